@@ -0,0 +1,81 @@
+"""
+Reading append-only tables in commit order.
+
+Sequence numbers are allocated when a row is inserted, but transactions don't commit in that
+order: a row with a lower id can become visible after a higher one, and a reader paging on the
+id would skip it for good. No clock fixes that, a transaction can always take longer to commit.
+
+On Postgres, a trigger (record_insert_xmax, see passengers/migrations/0015) stores the xmax of
+a fresh snapshot in every new row's insert_xmax column, after its id was allocated: every
+transaction that had an id (xid) by then has a lower one. Once the oldest transaction still
+running (the xmin of the reader's snapshot) is past it, all of those have committed or rolled
+back, so no row with a lower id can still appear. Readers
+page on the id but only up to the last such row (committed_rows()): they wait for the gaps to
+close instead of guessing. A transaction left open holds the readers back, it never makes them
+skip rows.
+
+This relies on every writer having an xid before its rows' ids are allocated, true as soon as
+it wrote anything else in the transaction; assign_transaction_id() takes one otherwise.
+
+Other databases (SQLite in development) run one writing transaction at a time, so ids are
+allocated in commit order and insert_xmax stays NULL.
+"""
+from django.db import connections
+from django.db.models import Max, Q
+
+
+def assign_transaction_id(using):
+    """Makes sure the current transaction has an xid, for writers whose first write is the log"""
+    connection = connections[using]
+    if connection.vendor == "postgresql":
+        with connection.cursor() as cursor:
+            cursor.execute("SELECT pg_current_xact_id()")
+
+
+def snapshot_xmin(using):
+    """Every transaction with a lower xid is finished. None outside of Postgres"""
+    connection = connections[using]
+    if connection.vendor != "postgresql":
+        return None
+    with connection.cursor() as cursor:
+        cursor.execute("SELECT pg_snapshot_xmin(pg_current_snapshot())::text::bigint")
+        return cursor.fetchone()[0]
+
+
+def committed_rows(queryset, key, fields, after, limit):
+    """
+    Up to limit rows of queryset with key above after, as tuples of fields ordered by key,
+    that no row still being inserted can come before. queryset's model needs an insert_xmax
+    column (see above).
+    """
+    # Read first: the rows are read from a later snapshot, which sees everything it covers
+    xmin = snapshot_xmin(queryset.db)
+    rows = list(
+        queryset.filter(**{f"{key}__gt": after})
+        .order_by(key)
+        .values_list(*fields, "insert_xmax")[:limit]
+    )
+    if xmin is None:
+        return [tuple(row[:-1]) for row in rows]
+
+    # The rows before a committed one are all visible already, whatever their own insert_xmax
+    last = max(
+        (
+            index
+            for index, row in enumerate(rows)
+            # NULL for the rows inserted before the trigger existed
+            if row[-1] is None or row[-1] <= xmin
+        ),
+        default=-1,
+    )
+    return [tuple(row[:-1]) for row in rows[: last + 1]]
+
+
+def committed_position(queryset, key):
+    """The highest key that no row still being inserted can come before, 0 for no rows"""
+    xmin = snapshot_xmin(queryset.db)
+    if xmin is not None:
+        queryset = queryset.filter(
+            Q(insert_xmax__isnull=True) | Q(insert_xmax__lte=xmin)
+        )
+    return queryset.aggregate(position=Max(key))["position"] or 0
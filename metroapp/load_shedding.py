@@ -0,0 +1,176 @@
+"""
+Priority-aware load shedding.
+
+Every request is classified by the view it resolves to, from the most to the least critical:
+    GATE: gate scans and the scanner's incoming/outgoing pages, turnstiles wait on them
+    CONFIRMATION: OTP confirmation, the passenger already started paying
+    PURCHASE: purchase quotes and the other routing heavy pages
+    DEFAULT: everything else (dashboard, signup, admin, reports, ...)
+
+Each process has a budget of settings.SHED_MAX_IN_FLIGHT concurrent requests. Lower priorities
+may only use part of it, so the rest stays reserved for the higher ones: under a surge, purchases
+are turned away before they can take the threads the gates need. A request is also turned away
+when it already waited in the queue (nginx -> gunicorn) longer than its priority allows, the
+client has most likely given up on it. Gate requests are never shed.
+
+Shed requests get an immediate 503 with Retry-After. Sheds are counted per priority and minute
+in the cache, so the counts of every process add up (see shed_counts() and shed_metrics).
+"""
+import logging
+import threading
+import time
+
+from django.conf import settings
+from django.core.cache import cache
+from django.contrib.admin.views.decorators import staff_member_required
+from django.http import HttpResponse, JsonResponse
+from django.urls import Resolver404, resolve
+from django.views.decorators.cache import never_cache
+
+logger = logging.getLogger(__name__)
+
+GATE = "gate"
+CONFIRMATION = "confirmation"
+PURCHASE = "purchase"
+DEFAULT = "default"
+
+PRIORITIES = [GATE, CONFIRMATION, PURCHASE, DEFAULT]
+
+# URL names (namespace:name) of the requests that aren't DEFAULT
+VIEW_PRIORITIES = {
+    "scanner:gate-incoming": GATE,
+    "scanner:gate-outgoing": GATE,
+    "scanner:gate-revocations": GATE,
+    "scanner:scanner-incoming": GATE,
+    "scanner:scanner-outgoing": GATE,
+    "confirmation": CONFIRMATION,
+    "purchase": PURCHASE,
+    "station-search": PURCHASE,
+    "scanner:offline": PURCHASE,
+    "scanner:offline-group": PURCHASE,
+    "api:confirm": CONFIRMATION,
+    "api:purchase": PURCHASE,
+    "api:quote": PURCHASE,
+}
+
+# priority: (share of settings.SHED_MAX_IN_FLIGHT it may use, multiple of
+# settings.SHED_MAX_QUEUE_MS it may have waited), None for no limit
+LIMITS = {
+    GATE: (None, None),
+    CONFIRMATION: (0.9, 4),
+    PURCHASE: (0.75, 2),
+    DEFAULT: (0.5, 1),
+}
+
+# Shed counters are kept per minute for an hour
+SHED_COUNT_TIMEOUT = 60 * 60
+
+
+def classify(request):
+    try:
+        view_name = resolve(request.path_info).view_name
+    except Resolver404:
+        return DEFAULT
+    return VIEW_PRIORITIES.get(view_name, DEFAULT)
+
+
+def queue_wait_ms(request):
+    """
+    How long the request waited before reaching Django, from the X-Request-Start header set by
+    nginx ("t=<seconds since the epoch>", see nginx/default.conf). None without the header.
+    """
+    header = request.META.get("HTTP_X_REQUEST_START", "")
+    try:
+        started = float(header.removeprefix("t="))
+    except ValueError:
+        return None
+    return max((time.time() - started) * 1000, 0)
+
+
+def shed_key(priority, minute):
+    return f"load-shedding:{priority}:{minute}"
+
+
+def count_shed(priority):
+    key = shed_key(priority, int(time.time() // 60))
+    try:
+        cache.incr(key)
+    except ValueError:
+        if not cache.add(key, 1, SHED_COUNT_TIMEOUT):
+            cache.incr(key)
+
+
+def shed_counts(minutes=15):
+    """{priority: [sheds per minute, oldest first]} over the last minutes, for every process"""
+    now = int(time.time() // 60)
+    window = range(now - minutes + 1, now + 1)
+    counts = cache.get_many(
+        [shed_key(priority, minute) for priority in PRIORITIES for minute in window]
+    )
+    return {
+        priority: [counts.get(shed_key(priority, minute), 0) for minute in window]
+        for priority in PRIORITIES
+    }
+
+
+class LoadSheddingMiddleware:
+    """First in settings.MIDDLEWARE, so a shed request costs no session or database work"""
+
+    def __init__(self, get_response):
+        self.get_response = get_response
+        self.in_flight = 0
+        self.lock = threading.Lock()
+
+    def __call__(self, request):
+        if not settings.SHED_ENABLED:
+            return self.get_response(request)
+
+        priority = classify(request)
+        share, max_wait = LIMITS[priority]
+
+        if max_wait is not None:
+            waited = queue_wait_ms(request)
+            if waited is not None and waited > max_wait * settings.SHED_MAX_QUEUE_MS:
+                return self.shed(priority, f"waited {waited:.0f}ms")
+
+        with self.lock:
+            if (
+                share is not None
+                and self.in_flight >= share * settings.SHED_MAX_IN_FLIGHT
+            ):
+                admitted = False
+            else:
+                admitted = True
+                self.in_flight += 1
+
+        if not admitted:
+            return self.shed(priority, f"{self.in_flight} requests in flight")
+
+        try:
+            return self.get_response(request)
+        finally:
+            with self.lock:
+                self.in_flight -= 1
+
+    def shed(self, priority, reason):
+        count_shed(priority)
+        logger.info("Shed a %s request: %s", priority, reason)
+
+        response = HttpResponse(
+            "The service is busy, please try again shortly.",
+            status=503,
+            content_type="text/plain",
+        )
+        response["Retry-After"] = str(settings.SHED_RETRY_AFTER)
+        return response
+
+
+@staff_member_required
+@never_cache
+def shed_metrics(request):
+    """JSON sheds per priority and minute, ?minutes= (default 15, at most 60)"""
+    try:
+        minutes = min(max(int(request.GET.get("minutes", 15)), 1), 60)
+    except ValueError:
+        minutes = 15
+    return JsonResponse({"minutes": minutes, "shed": shed_counts(minutes)})
@@ -0,0 +1,108 @@
+"""
+Read replica routing.
+
+Reads only go to a replica inside a use_replica() block, which the replica_reads view decorator
+opens for GET/HEAD requests of pure read views (the dashboard, the station list for purchases,
+admin changelists). Everything else, and every write, uses the default (primary) database.
+
+Reads made inside a transaction stay on the primary too: they must see its own writes, and the
+rows it locked.
+
+Replicas lag behind the primary, so a passenger who just bought a ticket or topped up would not
+see it on the next page. pin_to_primary() marks the session so that passenger's reads stay on
+the primary for settings.REPLICA_STICKY_SECONDS after their own write (read-your-writes).
+"""
+import random
+import time
+from contextlib import contextmanager
+from contextvars import ContextVar
+from functools import wraps
+
+from django.conf import settings
+from django.db import connections
+from django.template.response import SimpleTemplateResponse
+
+# Set while the current request (thread or async task) may read from a replica
+_use_replica = ContextVar("use_replica", default=False)
+
+# Session key holding the time until which the passenger's reads stay on the primary
+PRIMARY_UNTIL_SESSION_KEY = "primary_until"
+
+# Apps that are always read from the primary. Sessions are written on almost every request and
+# must be read back immediately
+PRIMARY_ONLY_APPS = {"sessions"}
+
+
+@contextmanager
+def use_replica():
+    """Sends the reads made inside the block to a replica (if any is configured)"""
+    token = _use_replica.set(True)
+    try:
+        yield
+    finally:
+        _use_replica.reset(token)
+
+
+def pin_to_primary(request):
+    """Keeps this passenger's reads on the primary for a while after one of their own writes"""
+    request.session[PRIMARY_UNTIL_SESSION_KEY] = (
+        time.time() + settings.REPLICA_STICKY_SECONDS
+    )
+
+
+def is_pinned(request):
+    session = getattr(request, "session", None)
+    if session is None:
+        return False
+    return session.get(PRIMARY_UNTIL_SESSION_KEY, 0) > time.time()
+
+
+def replica_reads(view):
+    """
+    View decorator: the reads of GET/HEAD requests go to a replica, unless the passenger
+    recently wrote something (see pin_to_primary). Other methods are left on the primary.
+    """
+
+    @wraps(view)
+    def wrapper(request, *args, **kwargs):
+        if request.method not in ("GET", "HEAD") or is_pinned(request):
+            return view(request, *args, **kwargs)
+
+        with use_replica():
+            response = view(request, *args, **kwargs)
+            # TemplateResponses (ex. admin changelists) are rendered lazily, after the view
+            # returns. Render them here so the queries made while rendering use the replica too
+            if isinstance(response, SimpleTemplateResponse):
+                response.render()
+            return response
+
+    return wrapper
+
+
+class ReplicaRouter:
+    """
+    Database router (settings.DATABASE_ROUTERS): reads inside use_replica() go to a randomly
+    chosen alias from settings.DATABASE_REPLICAS unless a transaction is open on the primary,
+    everything else to the default database.
+    """
+
+    def db_for_read(self, model, **hints):
+        if (
+            _use_replica.get()
+            and settings.DATABASE_REPLICAS
+            and model._meta.app_label not in PRIMARY_ONLY_APPS
+            and not connections["default"].in_atomic_block
+        ):
+            return random.choice(settings.DATABASE_REPLICAS)
+        return "default"
+
+    def db_for_write(self, model, **hints):
+        return "default"
+
+    def allow_relation(self, obj1, obj2, **hints):
+        # The replicas hold the same data as the primary
+        return True
+
+    def allow_migrate(self, db, app_label, model_name=None, **hints):
+        # Replicas get the schema through replication
+        return db == "default"
@@ -10,6 +10,7 @@ For the full list of settings and their values, see
 https://docs.djangoproject.com/en/5.2/ref/settings/
 """
 import os
+import sys
 
 from pathlib import Path
 from dotenv import load_dotenv
@@ -47,6 +48,7 @@ CSRF_TRUSTED_ORIGINS = [
 INSTALLED_APPS = [
     "passengers.apps.PassengersConfig",
     "scanner.apps.ScannerConfig",
+    "ridership.apps.RidershipConfig",
     "django.contrib.admin",
     "django.contrib.auth",
     "django.contrib.contenttypes",
@@ -79,9 +81,10 @@ DEFAULT_FROM_EMAIL=os.environ.get("MAILGUN_FROM_EMAIL")
 # EMAIL_HOST_PASSWORD = os.environ.get("EMAIL_HOST_PASSWORD")
 
 
+# Django's and allauth's backends, loading the passenger with the user (see passengers/backends.py)
 AUTHENTICATION_BACKENDS = [
-    "django.contrib.auth.backends.ModelBackend",
-    "allauth.account.auth_backends.AuthenticationBackend",
+    "passengers.backends.ModelBackend",
+    "passengers.backends.AuthenticationBackend",
 ]
 
 SOCIALACCOUNT_PROVIDERS = {
@@ -103,8 +106,11 @@ SOCIALACCOUNT_PROVIDERS = {
 
 
 MIDDLEWARE = [
+    # First, so shed requests are answered before any other work
+    "metroapp.load_shedding.LoadSheddingMiddleware",
     "django.middleware.security.SecurityMiddleware",
     "django.contrib.sessions.middleware.SessionMiddleware",
+    "passengers.middleware.LegacySessionBackendMiddleware",
     "django.middleware.common.CommonMiddleware",
     "django.middleware.csrf.CsrfViewMiddleware",
     "django.contrib.auth.middleware.AuthenticationMiddleware",
@@ -144,9 +150,60 @@ DATABASES = {
         "PASSWORD": os.environ.get("POSTGRES_PASSWORD"),
         "HOST": os.environ.get("POSTGRES_HOST", "localhost"),
         "PORT": os.environ.get("POSTGRES_PORT", 5432),
+        # Persistent connections, reused across requests instead of reconnecting every time.
+        # Health checks make sure a connection that went away is replaced before it is used.
+        "CONN_MAX_AGE": int(os.environ.get("POSTGRES_CONN_MAX_AGE", 60)),
+        "CONN_HEALTH_CHECKS": True,
     }
 }
 
+# Read replicas, as a comma separated list of hosts with the same credentials as the primary.
+# Pointing one at the primary itself (ex. POSTGRES_REPLICA_HOSTS=localhost) is enough to try
+# the routing locally. During tests the replicas mirror the default database.
+replica_hosts = os.environ.get("POSTGRES_REPLICA_HOSTS", "")
+for number, host in enumerate(
+    [host.strip() for host in replica_hosts.split(",") if host.strip()], start=1
+):
+    DATABASES[f"replica{number}"] = {
+        **DATABASES["default"],
+        "HOST": host,
+        "TEST": {"MIRROR": "default"},
+    }
+
+DATABASE_REPLICAS = [alias for alias in DATABASES if alias != "default"]
+DATABASE_ROUTERS = ["metroapp.replicas.ReplicaRouter"]
+
+# manage.py test also gets a "replica" alias mirroring the default database, so the routing is
+# tested without any replica configured (see metroapp/tests.py). It isn't in DATABASE_REPLICAS:
+# only the tests that override it read from it
+if sys.argv[1:2] == ["test"]:
+    DATABASES["replica"] = {**DATABASES["default"], "TEST": {"MIRROR": "default"}}
+
+# How long a passenger's reads stay on the primary after their own purchase or top-up, so they
+# don't see stale data while the replicas catch up
+REPLICA_STICKY_SECONDS = int(os.environ.get("REPLICA_STICKY_SECONDS", 15))
+
+# Cache
+# Shared by every process when REDIS_URL is set (needed for the station occupancy counters with
+# more than one process), per process memory otherwise
+REDIS_URL = os.environ.get('REDIS_URL', '')
+if REDIS_URL:
+    CACHES = {
+        "default": {
+            "BACKEND": "django.core.cache.backends.redis.RedisCache",
+            "LOCATION": REDIS_URL,
+        }
+    }
+
+# Sessions
+# With Redis, read from the cache and written through to the database: a cache miss (or a flushed
+# Redis) only costs the database read the default engine makes on every request. The local
+# memory cache isn't shared between processes, the cached copy there would only add writes
+if REDIS_URL:
+    SESSION_ENGINE = 'django.contrib.sessions.backends.cached_db'
+else:
+    SESSION_ENGINE = 'django.contrib.sessions.backends.db'
+
 
 # Password validation
 # https://docs.djangoproject.com/en/5.2/ref/settings/#auth-password-validators
@@ -185,6 +242,85 @@ USE_TZ = True
 STATIC_URL = '/static/'
 STATIC_ROOT = os.path.join(BASE_DIR, 'static')
 
+# Routing
+# Precomputed routing data (contraction hierarchies) built by the build_contraction_hierarchy
+# management command, one file per network version
+ROUTING_DATA_DIR = os.environ.get('ROUTING_DATA_DIR', BASE_DIR / 'routing_data')
+# Maximum number of origin/destination pairs whose best route is kept in memory, per process
+ROUTE_TABLE_SIZE = int(os.environ.get('ROUTE_TABLE_SIZE', 100000))
+# Seconds the alternative routes between two stations stay in the cache. They are keyed by
+# topology version and disabled lines, the ones of older networks are only left to expire
+ALTERNATIVE_ROUTES_CACHE_SECONDS = int(os.environ.get('ALTERNATIVE_ROUTES_CACHE_SECONDS', 24 * 3600))
+# Unix socket of the routing daemon (routing_daemon command). Empty: every process routes itself
+ROUTING_SOCKET = os.environ.get('ROUTING_SOCKET', '')
+# Seconds to wait for the daemon before routing in-process, and before trying it again after that
+ROUTING_DAEMON_TIMEOUT = float(os.environ.get('ROUTING_DAEMON_TIMEOUT', 1))
+ROUTING_DAEMON_RETRY_SECONDS = int(os.environ.get('ROUTING_DAEMON_RETRY_SECONDS', 5))
+# The daemon answers the queries received within this many seconds together
+ROUTING_BATCH_WINDOW = float(os.environ.get('ROUTING_BATCH_WINDOW', 0.002))
+
+# Admin
+# Changelists of unfiltered tables with at least this many rows show the Postgres row
+# estimate instead of running an exact COUNT(*)
+ESTIMATED_COUNT_THRESHOLD = int(os.environ.get('ESTIMATED_COUNT_THRESHOLD', 100000))
+
+# Gates
+# Key of the HMAC signed ticket tokens, shared with the gates. Derived from SECRET_KEY if empty
+TICKET_TOKEN_KEY = os.environ.get('TICKET_TOKEN_KEY', '')
+# Seconds a ticket token stays valid after being issued
+TICKET_TOKEN_LIFETIME = int(os.environ.get('TICKET_TOKEN_LIFETIME', 24 * 60 * 60))
+# How often the revocation filter is rebuilt/re-synced, and its false positive rate
+REVOCATION_REFRESH_SECONDS = int(os.environ.get('REVOCATION_REFRESH_SECONDS', 30))
+REVOCATION_FALSE_POSITIVE_RATE = float(os.environ.get('REVOCATION_FALSE_POSITIVE_RATE', 0.001))
+# The status changes of gate scans are written every GATE_WRITE_INTERVAL seconds, in batches of
+# up to GATE_WRITE_BATCH_SIZE
+GATE_WRITE_BATCH_SIZE = int(os.environ.get('GATE_WRITE_BATCH_SIZE', 500))
+GATE_WRITE_INTERVAL = float(os.environ.get('GATE_WRITE_INTERVAL', 0.5))
+# Tap events are buffered in memory (at most TAP_LOG_BUFFER_SIZE of them) and written every
+# TAP_LOG_FLUSH_INTERVAL seconds, in batches of TAP_LOG_BATCH_SIZE
+TAP_LOG_BUFFER_SIZE = int(os.environ.get('TAP_LOG_BUFFER_SIZE', 100000))
+TAP_LOG_BATCH_SIZE = int(os.environ.get('TAP_LOG_BATCH_SIZE', 5000))
+TAP_LOG_FLUSH_INTERVAL = float(os.environ.get('TAP_LOG_FLUSH_INTERVAL', 1))
+
+# Ticket archive
+# Expired tickets are moved to the archive by the archive_tickets command after this many days
+# (never before TICKET_TOKEN_LIFETIME, the revocation filter needs them)
+TICKET_ARCHIVE_AFTER_DAYS = int(os.environ.get('TICKET_ARCHIVE_AFTER_DAYS', 30))
+
+# Load shedding
+SHED_ENABLED = os.environ.get('SHED_ENABLED', 'true').lower() == 'true'
+# Concurrent requests per process, the number of gunicorn threads per worker. Lower priority
+# requests only get a share of it, the rest is kept for gate scans
+SHED_MAX_IN_FLIGHT = int(os.environ.get('SHED_MAX_IN_FLIGHT', 8))
+# Time in the queue (from nginx's X-Request-Start) after which default priority requests are
+# shed, purchases may wait twice as long and confirmations four times
+SHED_MAX_QUEUE_MS = int(os.environ.get('SHED_MAX_QUEUE_MS', 1000))
+# Retry-After of the 503 responses, in seconds
+SHED_RETRY_AFTER = int(os.environ.get('SHED_RETRY_AFTER', 5))
+
+# Station occupancy
+# Counter changes from the scanner are written to the cache every OCCUPANCY_FLUSH_INTERVAL seconds
+OCCUPANCY_FLUSH_INTERVAL = float(os.environ.get('OCCUPANCY_FLUSH_INTERVAL', 0.5))
+# How often the live occupancy streams are updated, and sent a keep-alive when nothing changed
+OCCUPANCY_TICK_SECONDS = float(os.environ.get('OCCUPANCY_TICK_SECONDS', 1))
+OCCUPANCY_HEARTBEAT_SECONDS = int(os.environ.get('OCCUPANCY_HEARTBEAT_SECONDS', 15))
+# How often the tapped in counts are recounted from the database, correcting any drift
+OCCUPANCY_RESYNC_SECONDS = int(os.environ.get('OCCUPANCY_RESYNC_SECONDS', 300))
+
+# Sweeper
+# Pending tickets (unconfirmed purchases) older than this are deleted by the sweep command
+PENDING_TICKET_TIMEOUT_MINUTES = int(os.environ.get('PENDING_TICKET_TIMEOUT_MINUTES', 60))
+# Rows deleted per transaction
+SWEEP_BATCH_SIZE = int(os.environ.get('SWEEP_BATCH_SIZE', 1000))
+
+# Ticket change feed
+# Maximum number of changes returned per request
+CHANGE_FEED_BATCH_SIZE = int(os.environ.get('CHANGE_FEED_BATCH_SIZE', 1000))
+
+# Ridership rollups
+# Rows read per transaction by the rollup_ridership command
+ROLLUP_BATCH_SIZE = int(os.environ.get('ROLLUP_BATCH_SIZE', 50000))
+
 # Default primary key field type
 # https://docs.djangoproject.com/en/5.2/ref/settings/#default-auto-field
 
@@ -0,0 +1,220 @@
+"""
+Tests of the load shedding middleware (see load_shedding.py), on requests built with
+RequestFactory: the views behind them are never called.
+
+ReplicaRoutingTests send the reads to the "replica" alias that test runs get (see settings.py).
+It mirrors the default database on another connection, which only sees committed data: they are
+TransactionTestCases.
+"""
+import threading
+import time
+from unittest import mock
+
+from django.conf import settings
+from django.contrib.sessions.backends.db import SessionStore
+from django.contrib.sessions.models import Session
+from django.core.cache import cache
+from django.db import connections, router, transaction
+from django.http import HttpResponse
+from django.test import (
+    RequestFactory,
+    SimpleTestCase,
+    TransactionTestCase,
+    override_settings,
+)
+from django.test.utils import CaptureQueriesContext
+from django.urls import reverse
+
+from passengers.models import Station
+from . import load_shedding, replicas
+from .load_shedding import (
+    CONFIRMATION,
+    DEFAULT,
+    GATE,
+    PURCHASE,
+    LoadSheddingMiddleware,
+)
+
+
+@override_settings(
+    SHED_ENABLED=True, SHED_MAX_IN_FLIGHT=4, SHED_MAX_QUEUE_MS=100, SHED_RETRY_AFTER=7
+)
+class LoadSheddingTests(SimpleTestCase):
+    def setUp(self):
+        cache.clear()
+        self.factory = RequestFactory()
+        self.middleware = LoadSheddingMiddleware(lambda request: HttpResponse("ok"))
+
+    def request(self, priority, waited_ms=None):
+        path = {
+            GATE: reverse("scanner:gate-incoming", args=[1]),
+            CONFIRMATION: reverse("confirmation", args=[1]),
+            PURCHASE: reverse("purchase"),
+            DEFAULT: reverse("dashboard"),
+        }[priority]
+        headers = {}
+        if waited_ms is not None:
+            headers["x_request_start"] = f"t={time.time() - waited_ms / 1000:.3f}"
+        return self.factory.get(path, headers=headers)
+
+    def assertShed(self, response):
+        self.assertEqual(response.status_code, 503)
+        self.assertEqual(response["Retry-After"], "7")
+
+    def test_classify(self):
+        for priority in load_shedding.PRIORITIES:
+            with self.subTest(priority=priority):
+                self.assertEqual(
+                    load_shedding.classify(self.request(priority)), priority
+                )
+        self.assertEqual(load_shedding.classify(self.factory.get("/nowhere")), DEFAULT)
+
+    def test_queue_wait(self):
+        # Up to 4, 2 and 1 times SHED_MAX_QUEUE_MS
+        for priority, admitted, shed in [
+            (CONFIRMATION, 350, 450),
+            (PURCHASE, 150, 250),
+            (DEFAULT, 50, 150),
+        ]:
+            with self.subTest(priority=priority):
+                self.assertEqual(
+                    self.middleware(self.request(priority, admitted)).status_code, 200
+                )
+                self.assertShed(self.middleware(self.request(priority, shed)))
+        # Gates are never shed, and requests without the header are never too late
+        self.assertEqual(self.middleware(self.request(GATE, 60000)).status_code, 200)
+        self.assertEqual(self.middleware(self.request(DEFAULT)).status_code, 200)
+
+    def test_in_flight_shares(self):
+        release = threading.Event()
+        started = threading.Semaphore(0)
+
+        def blocked(request):
+            started.release()
+            release.wait(5)
+            return HttpResponse("ok")
+
+        middleware = LoadSheddingMiddleware(blocked)
+        # Half of SHED_MAX_IN_FLIGHT for the default requests
+        threads = [
+            threading.Thread(target=middleware, args=[self.request(DEFAULT)])
+            for _ in range(2)
+        ]
+        for thread in threads:
+            thread.start()
+            started.acquire()
+
+        try:
+            middleware.get_response = lambda request: HttpResponse("ok")
+            self.assertShed(middleware(self.request(DEFAULT)))
+            # The rest is reserved for the higher priorities
+            for priority in (PURCHASE, CONFIRMATION, GATE):
+                self.assertEqual(middleware(self.request(priority)).status_code, 200)
+        finally:
+            release.set()
+            for thread in threads:
+                thread.join()
+
+        self.assertEqual(middleware.in_flight, 0)
+        self.assertEqual(middleware(self.request(DEFAULT)).status_code, 200)
+
+    def test_gates_are_never_shed(self):
+        self.middleware.in_flight = 100
+        self.assertEqual(self.middleware(self.request(GATE)).status_code, 200)
+        self.assertShed(self.middleware(self.request(CONFIRMATION)))
+        self.assertEqual(self.middleware.in_flight, 100)
+
+    def test_in_flight_released_on_errors(self):
+        def failing(request):
+            raise RuntimeError
+
+        middleware = LoadSheddingMiddleware(failing)
+        with self.assertRaises(RuntimeError):
+            middleware(self.request(DEFAULT))
+        self.assertEqual(middleware.in_flight, 0)
+
+    def test_shed_counts(self):
+        self.middleware.in_flight = 100
+        # In the middle of a minute
+        now = (time.time() // 60) * 60 + 30
+        with mock.patch.object(load_shedding.time, "time", return_value=now):
+            for priority in (DEFAULT, DEFAULT, PURCHASE):
+                self.middleware(self.request(priority))
+            counts = load_shedding.shed_counts(minutes=2)
+        self.assertEqual(counts[DEFAULT], [0, 2])
+        self.assertEqual(counts[PURCHASE], [0, 1])
+        self.assertEqual(counts[GATE], [0, 0])
+
+    @override_settings(SHED_ENABLED=False)
+    def test_disabled(self):
+        self.middleware.in_flight = 100
+        self.assertEqual(self.middleware(self.request(DEFAULT, 60000)).status_code, 200)
+
+
+@override_settings(DATABASE_REPLICAS=["replica"])
+class ReplicaRoutingTests(TransactionTestCase):
+    databases = {"default", "replica"}
+
+    def setUp(self):
+        self.factory = RequestFactory()
+        Station.objects.create(name="A")
+
+    def queries(self, function, *args, **kwargs):
+        """function's result and {alias: number of queries it made}"""
+        with CaptureQueriesContext(connections["default"]) as primary:
+            with CaptureQueriesContext(connections["replica"]) as replica:
+                result = function(*args, **kwargs)
+        return result, {"default": len(primary), "replica": len(replica)}
+
+    def request(self, method="get", session=None):
+        request = getattr(self.factory, method)("/")
+        request.session = session if session is not None else SessionStore()
+        return request
+
+    @staticmethod
+    @replicas.replica_reads
+    def count_stations(request):
+        return HttpResponse(Station.objects.count())
+
+    def test_replica_reads(self):
+        response, queries = self.queries(self.count_stations, self.request())
+        self.assertEqual(response.content, b"1")
+        self.assertEqual(queries, {"default": 0, "replica": 1})
+
+        # Other methods stay on the primary
+        _, queries = self.queries(self.count_stations, self.request("post"))
+        self.assertEqual(queries, {"default": 1, "replica": 0})
+
+    def test_writes_and_transactions_use_the_primary(self):
+        with replicas.use_replica():
+            _, queries = self.queries(Station.objects.update, name="B")
+            self.assertEqual(queries, {"default": 1, "replica": 0})
+
+            with transaction.atomic():
+                _, queries = self.queries(Station.objects.count)
+            self.assertEqual(queries, {"default": 1, "replica": 0})
+
+            # Committed, the replica has it
+            count, queries = self.queries(Station.objects.filter(name="B").count)
+            self.assertEqual((count, queries), (1, {"default": 0, "replica": 1}))
+
+            # Sessions are never read from a replica
+            self.assertEqual(router.db_for_read(Session), "default")
+            self.assertEqual(router.db_for_read(Station), "replica")
+        self.assertEqual(router.db_for_read(Station), "default")
+
+    @override_settings(REPLICA_STICKY_SECONDS=15)
+    def test_sticky_primary(self):
+        session = SessionStore()
+        replicas.pin_to_primary(self.request("post", session))
+
+        _, queries = self.queries(self.count_stations, self.request(session=session))
+        self.assertEqual(queries, {"default": 1, "replica": 0})
+
+        # Back on the replica once the window is over
+        expired = time.time() + settings.REPLICA_STICKY_SECONDS + 1
+        with mock.patch.object(replicas.time, "time", return_value=expired):
+            _, queries = self.queries(
+                self.count_stations, self.request(session=session)
+            )
+        self.assertEqual(queries, {"default": 0, "replica": 1})
@@ -18,10 +18,15 @@ from django.contrib import admin
 from django.urls import include, path
 from django.shortcuts import redirect
 
+from .load_shedding import shed_metrics
+
 urlpatterns = [
     path("admin/", admin.site.urls),
     path("passengers/", include("passengers.urls")),
+    path("api/v1/", include("passengers.api_urls")),
     path("", lambda request: redirect("/passengers/")),
     path("scanner/", include("scanner.urls")),
+    path("ridership/", include("ridership.urls")),
+    path("metrics/load-shedding", shed_metrics, name="shed-metrics"),
     path("accounts/", include('allauth.urls'))
 ]
@@ -3,71 +3,263 @@ Registers the Passenger, Ticket, Connection, and Line models to define the railw
 For the Station model, some additional functionality:
     View the number of tickets starting/ending at each station, provided the ticket is active
     or in use.
-    The list of tickets associated with that station
+    The list of the most recent tickets associated with that station
+For the Line model:
+    A disruption impact report (CSV) of the open tickets affected by disabling the selected lines
+For the Ticket and Connection models:
+    Changelists that load the related objects in the same query, raw id/autocomplete widgets
+    instead of dropdowns of every passenger/station, and an estimated row count on large tables
+    Streaming CSV/JSONL exports of the selected tickets
+For the ArchivedTicket model:
+    A read-only list of the tickets moved out of the Ticket table
+All changelists read from a read replica (see metroapp.replicas)
 """
 from django.contrib import admin
 from django.db import models
-from .models import Station, Passenger, Ticket, Connection, Line
+from django.db.models import Prefetch
+from django.db.models.functions import Coalesce
+from django.http import StreamingHttpResponse
+from django.utils.decorators import method_decorator
+from metroapp.replicas import replica_reads
+from .disruption import OPEN_TICKETS, affected_pairs, pair_rows
+from .models import Station, Passenger, Ticket, Connection, Line, ArchivedTicket
+from .pagination import EstimatedCountPaginator
+from .streaming import csv_lines
+from .ticket_export import export_response
+
+
+class ReplicaChangelistAdmin(admin.ModelAdmin):
+    """
+    Base class for the admin interfaces: changelists are pure reads, so they are served from a
+    read replica. Add/change/delete pages stay on the primary.
+    """
+
+    @method_decorator(replica_reads)
+    def changelist_view(self, request, extra_context=None):
+        return super().changelist_view(request, extra_context)
+
 
 # The register decorator is used here since we have a custom class for the Station-admin interface
 @admin.register(Station)
-class StationAdmin(admin.ModelAdmin):
+class StationAdmin(ReplicaChangelistAdmin):
     """
     Implements a custom Station-admin interface that displays all tickets associated with that
     station provided the ticket is active or in use and the list of tickets associated with that
     station
+
+    Both columns are loaded with the page: the count is annotated on the stations, and the most
+    recent tickets of every station on the page are prefetched, so the number of queries doesn't
+    depend on the number of stations or tickets.
     """
 
     # Which columns to show for this model
     list_display = ["name", "ticket_count", "tickets_overview"]
+    # Needed by the station autocomplete widgets of the Ticket and Connection forms
+    search_fields = ["name"]
+    ordering = ["name"]
+
+    # Tickets listed per station and direction, busy stations have far too many to list them all
+    OVERVIEW_TICKETS = 5
+
+    def get_queryset(self, request):
+        def open_tickets(field):
+            # Subqueries rather than a Count over both joins, which would multiply the rows
+            return Coalesce(
+                models.Subquery(
+                    Ticket.objects.filter(
+                        OPEN_TICKETS, **{field: models.OuterRef("pk")}
+                    )
+                    .values(field)
+                    .annotate(count=models.Count("id"))
+                    .values("count")
+                    .order_by()
+                ),
+                0,
+            )
+
+        def recent_tickets(related_name):
+            return Prefetch(
+                related_name,
+                queryset=Ticket.objects.select_related(
+                    "passenger__user", "start_station", "destination"
+                ).order_by("-id")[: self.OVERVIEW_TICKETS + 1],
+                to_attr=f"recent_{related_name}",
+            )
+
+        return (
+            super()
+            .get_queryset(request)
+            .annotate(
+                open_ticket_count=open_tickets("start_station")
+                + open_tickets("destination")
+            )
+            .prefetch_related(
+                recent_tickets("start_station"), recent_tickets("destination_station")
+            )
+        )
 
     # When using a callable, a model method, or a ModelAdmin method, you can customize
     # the column’s title by wrapping the callable with admin's display() decorator
-    @admin.display(description="Active/In Use Ticket count")
+    @admin.display(
+        description="Active/In Use Ticket count", ordering="open_ticket_count"
+    )
     def ticket_count(self, obj) -> int:
         """
         Returns the ticket count for all tickets that have start/end station as the given station
         (represented by the obj, the instance of the Station), given the ticket status is active or
         in use.
         """
-
-        # By default, filter uses AND operations which isn't always needed.
-        # models.Q (QueryExpression )structures a more complex query that can involve OR, NOT,
-        # as well as AND operations. Here, it is used to query the tickets which have start/end
-        # stations as the given station, and are active or in use
-        count = Ticket.objects.filter(
-            (models.Q(start_station=obj) | models.Q(destination=obj))
-            & (models.Q(status="active") | models.Q(status="in use"))
-        ).count()
-
-        return count
+        return obj.open_ticket_count
 
     @admin.display(description="Ticket Data")
     def tickets_overview(self, obj) -> str:
         """
-        Returns a comma separated list of all tickets connected to this station
+        Returns a comma separated list of the most recent tickets connected to this station,
+        followed by "..." if there are more
         ex:
             "user (Station A to Station B), ..."
         Returns '-' if no tickets exist
         """
-        tickets = Ticket.objects.filter(
-            models.Q(start_station=obj) | models.Q(destination=obj)
-        )
+        tickets = {
+            t.id: t for t in obj.recent_start_station + obj.recent_destination_station
+        }
 
         # Displays - if there are no tickets associated with that station
-        if not tickets.exists():
+        if not tickets:
             return "-"
 
-        return ", ".join(
+        recent = sorted(tickets.values(), key=lambda t: t.id, reverse=True)
+        overview = ", ".join(
             [
                 f"{t.passenger.user.username} ({t.start_station.name} to {t.destination.name})"
-                for t in tickets
+                for t in recent[: self.OVERVIEW_TICKETS]
             ]
         )
+        if len(recent) > self.OVERVIEW_TICKETS:
+            overview += ", ..."
+        return overview
+
+
+@admin.register(Line)
+class LineAdmin(ReplicaChangelistAdmin):
+    """
+    Implements a custom Line-admin interface. Disabling a line reports how many open tickets it
+    affects, and the disruption_impact action downloads the details for the selected lines.
+    """
+
+    list_display = ["name", "is_active"]
+    list_filter = ["is_active"]
+    actions = ["disruption_impact"]
+
+    @admin.action(description="Download disruption impact report (CSV)")
+    def disruption_impact(self, request, queryset):
+        """
+        Streams one CSV row per (start, destination) pair of open tickets whose route uses the
+        selected lines, with the fare without those lines, or whether it can't be routed at all.
+        """
+        line_ids = list(queryset.values_list("id", flat=True))
+
+        response = StreamingHttpResponse(
+            csv_lines(pair_rows(line_ids)), content_type="text/csv"
+        )
+        response["Content-Disposition"] = 'attachment; filename="disruption-impact.csv"'
+        return response
+
+    def save_model(self, request, obj, form, change):
+        super().save_model(request, obj, form, change)
+
+        # Operations needs to know straight away what disabling a line did to sold tickets
+        if change and "is_active" in form.changed_data and not obj.is_active:
+            impact = affected_pairs([obj.id])
+            tickets = sum(count for count, _, _ in impact.values())
+            unroutable = sum(
+                count for count, _, new_fare in impact.values() if new_fare is None
+            )
+            self.message_user(
+                request,
+                f"Disabling {obj.name} affects {tickets} open tickets over {len(impact)} "
+                f"station pairs, {unroutable} of them can no longer be routed. Use the "
+                "disruption impact action for the details.",
+            )
+
+
+@admin.register(Ticket)
+class TicketAdmin(ReplicaChangelistAdmin):
+    """
+    Implements a custom Ticket-admin interface, with actions exporting the selected tickets
+    (or all of them, with "select all") as a streamed download.
+
+    Ticket.__str__ and the list columns follow the passenger, user and station foreign keys,
+    list_select_related loads them with the page instead of with one query per row.
+    """
+
+    list_display = ["id", "passenger", "start_station", "destination", "cost", "status"]
+    list_select_related = ["passenger__user", "start_station", "destination"]
+    # status is indexed
+    list_filter = ["status"]
+    search_fields = ["=id", "=passenger__user__username"]
+    raw_id_fields = ["passenger"]
+    autocomplete_fields = ["start_station", "destination"]
+
+    # The tickets table is the largest one: don't count it exactly on every page
+    paginator = EstimatedCountPaginator
+    show_full_result_count = False
+
+    actions = ["export_csv", "export_jsonl"]
+
+    @admin.action(description="Export selected tickets (CSV)")
+    def export_csv(self, request, queryset):
+        return export_response(queryset, "csv", "ticket-history")
+
+    @admin.action(description="Export selected tickets (JSON lines)")
+    def export_jsonl(self, request, queryset):
+        return export_response(queryset, "jsonl", "ticket-history")
+
+
+@admin.register(Connection)
+class ConnectionAdmin(ReplicaChangelistAdmin):
+    """
+    Implements a custom Connection-admin interface, Connection.__str__ follows the line and
+    both stations, which are loaded with the page.
+    """
+
+    list_display = [
+        "start_station",
+        "destination_station",
+        "line",
+        "distance",
+        "travel_time",
+        "cost",
+    ]
+    list_select_related = ["line", "start_station", "destination_station"]
+    # Foreign keys are indexed, and there are only a few lines
+    list_filter = ["line"]
+    autocomplete_fields = ["start_station", "destination_station"]
+
+    paginator = EstimatedCountPaginator
+    show_full_result_count = False
+
+
+@admin.register(ArchivedTicket)
+class ArchivedTicketAdmin(ReplicaChangelistAdmin):
+    """Archived tickets are never modified, only moved there by the archive_tickets command"""
+
+    list_display = ["id", "passenger", "start_station", "destination", "cost", "status"]
+    list_select_related = ["passenger__user", "start_station", "destination"]
+    search_fields = ["=id", "=passenger__user__username"]
+    paginator = EstimatedCountPaginator
+    show_full_result_count = False
+
+    def has_add_permission(self, request):
+        return False
+
+    def has_change_permission(self, request, obj=None):
+        return False
+
 
+@admin.register(Passenger)
+class PassengerAdmin(ReplicaChangelistAdmin):
+    """Passenger.__str__ is the username, the users are loaded with the page"""
 
-# Registers the remaining models:
-admin.site.register(Passenger)
-admin.site.register(Ticket)
-admin.site.register(Connection)
-admin.site.register(Line)
+    list_select_related = ["user"]
+    search_fields = ["=user__username"]
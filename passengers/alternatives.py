@@ -0,0 +1,105 @@
+"""
+Alternative routes: the k shortest loopless paths between two stations (Yen's algorithm).
+
+Starting from the shortest path, every station along the previous best path is tried as a "spur"
+where the route leaves it: the path up to the spur station is kept, the connections already used
+from there by the paths found so far are removed, and a Dijkstra finds the best way on to the
+destination. The cheapest candidate becomes the next alternative.
+
+The spur searches are expensive: they are only made for the alternative_routes view, which the
+confirmation page loads after it is displayed, and the paths found are kept in the shared cache
+per topology version and set of disabled lines. Fares are read from the current graph when the
+routes are built, so the paths don't have to be searched again when the network version changes
+for something else.
+"""
+import heapq
+
+from django.conf import settings
+from django.core.cache import cache
+
+from .network import get_graph
+from .pathfinder import dijkstra
+
+
+def _path_nodes(graph, start_id, connection_ids):
+    """Station ids visited by a path of connections, starting with start_id"""
+    nodes = [start_id]
+    for cid in connection_ids:
+        edge = graph.edges[cid]
+        nodes.append(edge.end if edge.start == nodes[-1] else edge.start)
+    return nodes
+
+
+def k_shortest_paths(graph, start_id, end_id, k, weight="distance"):
+    """
+    Returns up to k loopless paths from start_id to end_id as lists of connection ids, shortest
+    first. Returns an empty list if there is no route at all.
+    """
+    try:
+        _, shortest = dijkstra(graph, start_id, end_id, weight)
+    except ValueError:
+        return []
+
+    found = [shortest]
+    seen = {tuple(shortest)}
+    # Candidates: (total_weight, connection_ids)
+    candidates = []
+
+    while len(found) < k:
+        previous = found[-1]
+        previous_nodes = _path_nodes(graph, start_id, previous)
+
+        for i, spur_node in enumerate(previous_nodes[:-1]):
+            root = previous[:i]
+            root_nodes = previous_nodes[: i + 1]
+
+            # Don't leave the spur station the same way as any path sharing this root
+            excluded_edges = {
+                path[i] for path in found if len(path) > i and path[:i] == root
+            }
+            # Stations on the root can't be visited again, the path would loop
+            excluded_nodes = set(root_nodes[:-1])
+
+            try:
+                _, spur = dijkstra(
+                    graph, spur_node, end_id, weight, excluded_edges, excluded_nodes
+                )
+            except ValueError:
+                continue
+
+            path = root + spur
+            if tuple(path) not in seen:
+                seen.add(tuple(path))
+                total = sum(float(getattr(graph.edges[cid], weight)) for cid in path)
+                heapq.heappush(candidates, (total, path))
+
+        if not candidates:
+            break
+        found.append(heapq.heappop(candidates)[1])
+
+    return found
+
+
+def _cache_key(graph, start_id, end_id, k, weight):
+    disabled = ",".join(str(line_id) for line_id in sorted(graph.disabled_lines))
+    return (
+        f"alternatives:{graph.topology_version}:{disabled}:"
+        f"{start_id}:{end_id}:{k}:{weight}"
+    )
+
+
+def alternative_routes(start_id, end_id, k=3, weight="distance"):
+    """
+    The k best routes between two station ids as network.Route tuples (cost, distance,
+    travel time, connection ids), best first. The paths are cached until the topology or the
+    disabled lines change.
+    """
+    graph = get_graph()
+    key = _cache_key(graph, start_id, end_id, k, weight)
+
+    paths = cache.get(key)
+    if paths is None:
+        paths = k_shortest_paths(graph, start_id, end_id, k, weight)
+        cache.set(key, paths, settings.ALTERNATIVE_ROUTES_CACHE_SECONDS)
+
+    return [graph.route(path) for path in paths]
@@ -0,0 +1,301 @@
+"""
+Versioned JSON API for the mobile app, mounted under /api/v1/ (see api_urls.py).
+
+Clients log in through the login page and send the session cookie back, POST requests also
+need the CSRF token in the X-CSRFToken header.
+
+    GET  balance
+    GET  tickets?before=<id>&limit=<n>   the passenger's tickets, most recent first, "next" is
+                                         the before of the next page (null on the last one)
+    GET  stations
+    GET  quote?start=<id>&destination=<id>
+    POST purchase {"start": <id>, "destination": <id>}   creates a pending ticket and emails
+                                                         the OTP
+    POST tickets/<id>/confirm {"otp": "<code>"}          pays for the pending ticket
+
+Reads have an ETag built from a version counter: Passenger.version (bumped whenever the
+balance or a ticket of the passenger changes) for the balance and tickets, the network versions
+for stations and quotes. A client sending it back in If-None-Match gets an empty 304 until the
+data changes. ?fields=a,b restricts the objects to those fields. Errors are {"error": message}
+with a 4xx status.
+
+Everything is read from the primary: the passenger's version is loaded with the user, the data
+it tags must not come from a lagging replica.
+"""
+import json
+import time
+from functools import wraps
+
+from django.conf import settings
+from django.db import transaction
+from django.http import JsonResponse
+from django.views.decorators.cache import cache_control
+from django.views.decorators.http import condition, require_GET, require_POST
+from metroapp.replicas import pin_to_primary
+from .catalogue import get_station_catalogue, get_stations_state
+from .models import OTP, Passenger, Station, Ticket
+from .network import get_network_version
+from .otp_generation import generate_otp, send_verification_email
+from .routing_client import shortest_route
+
+# Part of every ETag, to be changed with the format of the responses
+API_VERSION = "v1"
+
+TICKET_FIELDS = [
+    "id",
+    "start_station",
+    "destination",
+    "cost",
+    "status",
+    "status_changed_at",
+    "gate_token",
+]
+STATION_FIELDS = ["id", "name"]
+QUOTE_FIELDS = ["cost", "distance", "travel_time", "connections"]
+
+DEFAULT_PAGE_SIZE = 20
+MAX_PAGE_SIZE = 100
+
+# No spaces after the separators
+COMPACT = {"separators": (",", ":")}
+
+
+class ApiError(Exception):
+    def __init__(self, message, status=400):
+        super().__init__(message)
+        self.status = status
+
+
+def api_response(data, status=200):
+    return JsonResponse(data, status=status, json_dumps_params=COMPACT)
+
+
+def api_view(view):
+    """Answers anonymous requests with a 401 and ApiErrors with their status, instead of pages"""
+
+    @wraps(view)
+    def wrapper(request, *args, **kwargs):
+        if not request.user.is_authenticated:
+            return api_response({"error": "Authentication required"}, 401)
+        try:
+            return view(request, *args, **kwargs)
+        except ApiError as e:
+            return api_response({"error": str(e)}, e.status)
+
+    return wrapper
+
+
+def selected_fields(request, available):
+    """The fields asked for with ?fields=, all of them by default"""
+    if not request.GET.get("fields"):
+        return available
+    fields = request.GET["fields"].split(",")
+    unknown = [field for field in fields if field not in available]
+    if unknown:
+        raise ApiError(
+            f"Unknown fields: {', '.join(unknown)}. Available: {', '.join(available)}"
+        )
+    return fields
+
+
+def int_parameter(data, name, default=None):
+    value = data.get(name, default)
+    if value is None:
+        raise ApiError(f"{name} is required")
+    try:
+        return int(value)
+    except (TypeError, ValueError):
+        raise ApiError(f"{name} must be an integer")
+
+
+def json_body(request):
+    try:
+        data = json.loads(request.body)
+    except ValueError:
+        raise ApiError("The body must be JSON")
+    if not isinstance(data, dict):
+        raise ApiError("The body must be a JSON object")
+    return data
+
+
+def ticket_data(ticket, fields):
+    values = {
+        "id": lambda: ticket.id,
+        "start_station": lambda: ticket.start_station_id,
+        "destination": lambda: ticket.destination_id,
+        "cost": lambda: ticket.cost,
+        "status": lambda: ticket.status,
+        "status_changed_at": lambda: ticket.status_changed_at,
+        "gate_token": lambda: ticket.gate_token,
+    }
+    return {field: values[field]() for field in fields}
+
+
+def passenger_etag(request, *args, **kwargs):
+    return f'"{API_VERSION}-passenger-{request.user.passenger.version}"'
+
+
+def tickets_etag(request, *args, **kwargs):
+    etag = passenger_etag(request)
+    if "gate_token" in request.GET.get("fields", "gate_token"):
+        # Gate tokens expire: a client is sent new ones every half lifetime, so the ones it
+        # keeps on a 304 are always valid for at least another half
+        window = int(time.time() // (settings.TICKET_TOKEN_LIFETIME // 2))
+        etag = f'{etag[:-1]}-tokens-{window}"'
+    return etag
+
+
+def stations_etag(request, *args, **kwargs):
+    return f'"{API_VERSION}-stations-{get_stations_state(request)[0]}"'
+
+
+def network_etag(request, *args, **kwargs):
+    return f'"{API_VERSION}-network-{get_network_version()}"'
+
+
+@api_view
+@require_GET
+@cache_control(private=True, no_cache=True)
+@condition(etag_func=passenger_etag)
+def balance(request):
+    return api_response({"balance": request.user.passenger.bank_balance})
+
+
+@api_view
+@require_GET
+@cache_control(private=True, no_cache=True)
+@condition(etag_func=tickets_etag)
+def tickets(request):
+    fields = selected_fields(request, TICKET_FIELDS)
+    limit = min(
+        max(int_parameter(request.GET, "limit", DEFAULT_PAGE_SIZE), 1), MAX_PAGE_SIZE
+    )
+
+    page = request.user.passenger.ticket_history.order_by("-id")
+    if "before" in request.GET:
+        page = page.filter(id__lt=int_parameter(request.GET, "before"))
+    # One more than the page, to know if there is a next one
+    page = list(page[: limit + 1])
+
+    more = len(page) > limit
+    page = page[:limit]
+    return api_response(
+        {
+            "tickets": [ticket_data(ticket, fields) for ticket in page],
+            "next": page[-1].id if more else None,
+        }
+    )
+
+
+@api_view
+@require_GET
+@cache_control(private=True, no_cache=True)
+@condition(etag_func=stations_etag)
+def stations(request):
+    fields = selected_fields(request, STATION_FIELDS)
+    catalogue = get_station_catalogue(get_stations_state(request)[0])
+    return api_response(
+        {
+            "stations": [
+                {field: station[field] for field in fields} for station in catalogue
+            ]
+        }
+    )
+
+
+def route_between(start_id, destination_id):
+    if start_id == destination_id:
+        raise ApiError("Start and destination cannot be the same")
+    try:
+        return shortest_route(start_id, destination_id)
+    except ValueError:
+        raise ApiError("No metro lines operational that cover that route", 404)
+
+
+@api_view
+@require_GET
+@cache_control(private=True, no_cache=True)
+@condition(etag_func=network_etag)
+def quote(request):
+    fields = selected_fields(request, QUOTE_FIELDS)
+    route = route_between(
+        int_parameter(request.GET, "start"), int_parameter(request.GET, "destination")
+    )
+    values = {
+        "cost": route.cost,
+        "distance": route.distance,
+        "travel_time": route.travel_time,
+        "connections": route.connection_ids,
+    }
+    return api_response({field: values[field] for field in fields})
+
+
+@api_view
+@require_POST
+def purchase(request):
+    """Same checks as the purchase page, the OTP is sent straight away"""
+    data = json_body(request)
+    start_id = int_parameter(data, "start")
+    destination_id = int_parameter(data, "destination")
+    if Station.objects.filter(id__in=[start_id, destination_id]).count() != 2:
+        raise ApiError("Unknown station", 404)
+
+    route = route_between(start_id, destination_id)
+    passenger = request.user.passenger
+    if passenger.bank_balance < route.cost:
+        raise ApiError("Insufficient balance", 402)
+
+    ticket = Ticket.objects.create(
+        passenger=passenger,
+        start_station_id=start_id,
+        destination_id=destination_id,
+        cost=route.cost,
+        status="pending",
+    )
+    user_otp = generate_otp()
+    OTP.objects.create(user=passenger, code=user_otp)
+    send_verification_email(request.user.email, user_otp)
+    pin_to_primary(request)
+
+    return api_response({"ticket": ticket_data(ticket, TICKET_FIELDS)}, 201)
+
+
+@api_view
+@require_POST
+def confirm(request, ticket_id):
+    """Checks the OTP, deducts the cost and activates the ticket"""
+    code = str(json_body(request).get("otp", ""))
+
+    with transaction.atomic():
+        # Locked, so a ticket confirmed twice at the same time is only paid once
+        passenger = Passenger.objects.select_for_update().get(
+            id=request.user.passenger.id
+        )
+        ticket = (
+            Ticket.objects.select_for_update()
+            .filter(id=ticket_id, passenger=passenger)
+            .first()
+        )
+        if ticket is None:
+            raise ApiError("Unknown ticket", 404)
+        if ticket.status != "pending":
+            raise ApiError("The ticket is not pending", 409)
+
+        otp = OTP.objects.filter(user=passenger, code=code).last()
+        if not otp or not otp.is_valid():
+            raise ApiError("Invalid or expired OTP")
+        if passenger.bank_balance < ticket.cost:
+            raise ApiError("Insufficient balance", 402)
+
+        passenger.bank_balance -= ticket.cost
+        passenger.save()
+        ticket.status = "active"
+        ticket.save()
+    pin_to_primary(request)
+
+    return api_response(
+        {
+            "ticket": ticket_data(ticket, TICKET_FIELDS),
+            "balance": passenger.bank_balance,
+        }
+    )
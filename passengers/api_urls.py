@@ -0,0 +1,17 @@
+"""
+Version 1 of the JSON API, included under /api/v1/ (see api.py)
+"""
+from django.urls import path
+
+from . import api
+
+app_name = "api"
+
+urlpatterns = [
+    path("balance", api.balance, name="balance"),
+    path("tickets", api.tickets, name="tickets"),
+    path("tickets/<int:ticket_id>/confirm", api.confirm, name="confirm"),
+    path("stations", api.stations, name="stations"),
+    path("quote", api.quote, name="quote"),
+    path("purchase", api.purchase, name="purchase"),
+]
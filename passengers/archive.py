@@ -0,0 +1,85 @@
+"""
+Archival of expired tickets.
+
+Tickets expired long enough ago are moved from Ticket to ArchivedTicket, so the Ticket table
+(read by the gates, dashboards and reports of open tickets) and its indexes stay small enough
+to be cached in memory. passenger.ticket_history (the TicketHistory view) still shows both.
+
+Tickets are moved in batches ordered by id (keyset pagination, no OFFSET), each batch in its own
+short transaction: copy to the archive, delete from Ticket, and log the move to "archived" in
+the change feed. Rows being updated by someone else are skipped (SKIP LOCKED on Postgres) and
+picked up by the next run, so the archival never waits on, or blocks, the gates.
+
+Tickets expired less than a token lifetime ago stay in Ticket, the gates' revocation filter is
+built from them (see scanner/revocation.py).
+"""
+from datetime import timedelta
+
+from django.conf import settings
+from django.db import connection, transaction
+from django.db.models import Q
+from django.utils import timezone
+
+from .models import ArchivedTicket, Ticket, TicketChange
+
+FIELDS = [
+    "id",
+    "passenger_id",
+    "start_station_id",
+    "destination_id",
+    "cost",
+    "status",
+    "status_changed_at",
+]
+
+
+def archive_cutoff(days=None):
+    """Tickets expired before this moment can be archived"""
+    days = settings.TICKET_ARCHIVE_AFTER_DAYS if days is None else days
+    age = max(timedelta(days=days), timedelta(seconds=settings.TICKET_TOKEN_LIFETIME))
+    return timezone.now() - age
+
+
+def archive_batch(after_id, cutoff, batch_size):
+    """
+    Moves up to batch_size expired tickets with ids above after_id. Returns (moved, last_id),
+    last_id is None when there is nothing left to look at.
+    """
+    with transaction.atomic():
+        candidates = Ticket.objects.filter(
+            Q(status__iexact="expired"), id__gt=after_id, status_changed_at__lt=cutoff
+        ).order_by("id")
+        if connection.features.has_select_for_update_skip_locked:
+            candidates = candidates.select_for_update(skip_locked=True)
+
+        rows = list(candidates.values_list(*FIELDS)[:batch_size])
+        if not rows:
+            return 0, None
+
+        now = timezone.now()
+        ArchivedTicket.objects.bulk_create(
+            [ArchivedTicket(**dict(zip(FIELDS, row)), archived_at=now) for row in rows],
+            ignore_conflicts=True,
+        )
+        Ticket.objects.filter(id__in=[row[0] for row in rows]).delete()
+        # The change feed's consumers drop the tickets, the view still shows them
+        TicketChange.record([(row[0], row[5], "archived", row[4]) for row in rows], now)
+
+        return len(rows), rows[-1][0]
+
+
+def archive_expired(days=None, batch_size=1000, max_batches=None):
+    """Archives every ticket that expired more than days ago, returns how many were moved"""
+    cutoff = archive_cutoff(days)
+    moved = 0
+    last_id = 0
+    batches = 0
+
+    while max_batches is None or batches < max_batches:
+        count, last_id = archive_batch(last_id, cutoff, batch_size)
+        if last_id is None:
+            break
+        moved += count
+        batches += 1
+
+    return moved
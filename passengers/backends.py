@@ -0,0 +1,32 @@
+"""
+Authentication backends loading the passenger together with the user.
+
+The session only stores the user id, so the user is loaded again on every authenticated
+request, and nearly every page then reads request.user.passenger with another query. These
+backends load both with a single select_related query. A user without a passenger gets
+user.passenger raising RelatedObjectDoesNotExist as before (without a query), which
+LogoutOnMissingPassengerMiddleware turns into a logout.
+"""
+from allauth.account import auth_backends as allauth_backends
+from django.contrib.auth import backends, get_user_model
+
+UserModel = get_user_model()
+
+
+class PassengerMixin:
+    def get_user(self, user_id):
+        try:
+            user = UserModel._default_manager.select_related("passenger").get(
+                pk=user_id
+            )
+        except UserModel.DoesNotExist:
+            return None
+        return user if self.user_can_authenticate(user) else None
+
+
+class ModelBackend(PassengerMixin, backends.ModelBackend):
+    """Username and password logins"""
+
+
+class AuthenticationBackend(PassengerMixin, allauth_backends.AuthenticationBackend):
+    """allauth logins (ex. Google sign in)"""
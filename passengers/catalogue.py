@@ -0,0 +1,76 @@
+"""
+Cached station catalogue.
+
+The list of stations only changes when a Station is saved or deleted, which bumps
+NetworkVersion.stations_version (see signals.py). The catalogue is cached under that version,
+so it is only loaded from the database once per change. The station autocomplete index
+(station_search.py) is built from it.
+
+The same version is the basis of the ETag/Last-Modified headers of the purchase page.
+"""
+import hashlib
+
+from django.core.cache import cache
+
+# Cache entries are keyed by version and never go stale, old versions simply stop being read
+CATALOGUE_TIMEOUT = 24 * 60 * 60
+
+
+def get_stations_state(request=None):
+    """
+    Returns (stations_version, stations_updated_at). Stored on the request when given, since
+    the conditional GET checks and the view all need it.
+    """
+    from .models import NetworkVersion
+
+    if request is not None and hasattr(request, "_stations_state"):
+        return request._stations_state
+
+    state = NetworkVersion.objects.filter(pk=1).values_list(
+        "stations_version", "stations_updated_at"
+    )
+    state = state.first() or (0, None)
+
+    if request is not None:
+        request._stations_state = state
+    return state
+
+
+def get_station_catalogue(version=None):
+    """Returns the [{"id": ..., "name": ...}, ...] list of every station, cached per version"""
+    from .models import Station
+
+    if version is None:
+        version = get_stations_state()[0]
+
+    key = f"station-catalogue:{version}"
+    catalogue = cache.get(key)
+    if catalogue is None:
+        catalogue = list(Station.objects.order_by("id").values("id", "name"))
+        cache.set(key, catalogue, CATALOGUE_TIMEOUT)
+
+    return catalogue
+
+
+def purchase_etag(request):
+    """
+    ETag of the purchase page. The page also carries a CSRF token, so it depends on the CSRF
+    secret too: a new secret (ex. after logging in again) must not get a 304 with a stale token.
+    """
+    csrf_secret = request.META.get("CSRF_COOKIE")
+    if not csrf_secret:
+        return None
+
+    version = get_stations_state(request)[0]
+    csrf_hash = hashlib.sha256(csrf_secret.encode()).hexdigest()[:16]
+    return f"stations-{version}-{csrf_hash}"
+
+
+def purchase_last_modified(request):
+    """
+    Only sent along with the ETag: without a CSRF cookie the page sets a new one, which an
+    If-Modified-Since match would skip.
+    """
+    if purchase_etag(request) is None:
+        return None
+    return get_stations_state(request)[1]
@@ -0,0 +1,40 @@
+"""
+Ticket change feed: incremental sync of ticket states for gates, kiosks and reporting jobs.
+
+Consumers keep the seq of the last change they applied (the cursor) and ask for the changes
+after it, instead of re-reading the tickets table. To start from scratch, read the current
+cursor first (changes_since(None)), then take a ticket export, then follow the feed from that
+cursor: changes made in between are applied twice, which is harmless since each change carries
+the resulting status.
+
+Sequence numbers are allocated when a change is inserted, but transactions don't always commit
+in that order, so a change with a lower seq can become visible after a higher one. The feed only
+goes as far as no change still being written can come before (see metroapp/commit_order.py), so
+it never skips one however long a transaction takes to commit.
+"""
+from django.conf import settings
+
+from metroapp.commit_order import committed_position, committed_rows
+from .models import TicketChange
+
+FIELDS = ["seq", "ticket_id", "previous_status", "status", "changed_at"]
+
+
+def changes_since(cursor, limit=None):
+    """
+    Returns (rows, next_cursor, more): up to limit changes after cursor as tuples in FIELDS
+    order, the cursor to ask for next, and whether more changes may already be waiting.
+    A cursor of None returns no rows, and the current position of the feed.
+    """
+    if cursor is None:
+        return [], committed_position(TicketChange.objects.all(), "seq"), False
+
+    limit = min(
+        limit or settings.CHANGE_FEED_BATCH_SIZE, settings.CHANGE_FEED_BATCH_SIZE
+    )
+    rows = committed_rows(TicketChange.objects.all(), "seq", FIELDS, cursor, limit + 1)
+    more = len(rows) > limit
+    rows = rows[:limit]
+
+    next_cursor = rows[-1][0] if rows else cursor
+    return rows, next_cursor, more
@@ -0,0 +1,383 @@
+"""
+Contraction hierarchy (CH) routing for large networks.
+
+Preprocessing ranks every station by "importance" and contracts them one at a time, from the
+least to the most important. When a station is removed, shortcut edges are added between its
+remaining neighbours wherever the path through it was the only shortest path. A query then only
+needs a bidirectional Dijkstra that moves *upwards* in rank from both ends, which settles a tiny
+fraction of the stations a plain Dijkstra would. Shortcuts remember the station they bypass, so
+the result is unpacked back into the original Connection ids.
+
+The hierarchy is built per network version and per weight ("distance" or "cost"). The
+build_contraction_hierarchy management command (or the routing daemon) builds it offline and
+stores it under settings.ROUTING_DATA_DIR; processes only ever load that file, and route with
+Dijkstra until it exists.
+
+Disabling or re-enabling a line doesn't throw the hierarchy away. Until the new one is built,
+the old one keeps answering queries whose route avoids the newly disabled lines (removing edges
+can't make any other path shorter), everything else falls back to Dijkstra.
+"""
+import heapq
+import logging
+import os
+import pickle
+import time
+from collections import defaultdict
+from pathlib import Path
+
+from django.conf import settings
+
+from .network import WEIGHTS, get_graph
+from .pathfinder import dijkstra
+
+logger = logging.getLogger(__name__)
+
+INFINITY = float("inf")
+
+# The witness search checks whether a shortcut is really needed. Stopping it early only adds
+# shortcuts that are not strictly necessary, so this trades preprocessing time for query time.
+WITNESS_SETTLE_LIMIT = 60
+
+# Per-process cache of the loaded hierarchies: {weight: ContractionHierarchy}
+_hierarchies = {}
+# {weight: (network version, monotonic time)} of the files found missing, and when to look again
+_missing = {}
+
+MISSING_RETRY_SECONDS = 10
+
+
+def _key(u, v):
+    """Edges are undirected, so they are stored under the (smaller id, larger id) pair"""
+    return (u, v) if u < v else (v, u)
+
+
+class ContractionHierarchy:
+    """
+    The preprocessed hierarchy for one network version and weight.
+
+    rank: {station_id: contraction order}, higher means more important
+    up: {station_id: [(neighbour_id, weight), ...]} edges to more important stations only
+    arcs: {(u, v): (weight, connection_id, middle)} for every edge in the hierarchy. Original
+        connections have middle=None, shortcuts have connection_id=None and store the
+        station they bypass in middle.
+    topology_version, disabled_lines: the state of the graph it was built from
+    """
+
+    def __init__(
+        self,
+        version,
+        weight,
+        rank,
+        up,
+        arcs,
+        topology_version=None,
+        disabled_lines=frozenset(),
+    ):
+        self.version = version
+        self.weight = weight
+        self.rank = rank
+        self.up = up
+        self.arcs = arcs
+        self.topology_version = topology_version
+        self.disabled_lines = disabled_lines
+
+    @classmethod
+    def build(cls, graph, weight="distance"):
+        """Contracts every station of a NetworkGraph, returns the resulting hierarchy"""
+        if weight not in WEIGHTS:
+            raise ValueError(f"Unknown weight {weight}, expected one of {WEIGHTS}")
+
+        # Only the lightest connection between two stations can be part of a shortest path
+        arcs = {}
+        for edge in graph.open_edges():
+            if edge.start == edge.end:
+                continue
+            key = _key(edge.start, edge.end)
+            edge_weight = float(getattr(edge, weight))
+            if key not in arcs or edge_weight < arcs[key][0]:
+                arcs[key] = (edge_weight, edge.id, None)
+
+        # The graph that is left to contract: {station_id: {neighbour_id: weight}}
+        remaining = defaultdict(dict)
+        for (u, v), (edge_weight, _, _) in arcs.items():
+            remaining[u][v] = edge_weight
+            remaining[v][u] = edge_weight
+
+        contracted_neighbours = defaultdict(int)
+        rank = {}
+        up = {}
+
+        def shortcuts_for(node):
+            """Shortcuts (u, w, weight) needed if node was contracted now"""
+            neighbours = list(remaining[node].items())
+            shortcuts = []
+
+            for i, (u, weight_u) in enumerate(neighbours[:-1]):
+                targets = neighbours[i + 1 :]
+                limit = weight_u + max(weight_w for _, weight_w in targets)
+                witness = _witness_search(remaining, u, node, limit)
+
+                for w, weight_w in targets:
+                    via = weight_u + weight_w
+                    if witness.get(w, INFINITY) > via:
+                        shortcuts.append((u, w, via))
+
+            return shortcuts
+
+        def priority(node, shortcuts):
+            """Edge difference plus the number of contracted neighbours (keeps contraction uniform)"""
+            return len(shortcuts) - len(remaining[node]) + contracted_neighbours[node]
+
+        heap = [(priority(node, shortcuts_for(node)), node) for node in list(remaining)]
+        heapq.heapify(heap)
+
+        while heap:
+            _, node = heapq.heappop(heap)
+
+            # Lazy update: priorities of the neighbours of contracted stations go stale, so
+            # the popped station is re-evaluated and pushed back if it is no longer the minimum
+            shortcuts = shortcuts_for(node)
+            current = priority(node, shortcuts)
+            if heap and current > heap[0][0]:
+                heapq.heappush(heap, (current, node))
+                continue
+
+            rank[node] = len(rank)
+            neighbours = remaining.pop(node)
+            up[node] = list(neighbours.items())
+
+            for u in neighbours:
+                del remaining[u][node]
+                contracted_neighbours[u] += 1
+
+            for u, w, via in shortcuts:
+                if via < remaining[u].get(w, INFINITY):
+                    remaining[u][w] = via
+                    remaining[w][u] = via
+                    arcs[_key(u, w)] = (via, None, node)
+
+        return cls(
+            graph.version,
+            weight,
+            rank,
+            up,
+            arcs,
+            graph.topology_version,
+            graph.disabled_lines,
+        )
+
+    def covers(self, graph):
+        """
+        True if the hierarchy was built from the same connections as graph, with a subset of
+        its disabled lines. Its routes are then still optimal for graph whenever they avoid
+        the lines disabled since.
+        """
+        return (
+            self.topology_version == graph.topology_version
+            and self.disabled_lines <= graph.disabled_lines
+        )
+
+    def query(self, start_id, end_id):
+        """
+        Bidirectional upward search. Returns (total_weight, connection_ids) along the shortest
+        path, raises ValueError if no path exists.
+        """
+        if start_id == end_id:
+            return 0.0, []
+
+        # Index 0 is the search from the start, index 1 the search from the end
+        dist = ({start_id: 0.0}, {end_id: 0.0})
+        parent = ({start_id: None}, {end_id: None})
+        heaps = ([(0.0, start_id)], [(0.0, end_id)])
+        best, meeting = INFINITY, None
+
+        while True:
+            # A direction is finished once its smallest key can't improve the best path
+            open_directions = [d for d in (0, 1) if heaps[d] and heaps[d][0][0] < best]
+            if not open_directions:
+                break
+            side = min(open_directions, key=lambda d: heaps[d][0][0])
+
+            total_weight, node = heapq.heappop(heaps[side])
+            if total_weight > dist[side][node]:
+                continue
+
+            other = dist[1 - side].get(node)
+            if other is not None and total_weight + other < best:
+                best, meeting = total_weight + other, node
+
+            for neighbour, edge_weight in self.up.get(node, ()):
+                candidate = total_weight + edge_weight
+                if candidate < dist[side].get(neighbour, INFINITY):
+                    dist[side][neighbour] = candidate
+                    parent[side][neighbour] = node
+                    heapq.heappush(heaps[side], (candidate, neighbour))
+
+        if meeting is None:
+            raise ValueError(f"No route possible from {start_id} to {end_id}")
+
+        # Stations from the start up to the meeting station, then down to the end
+        forward = []
+        node = meeting
+        while node is not None:
+            forward.append(node)
+            node = parent[0][node]
+        forward.reverse()
+
+        node = parent[1][meeting]
+        while node is not None:
+            forward.append(node)
+            node = parent[1][node]
+
+        connection_ids = []
+        for u, v in zip(forward, forward[1:]):
+            connection_ids.extend(self.unpack(u, v))
+
+        return best, connection_ids
+
+    def unpack(self, u, v):
+        """Expands the hierarchy edge u -> v into the original connection ids, in order"""
+        connection_ids = []
+        stack = [(u, v)]
+
+        while stack:
+            a, b = stack.pop()
+            _, connection_id, middle = self.arcs[_key(a, b)]
+            if middle is None:
+                connection_ids.append(connection_id)
+            else:
+                # Pushed in reverse so a -> middle is expanded before middle -> b
+                stack.append((middle, b))
+                stack.append((a, middle))
+
+        return connection_ids
+
+    def save(self, path):
+        """Writes the hierarchy to disk, via a temporary file so readers never see half a file"""
+        path = Path(path)
+        path.parent.mkdir(parents=True, exist_ok=True)
+        temporary = path.with_suffix(".tmp")
+
+        with open(temporary, "wb") as f:
+            pickle.dump(self, f, protocol=pickle.HIGHEST_PROTOCOL)
+        os.replace(temporary, path)
+
+    @staticmethod
+    def load(path):
+        with open(path, "rb") as f:
+            return pickle.load(f)
+
+
+def _witness_search(remaining, source, excluded, limit):
+    """
+    Dijkstra from source in the remaining graph that ignores the station being contracted.
+    Stops after WITNESS_SETTLE_LIMIT stations or once distances exceed limit.
+    Returns {station_id: distance} for everything reached.
+    """
+    dist = {source: 0.0}
+    heap = [(0.0, source)]
+    settled = 0
+
+    while heap and settled < WITNESS_SETTLE_LIMIT:
+        total_weight, node = heapq.heappop(heap)
+        if total_weight > dist[node]:
+            continue
+        if total_weight > limit:
+            break
+        settled += 1
+
+        for neighbour, edge_weight in remaining[node].items():
+            if neighbour == excluded:
+                continue
+            candidate = total_weight + edge_weight
+            if candidate < dist.get(neighbour, INFINITY):
+                dist[neighbour] = candidate
+                heapq.heappush(heap, (candidate, neighbour))
+
+    return dist
+
+
+def hierarchy_path(version, weight):
+    """Where the offline preprocessing step stores the hierarchy for a version and weight"""
+    return Path(settings.ROUTING_DATA_DIR) / f"ch-{weight}-v{version}.pickle"
+
+
+def get_hierarchy(weight="distance", graph=None):
+    """
+    Returns the hierarchy for the current network version (or for the given graph), or None.
+    Uses this process' copy if it is still current, otherwise loads the file written by
+    build_contraction_hierarchy (or the routing daemon). If there is none yet, the previous copy
+    is kept when it was built from the same connections (only line statuses changed, see
+    query_route); otherwise there is no hierarchy and query_route uses Dijkstra. Building one
+    takes minutes on a large network, so it never happens while answering a request. A missing
+    file is looked for again at most every MISSING_RETRY_SECONDS.
+    """
+    graph = graph or get_graph()
+    hierarchy = _hierarchies.get(weight)
+    if hierarchy is not None and hierarchy.version == graph.version:
+        return hierarchy
+
+    missing = _missing.get(weight)
+    if missing and missing[0] == graph.version and time.monotonic() < missing[1]:
+        return hierarchy if hierarchy and hierarchy.covers(graph) else None
+
+    path = hierarchy_path(graph.version, weight)
+    try:
+        hierarchy = ContractionHierarchy.load(path)
+    except (OSError, pickle.UnpicklingError, EOFError):
+        _missing[weight] = (graph.version, time.monotonic() + MISSING_RETRY_SECONDS)
+        if hierarchy is None or not hierarchy.covers(graph):
+            logger.warning("No preprocessed hierarchy at %s, using Dijkstra", path)
+            return None
+        return hierarchy
+
+    _missing.pop(weight, None)
+    _hierarchies[weight] = hierarchy
+    return hierarchy
+
+
+def build_hierarchies(graph, weights=WEIGHTS, force=False):
+    """
+    Builds and saves the hierarchies of graph's version that don't exist yet (all of them with
+    force), and deletes the files of older versions. Yields (weight, path, hierarchy or None if
+    it was up to date, seconds taken).
+    """
+    for weight in weights:
+        path = hierarchy_path(graph.version, weight)
+        if path.exists() and not force:
+            _missing.pop(weight, None)
+            yield weight, path, None, 0.0
+            continue
+
+        started = time.perf_counter()
+        hierarchy = ContractionHierarchy.build(graph, weight)
+        hierarchy.save(path)
+        elapsed = time.perf_counter() - started
+        # get_hierarchy may have found it missing while it was built, it can load it right away
+        _missing.pop(weight, None)
+
+        # Files for older versions can never be used again
+        for stale in path.parent.glob(f"ch-{weight}-v*.pickle"):
+            if stale != path:
+                stale.unlink(missing_ok=True)
+
+        yield weight, path, hierarchy, elapsed
+
+
+def query_route(graph, start_id, end_id, weight="distance"):
+    """
+    Connection ids of the shortest route between two station ids in graph, minimising the given
+    weight. Raises ValueError if the stations are not connected.
+    """
+    hierarchy = get_hierarchy(weight, graph)
+
+    if hierarchy is not None and hierarchy.covers(graph):
+        # Raises ValueError if there is no route, the graph can only have fewer connections
+        _, connection_ids = hierarchy.query(start_id, end_id)
+        if not any(
+            graph.edges[cid].line_id in graph.disabled_lines for cid in connection_ids
+        ):
+            return connection_ids
+
+    _, connection_ids = dijkstra(graph, start_id, end_id, weight)
+    return connection_ids
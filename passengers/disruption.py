@@ -0,0 +1,155 @@
+"""
+Impact of disabling lines on the tickets that were already sold.
+
+Tickets are grouped by (start, destination) in the database, so every distinct pair is only
+routed once, no matter how many tickets share it. Pairs are then grouped by start station: one
+shortest path tree per start station answers all of its destinations at once, first on the
+network with the lines enabled (to find the pairs whose route uses them) and then, only for
+start stations with affected pairs, on the network with the lines disabled.
+
+The comparison doesn't depend on whether the lines are currently enabled, so the report can be
+run before disabling them (what if) or right after (what happened).
+"""
+from collections import defaultdict
+
+from django.db.models import Count, Q
+
+from .models import Station, Ticket
+from .network import get_graph
+from .pathfinder import shortest_path_tree, tree_path
+
+# Tickets that are still going to be used. The scanner stores "In Use" capitalised, hence iexact
+OPEN_TICKETS = Q(status__iexact="active") | Q(status__iexact="in use")
+
+PAIR_HEADER = [
+    "start_station_id",
+    "start_station",
+    "destination_id",
+    "destination",
+    "tickets",
+    "current_fare",
+    "new_fare",
+    "routable",
+]
+TICKET_HEADER = [
+    "ticket_id",
+    "passenger",
+    "start_station",
+    "destination",
+    "status",
+    "cost",
+    "new_fare",
+    "routable",
+]
+
+
+def compare_graphs(line_ids):
+    """Returns the (baseline, proposed) graphs: the network with the lines enabled/disabled"""
+    graph = get_graph()
+    lines = frozenset(line_ids)
+
+    baseline = graph.with_mask(graph.version, graph.disabled_lines - lines)
+    proposed = graph.with_mask(graph.version, graph.disabled_lines | lines)
+    return baseline, proposed
+
+
+def affected_pairs(line_ids):
+    """
+    Returns {(start_id, destination_id): (ticket_count, current_fare, new_fare)} for every
+    pair of open tickets whose route uses one of the lines. new_fare is None if the pair can't
+    be routed without them.
+    """
+    lines = frozenset(line_ids)
+    baseline, proposed = compare_graphs(lines)
+
+    pairs = (
+        Ticket.objects.filter(OPEN_TICKETS)
+        .values("start_station_id", "destination_id")
+        .annotate(tickets=Count("id"))
+        .values_list("start_station_id", "destination_id", "tickets")
+        .order_by()
+    )
+    by_start = defaultdict(list)
+    for start_id, destination_id, tickets in pairs:
+        by_start[start_id].append((destination_id, tickets))
+
+    impact = {}
+    for start_id, destinations in by_start.items():
+        _, parent = shortest_path_tree(baseline, start_id)
+
+        affected = []
+        for destination_id, tickets in destinations:
+            path = tree_path(parent, destination_id)
+            if path and any(baseline.edges[cid].line_id in lines for cid in path):
+                affected.append((destination_id, tickets, baseline.route(path).cost))
+
+        # Nothing from this station uses the lines, no need to route it again
+        if not affected:
+            continue
+
+        _, parent = shortest_path_tree(proposed, start_id)
+        for destination_id, tickets, current_fare in affected:
+            path = tree_path(parent, destination_id)
+            new_fare = None if path is None else proposed.route(path).cost
+            impact[(start_id, destination_id)] = (tickets, current_fare, new_fare)
+
+    return impact
+
+
+def pair_rows(line_ids):
+    """CSV rows (header first) with one row per affected (start, destination) pair"""
+    impact = affected_pairs(line_ids)
+    names = dict(Station.objects.values_list("id", "name"))
+
+    yield PAIR_HEADER
+    for (start_id, destination_id), (tickets, current, new) in sorted(impact.items()):
+        yield [
+            start_id,
+            names.get(start_id),
+            destination_id,
+            names.get(destination_id),
+            tickets,
+            current,
+            "" if new is None else new,
+            "no" if new is None else "yes",
+        ]
+
+
+def ticket_rows(line_ids, chunk_size=5000):
+    """CSV rows (header first) with one row per affected ticket, streamed from the database"""
+    impact = affected_pairs(line_ids)
+    names = dict(Station.objects.values_list("id", "name"))
+
+    yield TICKET_HEADER
+    if not impact:
+        return
+
+    tickets = (
+        Ticket.objects.filter(OPEN_TICKETS)
+        .values_list(
+            "id",
+            "passenger__user__username",
+            "start_station_id",
+            "destination_id",
+            "status",
+            "cost",
+        )
+        .order_by("id")
+        .iterator(chunk_size=chunk_size)
+    )
+    for ticket_id, username, start_id, destination_id, status, cost in tickets:
+        pair = impact.get((start_id, destination_id))
+        if pair is None:
+            continue
+
+        new = pair[2]
+        yield [
+            ticket_id,
+            username,
+            names.get(start_id),
+            names.get(destination_id),
+            status,
+            cost,
+            "" if new is None else new,
+            "no" if new is None else "yes",
+        ]
@@ -0,0 +1,400 @@
+"""
+End-to-end load testing harness, run with the loadtest management command.
+
+A throwaway test database (like the test runner's) is created and seeded with a network of
+stations and lines and with passengers that already have a balance. The site is then served by
+an in-process threaded WSGI server with the project's settings (so its deployment options, ex.
+ROUTING_SOCKET, REDIS_URL or the load shedding budgets, can be compared through the environment),
+and driven by virtual users over real HTTP, each in its own thread with its own session:
+
+    signup (a share of the users, the others log in with a seeded account) -> login
+    then for each journey: add money -> purchase -> OTP confirmation -> dashboard -> incoming
+        -> outgoing
+
+OTP codes are read from the locmem mail backend the harness switches to, the same way tests read
+sent emails. Every request is timed, and the report has the throughput and the p50/p95/p99
+latency of each endpoint.
+
+With a target URL (loadtest --url) an already running deployment is driven instead, nothing is
+seeded: every virtual user signs up, and the stations are read from the JSON API. Its emails
+never reach this process, so OTP codes can only be read from the target's database
+(otp_from_database, when this process is configured with it, ex. a staging deployment).
+Without it the journeys stop at the confirmation page: purchases are measured, but not the
+payment and the scans.
+
+Use Postgres (the production database) for meaningful numbers: SQLite serializes writes and
+fails some of the concurrent ones with "database table is locked".
+"""
+import random
+import re
+import statistics
+import threading
+import time
+import uuid
+from collections import defaultdict
+from decimal import Decimal
+
+import requests
+from django.contrib.auth.hashers import make_password
+from django.contrib.auth.models import User
+from django.core import mail
+from django.core.servers.basehttp import ThreadedWSGIServer, WSGIRequestHandler
+from django.core.wsgi import get_wsgi_application
+
+from .models import OTP, Connection, Line, Passenger, Station
+from .network import bump_network_version
+from .otp_generation import OTP_LENGTH
+
+PASSWORD = "load-test-password"
+
+# Seeded passengers never run out of money, the signed up ones add some on every journey
+SEEDED_BALANCE = Decimal("1000000")
+TOP_UP = "100"
+
+OTP_PATTERN = re.compile(rf"\b\d{{{OTP_LENGTH}}}\b")
+TICKET_ID_PATTERN = re.compile(r"/confirmation/(\d+)")
+
+REPORT_HEADER = [
+    "endpoint",
+    "requests",
+    "failed",
+    "req/s",
+    "p50 ms",
+    "p95 ms",
+    "p99 ms",
+]
+
+
+def seed_network(stations, line_length=10):
+    """
+    Stations S0..Sn-1 on lines of line_length consecutive stations, each line sharing its first
+    station with the previous one, plus an express line stopping at every line_length-th station.
+    """
+    created = Station.objects.bulk_create(
+        Station(name=f"Load test station {i}") for i in range(stations)
+    )
+    lines = {}
+    connections = []
+
+    def connect(line_name, start, end, hops):
+        line = lines.get(line_name)
+        if line is None:
+            line = lines[line_name] = Line.objects.create(name=line_name)
+        connections.append(
+            Connection(
+                line=line,
+                start_station=start,
+                destination_station=end,
+                distance=1.5 * hops,
+                travel_time=2 * hops,
+                cost=Decimal("2.50") * hops,
+            )
+        )
+
+    for i in range(1, stations):
+        connect(
+            f"Load test line {(i - 1) // line_length}", created[i - 1], created[i], 1
+        )
+    express = created[::line_length]
+    for start, end in zip(express, express[1:]):
+        connect("Load test express", start, end, line_length // 2)
+
+    Connection.objects.bulk_create(connections)
+    bump_network_version(stations=True)
+    return [station.id for station in created]
+
+
+def seed_passengers(count):
+    """Passengers load0..loadN-1 with a large balance, all sharing one password hash"""
+    existing = set(
+        User.objects.filter(username__startswith="load").values_list(
+            "username", flat=True
+        )
+    )
+    password = make_password(PASSWORD)
+    users = User.objects.bulk_create(
+        User(username=f"load{i}", email=f"load{i}@example.com", password=password)
+        for i in range(count)
+        if f"load{i}" not in existing
+    )
+    Passenger.objects.bulk_create(
+        Passenger(user=user, bank_balance=SEEDED_BALANCE) for user in users
+    )
+    return [f"load{i}" for i in range(count)]
+
+
+class QuietRequestHandler(WSGIRequestHandler):
+    def log_message(self, format, *args):
+        pass
+
+
+class Server:
+    """The site served on 127.0.0.1 by a background thread, one thread per request"""
+
+    def __init__(self, port=0):
+        self.httpd = ThreadedWSGIServer(
+            ("127.0.0.1", port), QuietRequestHandler, allow_reuse_address=True
+        )
+        self.httpd.set_app(get_wsgi_application())
+        self.url = f"http://127.0.0.1:{self.httpd.server_port}"
+        self.thread = threading.Thread(target=self.httpd.serve_forever, daemon=True)
+
+    def __enter__(self):
+        self.thread.start()
+        return self
+
+    def __exit__(self, *exc_info):
+        self.httpd.shutdown()
+        self.httpd.server_close()
+
+
+class Recorder:
+    """Latencies (seconds) of every request, and the failed ones, per endpoint"""
+
+    def __init__(self):
+        self.latencies = defaultdict(list)
+        self.failures = defaultdict(int)
+        self.lock = threading.Lock()
+
+    def add(self, endpoint, seconds, ok):
+        with self.lock:
+            self.latencies[endpoint].append(seconds)
+            if not ok:
+                self.failures[endpoint] += 1
+
+    def rows(self, elapsed):
+        """Report rows (header first), endpoints in the order they were first hit"""
+        yield REPORT_HEADER
+        total = 0
+        for endpoint, latencies in self.latencies.items():
+            total += len(latencies)
+            yield [endpoint, len(latencies), self.failures[endpoint]] + summary(
+                latencies, elapsed
+            )
+        every = [
+            seconds for latencies in self.latencies.values() for seconds in latencies
+        ]
+        if every:
+            yield ["all", total, sum(self.failures.values())] + summary(every, elapsed)
+
+
+def summary(latencies, elapsed):
+    """[requests per second, p50, p95, p99 in milliseconds]"""
+    if len(latencies) > 1:
+        cuts = statistics.quantiles(latencies, n=100, method="inclusive")
+        p50, p95, p99 = cuts[49], cuts[94], cuts[98]
+    else:
+        p50 = p95 = p99 = latencies[0]
+    return [
+        round(len(latencies) / elapsed, 1),
+        round(p50 * 1000, 1),
+        round(p95 * 1000, 1),
+        round(p99 * 1000, 1),
+    ]
+
+
+class JourneyFailed(Exception):
+    pass
+
+
+def otp_from_outbox(username, email):
+    """The last code emailed to the user, sent by the in-process server's threads"""
+    for message in reversed(mail.outbox):
+        if message.to == [email]:
+            return OTP_PATTERN.search(message.subject).group(0)
+    return None
+
+
+def otp_from_database(username, email):
+    """The last code created for the user, in the configured database"""
+    return (
+        OTP.objects.filter(user__user__username=username)
+        .order_by("-id")
+        .values_list("code", flat=True)
+        .first()
+    )
+
+
+class VirtualUser:
+    """
+    One passenger's session, requests are made without following redirects. read_otp(username,
+    email) returns the confirmation code, None (no way to read it) ends the journeys at the
+    confirmation page. Without stations, they are read from the API once logged in.
+    """
+
+    def __init__(self, url, recorder, stations, username, signup, read_otp):
+        self.url = url
+        self.recorder = recorder
+        self.stations = stations
+        self.username = username
+        self.email = f"{username}@example.com"
+        self.signup = signup
+        self.read_otp = read_otp
+        self.session = requests.Session()
+
+    def request(self, endpoint, method, path, data=None, expect=200, text=None):
+        if data is not None:
+            data = {
+                **data,
+                "csrfmiddlewaretoken": self.session.cookies.get("csrftoken"),
+            }
+
+        started = time.perf_counter()
+        try:
+            response = self.session.request(
+                method, self.url + path, data=data, allow_redirects=False
+            )
+        except requests.RequestException:
+            self.recorder.add(endpoint, time.perf_counter() - started, False)
+            raise JourneyFailed(endpoint)
+
+        ok = response.status_code == expect and (text is None or text in response.text)
+        self.recorder.add(endpoint, time.perf_counter() - started, ok)
+        if not ok:
+            raise JourneyFailed(endpoint)
+        return response
+
+    def start(self):
+        if self.signup:
+            self.request("GET signup", "GET", "/passengers/signup/")
+            self.request(
+                "POST signup",
+                "POST",
+                "/passengers/signup/",
+                {
+                    "username": self.username,
+                    "first_name": "Load",
+                    "last_name": "Test",
+                    "email": self.email,
+                    "password": PASSWORD,
+                },
+                expect=302,
+            )
+
+        self.request("GET login", "GET", "/passengers/login/")
+        self.request(
+            "POST login",
+            "POST",
+            "/passengers/login/",
+            {"username": self.username, "password": PASSWORD},
+            expect=302,
+        )
+
+        if self.stations is None:
+            response = self.request("GET stations", "GET", "/api/v1/stations?fields=id")
+            self.stations = [station["id"] for station in response.json()["stations"]]
+
+    def journey(self):
+        self.request("GET add money", "GET", "/passengers/finances/")
+        self.request(
+            "POST add money",
+            "POST",
+            "/passengers/finances/",
+            {"amount": TOP_UP},
+            expect=302,
+        )
+
+        start, destination = random.sample(self.stations, 2)
+        self.request("GET purchase", "GET", "/passengers/dashboard/purchase")
+        response = self.request(
+            "POST purchase",
+            "POST",
+            "/passengers/dashboard/purchase",
+            {"start_station": start, "destination_station": destination},
+            expect=302,
+        )
+        ticket_id = TICKET_ID_PATTERN.search(response.headers["Location"]).group(1)
+
+        confirmation = f"/passengers/dashboard/purchase/confirmation/{ticket_id}"
+        self.request("GET confirmation", "GET", confirmation)
+        if self.read_otp is None:
+            self.request("GET dashboard", "GET", "/passengers/dashboard/")
+            return
+
+        self.request(
+            "POST confirmation",
+            "POST",
+            confirmation,
+            {"otp": self.latest_otp()},
+            expect=302,
+        )
+        self.request("GET dashboard", "GET", "/passengers/dashboard/")
+
+        self.request(
+            "POST incoming",
+            "POST",
+            "/scanner/scanner/incoming",
+            {"ticket_id": ticket_id},
+            text="Scanned and updated successfully",
+        )
+        self.request(
+            "POST outgoing",
+            "POST",
+            "/scanner/scanner/outgoing",
+            {"ticket_id": ticket_id},
+            text="Journey completed",
+        )
+
+    def latest_otp(self):
+        # Created by the request for the confirmation page
+        code = self.read_otp(self.username, self.email)
+        if code is None:
+            raise JourneyFailed("no OTP")
+        return code
+
+    def run(self, journeys, deadline):
+        """Returns the number of journeys completed"""
+        completed = 0
+        try:
+            self.start()
+            while completed < journeys and time.monotonic() < deadline:
+                try:
+                    self.journey()
+                    completed += 1
+                except JourneyFailed:
+                    # Already recorded, the next journey starts over
+                    journeys -= 1
+        except JourneyFailed:
+            pass
+        return completed
+
+
+def run_load(
+    url,
+    stations,
+    usernames,
+    concurrency,
+    journeys,
+    duration=None,
+    signup_share=0.2,
+    read_otp=otp_from_outbox,
+):
+    """
+    Runs concurrency virtual users for journeys journeys each (or until duration seconds have
+    passed). Returns (recorder, elapsed seconds, completed journeys). See VirtualUser for
+    stations=None and read_otp.
+    """
+    recorder = Recorder()
+    run_id = uuid.uuid4().hex[:8]
+    deadline = time.monotonic() + duration if duration else float("inf")
+
+    users = []
+    for i in range(concurrency):
+        signup = i < round(concurrency * signup_share)
+        # Unique per run, a kept database (--keepdb) already has the previous run's users
+        username = f"signup{run_id}-{i}" if signup else usernames[i % len(usernames)]
+        users.append(VirtualUser(url, recorder, stations, username, signup, read_otp))
+
+    completed = [0] * concurrency
+
+    def run(i):
+        completed[i] = users[i].run(journeys, deadline)
+
+    threads = [threading.Thread(target=run, args=(i,)) for i in range(concurrency)]
+    started = time.perf_counter()
+    for thread in threads:
+        thread.start()
+    for thread in threads:
+        thread.join()
+
+    return recorder, time.perf_counter() - started, sum(completed)
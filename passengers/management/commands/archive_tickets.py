@@ -0,0 +1,38 @@
+"""
+Moves expired tickets to the archive table in short batches (see passengers.archive). Meant to
+run periodically (ex. nightly from cron), it can be interrupted and resumed at any point.
+"""
+
+import time
+
+from django.core.management.base import BaseCommand
+
+from passengers.archive import archive_expired
+
+
+class Command(BaseCommand):
+    help = "Moves tickets expired for a while to the archive table"
+
+    def add_arguments(self, parser):
+        parser.add_argument(
+            "--days",
+            type=int,
+            default=None,
+            help="Archive tickets expired more than this many days ago "
+            "(default: settings.TICKET_ARCHIVE_AFTER_DAYS)",
+        )
+        parser.add_argument("--batch-size", type=int, default=1000)
+        parser.add_argument(
+            "--max-batches", type=int, default=None, help="Stop after this many batches"
+        )
+
+    def handle(self, *args, **options):
+        started = time.perf_counter()
+        moved = archive_expired(
+            options["days"], options["batch_size"], options["max_batches"]
+        )
+        self.stdout.write(
+            self.style.SUCCESS(
+                f"Archived {moved} tickets in {time.perf_counter() - started:.2f}s"
+            )
+        )
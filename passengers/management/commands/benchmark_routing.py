@@ -0,0 +1,100 @@
+"""
+Benchmarks the contraction hierarchy against the plain Dijkstra in pathfinder on a generated
+network, and checks that both return routes of the same length.
+
+The network is generated in memory (nothing is written to the database): stations are laid
+out on a grid, every row and column is a line, and a few express lines skip stations.
+"""
+import math
+import random
+import time
+from decimal import Decimal
+
+from django.core.management.base import BaseCommand, CommandError
+
+from passengers.contraction_hierarchy import ContractionHierarchy
+from passengers.network import WEIGHTS, Edge, NetworkGraph
+from passengers.pathfinder import dijkstra
+
+
+def generate_network(stations, seed=0):
+    """Returns the edges of a grid network with roughly the given number of stations"""
+    rng = random.Random(seed)
+    side = math.ceil(math.sqrt(stations))
+    edges = []
+
+    def connect(line_id, u, v, hops=1):
+        distance = round(rng.uniform(0.5, 4.0) * hops, 2)
+        cost = Decimal(5) + Decimal(str(round(distance * 2, 2)))
+        edges.append(
+            Edge(len(edges) + 1, line_id, u, v, distance, cost, math.ceil(distance * 2))
+        )
+
+    # Rows and columns, station ids are 1..side*side
+    for i in range(side):
+        for j in range(side - 1):
+            connect(i + 1, i * side + j + 1, i * side + j + 2)
+            connect(side + i + 1, j * side + i + 1, (j + 1) * side + i + 1)
+
+    # Express lines along every 10th row, stopping at every 5th station
+    for i in range(0, side, 10):
+        for j in range(0, side - 5, 5):
+            connect(2 * side + i + 1, i * side + j + 1, i * side + j + 6, hops=4)
+
+    return edges
+
+
+class Command(BaseCommand):
+    help = "Benchmarks contraction hierarchy queries against Dijkstra on a generated network"
+
+    def add_arguments(self, parser):
+        parser.add_argument("--stations", type=int, default=10000)
+        parser.add_argument("--queries", type=int, default=200)
+        parser.add_argument("--weight", choices=WEIGHTS, default="distance")
+        parser.add_argument("--seed", type=int, default=0)
+
+    def handle(self, *args, **options):
+        rng = random.Random(options["seed"])
+        weight = options["weight"]
+        graph = NetworkGraph(0, generate_network(options["stations"], options["seed"]))
+        stations = list(graph.adjacency)
+        self.stdout.write(
+            f"Generated {len(stations)} stations and {len(graph.edges)} connections"
+        )
+
+        started = time.perf_counter()
+        hierarchy = ContractionHierarchy.build(graph, weight)
+        self.stdout.write(f"Preprocessing: {time.perf_counter() - started:.2f}s")
+
+        pairs = [
+            (rng.choice(stations), rng.choice(stations))
+            for _ in range(options["queries"])
+        ]
+
+        started = time.perf_counter()
+        expected = [dijkstra(graph, u, v, weight) for u, v in pairs]
+        dijkstra_time = time.perf_counter() - started
+
+        started = time.perf_counter()
+        results = [hierarchy.query(u, v) for u, v in pairs]
+        hierarchy_time = time.perf_counter() - started
+
+        for (u, v), (want, _), (got, connection_ids) in zip(pairs, expected, results):
+            route_weight = sum(
+                float(getattr(graph.edges[cid], weight)) for cid in connection_ids
+            )
+            if not math.isclose(want, got) or not math.isclose(want, route_weight):
+                raise CommandError(
+                    f"Mismatch for {u} -> {v}: dijkstra {want}, hierarchy {got}, "
+                    f"unpacked path {route_weight}"
+                )
+
+        queries = len(pairs)
+        self.stdout.write(
+            f"Dijkstra: {dijkstra_time / queries * 1000:.3f}ms per query\n"
+            f"Contraction hierarchy: {hierarchy_time / queries * 1000:.3f}ms per query\n"
+            f"Speedup: {dijkstra_time / hierarchy_time:.1f}x"
+        )
+        self.stdout.write(
+            self.style.SUCCESS(f"All {queries} routes match the Dijkstra answers")
+        )
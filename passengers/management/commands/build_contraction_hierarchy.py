@@ -0,0 +1,46 @@
+"""
+Offline preprocessing step for routing: builds the contraction hierarchies for the current
+network version and stores them under settings.ROUTING_DATA_DIR, where the web processes load
+them from. Run it after changing the network (or from a cron job, it does nothing if the files
+for the current version already exist).
+"""
+from django.core.management.base import BaseCommand
+
+from passengers.contraction_hierarchy import build_hierarchies
+from passengers.network import WEIGHTS, get_graph
+
+
+class Command(BaseCommand):
+    help = "Builds the contraction hierarchies for the current network version"
+
+    def add_arguments(self, parser):
+        parser.add_argument(
+            "--weight",
+            choices=WEIGHTS,
+            action="append",
+            help="Weight to build the hierarchy for, can be repeated (default: all)",
+        )
+        parser.add_argument(
+            "--force",
+            action="store_true",
+            help="Rebuild even if the hierarchy for this version already exists",
+        )
+
+    def handle(self, *args, **options):
+        graph = get_graph()
+        built = build_hierarchies(
+            graph, options["weight"] or WEIGHTS, force=options["force"]
+        )
+
+        for weight, path, hierarchy, elapsed in built:
+            if hierarchy is None:
+                self.stdout.write(f"{path} is up to date")
+                continue
+
+            shortcuts = sum(1 for arc in hierarchy.arcs.values() if arc[1] is None)
+            self.stdout.write(
+                self.style.SUCCESS(
+                    f"Built {weight} hierarchy for network version {graph.version}: "
+                    f"{len(hierarchy.rank)} stations, {shortcuts} shortcuts in {elapsed:.2f}s"
+                )
+            )
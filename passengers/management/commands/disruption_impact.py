@@ -0,0 +1,40 @@
+"""
+Reports which open (active/in use) tickets and which (start, destination) pairs are affected by
+disabling the given lines, with their new fares or whether they can no longer be routed.
+The CSV is streamed to stdout, or to a file with --output.
+"""
+from django.core.management.base import BaseCommand, CommandError
+
+from passengers.disruption import pair_rows, ticket_rows
+from passengers.models import Line
+from passengers.streaming import csv_lines
+
+
+class Command(BaseCommand):
+    help = "Streams the impact of disabling lines on open tickets as CSV"
+
+    def add_arguments(self, parser):
+        parser.add_argument("line_ids", nargs="+", type=int)
+        parser.add_argument(
+            "--tickets",
+            action="store_true",
+            help="One row per affected ticket instead of one per station pair",
+        )
+        parser.add_argument("--output", help="File to write to (default: stdout)")
+
+    def handle(self, *args, **options):
+        line_ids = set(options["line_ids"])
+        missing = line_ids - set(
+            Line.objects.filter(id__in=line_ids).values_list("id", flat=True)
+        )
+        if missing:
+            raise CommandError(f"Unknown line ids: {sorted(missing)}")
+
+        rows = ticket_rows(line_ids) if options["tickets"] else pair_rows(line_ids)
+
+        if options["output"]:
+            with open(options["output"], "w", newline="") as f:
+                f.writelines(csv_lines(rows))
+        else:
+            for line in csv_lines(rows):
+                self.stdout.write(line, ending="")
@@ -0,0 +1,70 @@
+"""
+Loads stations, lines and connections in bulk, from CSV files or a GTFS-like directory (see
+passengers.network_import for the layouts). The whole import runs in one transaction: if any row
+is invalid, the errors are reported and nothing is written.
+"""
+import time
+
+from django.core.management.base import BaseCommand, CommandError
+from django.db import transaction
+
+from passengers.network_import import NetworkImporter
+
+
+class Command(BaseCommand):
+    help = "Bulk imports stations, lines and connections from CSV or GTFS-like files"
+
+    def add_arguments(self, parser):
+        parser.add_argument("--stations", help="CSV with a name column")
+        parser.add_argument("--lines", help="CSV with name and is_active columns")
+        parser.add_argument(
+            "--connections",
+            help="CSV with line, start_station, destination_station, travel_time, "
+            "distance and cost columns",
+        )
+        parser.add_argument(
+            "--gtfs",
+            help="Directory with stops.txt, routes.txt, trips.txt and stop_times.txt",
+        )
+        parser.add_argument("--chunk-size", type=int, default=5000)
+        parser.add_argument(
+            "--dry-run",
+            action="store_true",
+            help="Validate everything, then roll back",
+        )
+
+    def handle(self, *args, **options):
+        csv_files = [options["stations"], options["lines"], options["connections"]]
+        if not options["gtfs"] and not any(csv_files):
+            raise CommandError("Pass --gtfs or at least one of the CSV files")
+
+        started = time.perf_counter()
+        with transaction.atomic():
+            importer = NetworkImporter(chunk_size=options["chunk_size"])
+
+            if options["gtfs"]:
+                importer.import_gtfs(options["gtfs"])
+            if any(csv_files):
+                importer.import_csv(*csv_files)
+
+            if importer.errors:
+                for error in importer.errors:
+                    self.stderr.write(error)
+                raise CommandError(
+                    f"{importer.counts['errors']} invalid rows, nothing was imported"
+                )
+
+            if options["dry_run"]:
+                transaction.set_rollback(True)
+
+        summary = ", ".join(
+            f"{count} {name}"
+            for name, count in importer.counts.items()
+            if name != "errors"
+        )
+        prefix = "Dry run, would have imported" if options["dry_run"] else "Imported"
+        self.stdout.write(
+            self.style.SUCCESS(
+                f"{prefix} {summary or 'nothing'} in {time.perf_counter() - started:.2f}s"
+            )
+        )
@@ -0,0 +1,147 @@
+"""
+Runs the end-to-end load test (see passengers.loadtest) against a throwaway test database and
+prints the throughput and latency percentiles of every endpoint. Nothing touches the configured
+database, unless --keepdb reuses the test database of a previous run.
+
+--url drives an already running deployment instead of the in-process server. OTP codes are then
+only available with --otp-from-db, which reads them from the configured database (it has to be
+the target's), otherwise the journeys stop at the confirmation page.
+"""
+from django.core.management.base import BaseCommand, CommandError
+from django.test.utils import (
+    override_settings,
+    setup_databases,
+    setup_test_environment,
+    teardown_databases,
+    teardown_test_environment,
+)
+
+from passengers.loadtest import (
+    Server,
+    otp_from_database,
+    run_load,
+    seed_network,
+    seed_passengers,
+)
+from scanner.occupancy import writer as occupancy_writer
+from scanner.tap_log import tap_log
+
+
+class Command(BaseCommand):
+    help = "Drives the passenger and gate flows with concurrent virtual users"
+
+    def add_arguments(self, parser):
+        parser.add_argument("--concurrency", type=int, default=10)
+        parser.add_argument(
+            "--journeys", type=int, default=5, help="Journeys per virtual user"
+        )
+        parser.add_argument(
+            "--duration",
+            type=float,
+            default=None,
+            help="Run for this many seconds instead of a number of journeys",
+        )
+        parser.add_argument("--stations", type=int, default=100)
+        parser.add_argument(
+            "--users", type=int, default=50, help="Seeded passengers to log in with"
+        )
+        parser.add_argument(
+            "--signup-share",
+            type=float,
+            default=0.2,
+            help="Share of the virtual users that sign up instead of logging in",
+        )
+        parser.add_argument("--port", type=int, default=0)
+        parser.add_argument("--keepdb", action="store_true")
+        parser.add_argument(
+            "--url",
+            help="Drive this running deployment (ex. https://staging.example.com) instead "
+            "of an in-process server, every virtual user signs up",
+        )
+        parser.add_argument(
+            "--otp-from-db",
+            action="store_true",
+            help="With --url, read the OTP codes from the configured database, which must "
+            "be the target's",
+        )
+
+    def handle(self, *args, **options):
+        if options["url"]:
+            results = self.run_remote(options)
+        else:
+            if options["otp_from_db"]:
+                raise CommandError("--otp-from-db only applies to --url")
+            results = self.run_local(options)
+        self.report(options, *results)
+
+    def run_remote(self, options):
+        self.stdout.write(f"Driving {options['url']}")
+        if not options["otp_from_db"]:
+            self.stdout.write(
+                "Without --otp-from-db the journeys stop at the confirmation page"
+            )
+        return run_load(
+            options["url"].rstrip("/"),
+            None,
+            [],
+            options["concurrency"],
+            float("inf") if options["duration"] else options["journeys"],
+            options["duration"],
+            signup_share=1,
+            read_otp=otp_from_database if options["otp_from_db"] else None,
+        )
+
+    def run_local(self, options):
+        setup_test_environment()
+        old_config = setup_databases(
+            verbosity=0, interactive=False, keepdb=options["keepdb"]
+        )
+        try:
+            # The in-process server is plain HTTP
+            with override_settings(
+                ALLOWED_HOSTS=["127.0.0.1"],
+                SECURE_SSL_REDIRECT=False,
+                SESSION_COOKIE_SECURE=False,
+                CSRF_COOKIE_SECURE=False,
+            ):
+                stations = seed_network(options["stations"])
+                usernames = seed_passengers(options["users"])
+
+                with Server(options["port"]) as server:
+                    self.stdout.write(f"Serving on {server.url}")
+                    recorder, elapsed, completed = run_load(
+                        server.url,
+                        stations,
+                        usernames,
+                        options["concurrency"],
+                        float("inf") if options["duration"] else options["journeys"],
+                        options["duration"],
+                        options["signup_share"],
+                    )
+
+                # Background writers still holding taps or counters for the test database
+                tap_log.flush()
+                occupancy_writer.flush()
+        finally:
+            teardown_databases(old_config, verbosity=0, keepdb=options["keepdb"])
+            teardown_test_environment()
+
+        return recorder, elapsed, completed
+
+    def report(self, options, recorder, elapsed, completed):
+        rows = list(recorder.rows(elapsed))
+        widths = [max(len(str(row[i])) for row in rows) for i in range(len(rows[0]))]
+        for row in rows:
+            self.stdout.write(
+                "  ".join(
+                    str(value).ljust(width) if i == 0 else str(value).rjust(width)
+                    for i, (value, width) in enumerate(zip(row, widths))
+                )
+            )
+
+        self.stdout.write(
+            self.style.SUCCESS(
+                f"{completed} journeys by {options['concurrency']} virtual users "
+                f"in {elapsed:.1f}s"
+            )
+        )
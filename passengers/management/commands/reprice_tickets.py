@@ -0,0 +1,48 @@
+"""
+Reprices pending tickets after fare changes (see passengers.repricing). With --dry-run nothing is
+written and the pairs that would change are streamed as CSV, to stdout or to a file with --output.
+"""
+import time
+
+from django.core.management.base import BaseCommand
+
+from passengers.repricing import reprice_pending
+from passengers.streaming import csv_lines
+
+
+class Command(BaseCommand):
+    help = "Sets the cost of pending tickets to the current fares"
+
+    def add_arguments(self, parser):
+        parser.add_argument("--chunk-size", type=int, default=5000)
+        parser.add_argument(
+            "--dry-run",
+            action="store_true",
+            help="Report the fares that would change without writing them",
+        )
+        parser.add_argument("--output", help="File to write the report to")
+
+    def handle(self, *args, **options):
+        started = time.perf_counter()
+        report = reprice_pending(options["chunk_size"], options["dry_run"])
+        elapsed = time.perf_counter() - started
+
+        if options["output"]:
+            with open(options["output"], "w", newline="") as f:
+                f.writelines(csv_lines(report.rows()))
+        elif options["dry_run"]:
+            for line in csv_lines(report.rows()):
+                self.stdout.write(line, ending="")
+
+        verb = "Would reprice" if options["dry_run"] else "Repriced"
+        # When the report goes to stdout, the summary goes to stderr to keep the CSV clean
+        out = (
+            self.stderr if options["dry_run"] and not options["output"] else self.stdout
+        )
+        out.write(
+            self.style.SUCCESS(
+                f"{verb} {report.repriced} of {report.tickets} pending tickets "
+                f"({len(report.pairs)} station pairs) in {elapsed:.2f}s, "
+                f"{report.unroutable} left unroutable"
+            )
+        )
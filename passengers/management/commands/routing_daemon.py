@@ -0,0 +1,46 @@
+"""
+Runs the routing daemon (see passengers.routing_daemon) on settings.ROUTING_SOCKET, or --socket.
+The web workers of the host use it once ROUTING_SOCKET points them to the same path.
+"""
+import asyncio
+
+from django.conf import settings
+from django.core.management.base import BaseCommand, CommandError
+
+from passengers.network import get_graph
+from passengers.routing_daemon import RoutingServer, prepare
+
+
+class Command(BaseCommand):
+    help = "Serves the routing queries of the web workers over a Unix socket"
+
+    def add_arguments(self, parser):
+        parser.add_argument("--socket", default=settings.ROUTING_SOCKET)
+        parser.add_argument(
+            "--batch-window",
+            type=float,
+            default=settings.ROUTING_BATCH_WINDOW,
+            help="Seconds to wait for more queries before answering a batch",
+        )
+
+    def handle(self, *args, **options):
+        if not options["socket"]:
+            raise CommandError("Set ROUTING_SOCKET or pass --socket")
+
+        # Loaded before listening, so the first queries don't wait for it
+        graph = get_graph()
+        for weight, elapsed in prepare(graph):
+            if elapsed:
+                self.stdout.write(f"Built the {weight} hierarchy in {elapsed:.2f}s")
+        self.stdout.write(
+            self.style.SUCCESS(
+                f"Loaded network version {graph.version}, "
+                f"listening on {options['socket']}"
+            )
+        )
+
+        server = RoutingServer(options["socket"], options["batch_window"])
+        try:
+            asyncio.run(server.serve())
+        except KeyboardInterrupt:
+            pass
@@ -0,0 +1,36 @@
+"""
+Deletes abandoned pending tickets and expired OTPs (see passengers.sweeper). Runs once, or
+forever with --interval (as a worker). Safe to run on several nodes at once.
+"""
+import json
+import time
+
+from django.core.management.base import BaseCommand
+from django.db import close_old_connections
+
+from passengers.sweeper import sweep
+
+
+class Command(BaseCommand):
+    help = "Deletes abandoned pending tickets and expired OTPs"
+
+    def add_arguments(self, parser):
+        parser.add_argument("--batch-size", type=int, default=None)
+        parser.add_argument(
+            "--interval",
+            type=int,
+            default=None,
+            help="Keep running, sweeping every this many seconds",
+        )
+
+    def handle(self, *args, **options):
+        while True:
+            metrics = sweep(options["batch_size"])
+            # One JSON line per run, easy to collect from the logs
+            self.stdout.write(json.dumps(metrics))
+
+            if options["interval"] is None:
+                return
+            time.sleep(options["interval"])
+            # Like between requests: drops the connection if it's broken or too old
+            close_old_connections()
@@ -1,7 +1,8 @@
 """
 Handles improper login/logout
+Moves sessions logged in before passengers.backends over to the new backends
 """
-from django.contrib.auth import logout
+from django.contrib.auth import BACKEND_SESSION_KEY, logout
 from django.shortcuts import redirect
 from django.core.exceptions import ObjectDoesNotExist
 
@@ -26,3 +27,28 @@ class LogoutOnMissingPassengerMiddleware:
             logout(request)
             return redirect("passenger-login")
         return None
+
+
+# Backends recorded in the sessions logged in before passengers.backends, and their replacement.
+# Can be removed once those sessions have expired (settings.SESSION_COOKIE_AGE).
+LEGACY_BACKENDS = {
+    "django.contrib.auth.backends.ModelBackend": "passengers.backends.ModelBackend",
+    "allauth.account.auth_backends.AuthenticationBackend": "passengers.backends.AuthenticationBackend",
+}
+
+
+class LegacySessionBackendMiddleware:
+    """
+    Django only loads the user of a session whose backend is still in
+    settings.AUTHENTICATION_BACKENDS: without this, switching backends would log every
+    passenger out. Goes between the session and authentication middlewares.
+    """
+
+    def __init__(self, get_response):
+        self.get_response = get_response
+
+    def __call__(self, request):
+        backend = request.session.get(BACKEND_SESSION_KEY)
+        if backend in LEGACY_BACKENDS:
+            request.session[BACKEND_SESSION_KEY] = LEGACY_BACKENDS[backend]
+        return self.get_response(request)
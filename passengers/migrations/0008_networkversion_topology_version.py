@@ -0,0 +1,18 @@
+# Generated by Django 5.2.8 on 2026-10-19 15:12
+
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ("passengers", "0007_networkversion_alter_passenger_bank_balance_and_more"),
+    ]
+
+    operations = [
+        migrations.AddField(
+            model_name="networkversion",
+            name="topology_version",
+            field=models.PositiveBigIntegerField(default=0),
+        ),
+    ]
@@ -0,0 +1,24 @@
+# Generated by Django 5.2.8 on 2026-10-19 15:17
+
+import django.utils.timezone
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ("passengers", "0008_networkversion_topology_version"),
+    ]
+
+    operations = [
+        migrations.AddField(
+            model_name="networkversion",
+            name="stations_updated_at",
+            field=models.DateTimeField(default=django.utils.timezone.now),
+        ),
+        migrations.AddField(
+            model_name="networkversion",
+            name="stations_version",
+            field=models.PositiveBigIntegerField(default=0),
+        ),
+    ]
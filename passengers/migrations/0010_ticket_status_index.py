@@ -0,0 +1,28 @@
+# Generated by Django 5.2.8 on 2026-10-19 15:24
+
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ("passengers", "0009_networkversion_stations_version"),
+    ]
+
+    operations = [
+        migrations.AlterField(
+            model_name="ticket",
+            name="status",
+            field=models.CharField(
+                choices=[
+                    ("pending", "Pending"),
+                    ("in use", "In Use"),
+                    ("active", "Active"),
+                    ("expired", "Expired"),
+                ],
+                db_index=True,
+                default="pending",
+                max_length=20,
+            ),
+        ),
+    ]
@@ -0,0 +1,33 @@
+# Generated by Django 5.2.8 on 2026-10-19 15:30
+
+import django.db.models.deletion
+import django.utils.timezone
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ("passengers", "0011_ticket_status_changed_at"),
+    ]
+
+    operations = [
+        migrations.CreateModel(
+            name="TicketChange",
+            fields=[
+                ("seq", models.BigAutoField(primary_key=True, serialize=False)),
+                ("previous_status", models.CharField(blank=True, max_length=20)),
+                ("status", models.CharField(max_length=20)),
+                ("changed_at", models.DateTimeField(default=django.utils.timezone.now)),
+                (
+                    "ticket",
+                    models.ForeignKey(
+                        db_constraint=False,
+                        on_delete=django.db.models.deletion.DO_NOTHING,
+                        related_name="changes",
+                        to="passengers.ticket",
+                    ),
+                ),
+            ],
+        ),
+    ]
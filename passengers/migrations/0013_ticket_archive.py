@@ -0,0 +1,100 @@
+# Generated by Django 5.2.8 on 2026-10-19 15:36
+
+import django.db.models.deletion
+import django.utils.timezone
+from django.db import migrations, models
+
+TICKET_COLUMNS = "id, passenger_id, start_station_id, destination_id, cost, status, status_changed_at"
+
+# Both tables are indexed on passenger_id, the filter on the view is applied to each of them
+CREATE_HISTORY_VIEW = f"""
+CREATE VIEW passengers_tickethistory AS
+SELECT {TICKET_COLUMNS}, FALSE AS archived FROM passengers_ticket
+UNION ALL
+SELECT {TICKET_COLUMNS}, TRUE AS archived FROM passengers_archivedticket
+"""
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ("passengers", "0012_ticketchange"),
+    ]
+
+    operations = [
+        migrations.CreateModel(
+            name="TicketHistory",
+            fields=[
+                ("id", models.BigIntegerField(primary_key=True, serialize=False)),
+                ("cost", models.DecimalField(decimal_places=2, max_digits=10)),
+                (
+                    "status",
+                    models.CharField(
+                        choices=[
+                            ("pending", "Pending"),
+                            ("in use", "In Use"),
+                            ("active", "Active"),
+                            ("expired", "Expired"),
+                        ],
+                        max_length=20,
+                    ),
+                ),
+                ("status_changed_at", models.DateTimeField()),
+                ("archived", models.BooleanField()),
+            ],
+            options={
+                "verbose_name_plural": "ticket history",
+                "db_table": "passengers_tickethistory",
+                "managed": False,
+            },
+        ),
+        migrations.CreateModel(
+            name="ArchivedTicket",
+            fields=[
+                ("id", models.BigIntegerField(primary_key=True, serialize=False)),
+                ("cost", models.DecimalField(decimal_places=2, max_digits=10)),
+                (
+                    "status",
+                    models.CharField(
+                        choices=[
+                            ("pending", "Pending"),
+                            ("in use", "In Use"),
+                            ("active", "Active"),
+                            ("expired", "Expired"),
+                        ],
+                        max_length=20,
+                    ),
+                ),
+                ("status_changed_at", models.DateTimeField()),
+                (
+                    "archived_at",
+                    models.DateTimeField(default=django.utils.timezone.now),
+                ),
+                (
+                    "destination",
+                    models.ForeignKey(
+                        on_delete=django.db.models.deletion.CASCADE,
+                        related_name="+",
+                        to="passengers.station",
+                    ),
+                ),
+                (
+                    "passenger",
+                    models.ForeignKey(
+                        on_delete=django.db.models.deletion.CASCADE,
+                        related_name="archived_tickets",
+                        to="passengers.passenger",
+                    ),
+                ),
+                (
+                    "start_station",
+                    models.ForeignKey(
+                        on_delete=django.db.models.deletion.CASCADE,
+                        related_name="+",
+                        to="passengers.station",
+                    ),
+                ),
+            ],
+        ),
+        migrations.RunSQL(CREATE_HISTORY_VIEW, "DROP VIEW passengers_tickethistory"),
+    ]
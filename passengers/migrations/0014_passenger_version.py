@@ -0,0 +1,18 @@
+# Generated by Django 5.2.8 on 2026-10-19 16:01
+
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ("passengers", "0013_ticket_archive"),
+    ]
+
+    operations = [
+        migrations.AddField(
+            model_name="passenger",
+            name="version",
+            field=models.PositiveBigIntegerField(default=0, editable=False),
+        ),
+    ]
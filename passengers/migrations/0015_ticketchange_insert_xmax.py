@@ -0,0 +1,50 @@
+# Generated by Django 5.2.8 on 2026-10-19 18:02
+
+from django.db import migrations, models
+
+# See metroapp/commit_order.py. plpgsql takes a new snapshot for the SELECT (at the READ
+# COMMITTED isolation level Django uses), the statement's own snapshot is older than the seq
+CREATE_FUNCTION = """
+CREATE OR REPLACE FUNCTION record_insert_xmax() RETURNS trigger AS $$
+BEGIN
+    NEW.insert_xmax := (SELECT pg_snapshot_xmax(pg_current_snapshot())::text::bigint);
+    RETURN NEW;
+END
+$$ LANGUAGE plpgsql VOLATILE
+"""
+
+CREATE_TRIGGER = """
+CREATE TRIGGER record_insert_xmax BEFORE INSERT ON passengers_ticketchange
+FOR EACH ROW EXECUTE FUNCTION record_insert_xmax()
+"""
+
+
+def create_trigger(apps, schema_editor):
+    # Other databases allocate the ids in commit order, the column stays NULL
+    if schema_editor.connection.vendor == "postgresql":
+        schema_editor.execute(CREATE_FUNCTION)
+        schema_editor.execute(CREATE_TRIGGER)
+
+
+def drop_trigger(apps, schema_editor):
+    if schema_editor.connection.vendor == "postgresql":
+        schema_editor.execute(
+            "DROP TRIGGER record_insert_xmax ON passengers_ticketchange"
+        )
+        schema_editor.execute("DROP FUNCTION record_insert_xmax()")
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ("passengers", "0014_passenger_version"),
+    ]
+
+    operations = [
+        migrations.AddField(
+            model_name="ticketchange",
+            name="insert_xmax",
+            field=models.BigIntegerField(editable=False, null=True),
+        ),
+        migrations.RunPython(create_trigger, drop_trigger),
+    ]
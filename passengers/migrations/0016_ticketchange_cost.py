@@ -0,0 +1,18 @@
+# Generated by Django 5.2.8 on 2026-10-19 16:26
+
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ("passengers", "0015_ticketchange_insert_xmax"),
+    ]
+
+    operations = [
+        migrations.AddField(
+            model_name="ticketchange",
+            name="cost",
+            field=models.DecimalField(decimal_places=2, max_digits=10, null=True),
+        ),
+    ]
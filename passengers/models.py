@@ -3,7 +3,9 @@ Implementation of the models used to make the metroapp
 The db module is to implement the models
 The User is for Django's authentication
 The utils and datetime module are needed for OTP validation
-The pathfinder module finds the shortest path, needed for calculating the price
+The routing_client module finds the shortest path (through the routing daemon, or the route table),
+needed for calculating the price
+The ticket_tokens module signs the tokens checked by the gates
 
 The kinds of relationships between models are:
 one-to-one: models.OneToOneField(), or one instance of this model can be linked to one instance of the model
@@ -13,11 +15,12 @@ specified in the ForeignKey
 many-to-many: models.ManyToManyField(), or many instances of this model can be linked to many instances of the
 model specified in the ManyToManyField
 """
-from django.db import models
+from django.db import models, transaction
 from django.contrib.auth.models import User
 from django.utils import timezone
 from datetime import timedelta
-from passengers.breadth_first_search import shortest_path
+from passengers.routing_client import shortest_route
+from passengers.ticket_tokens import make_token
 
 # OTP expiry limit in minutes
 EXPIRYLIMIT = 10
@@ -37,11 +40,33 @@ class Passenger(models.Model):
 
     bank_balance = models.DecimalField(max_digits=10, decimal_places=2, default=0)
     user = models.OneToOneField(User, on_delete=models.CASCADE)
+    # Incremented whenever the balance or one of the passenger's tickets changes, the API's
+    # ETags are based on it (see api.py)
+    version = models.PositiveBigIntegerField(default=0, editable=False)
 
     def __str__(self):
         """Useful for the admin interface"""
         return self.user.username
 
+    def save(self, *args, **kwargs):
+        """
+        Bumps the version on every update, the balance may have changed. The increment happens in
+        the database so an instance loaded earlier can't write an older version back, the new
+        value is loaded again if it is read.
+        """
+        adding = self._state.adding
+        if not adding:
+            self.version = models.F("version") + 1
+        super().save(*args, **kwargs)
+        if not adding:
+            # Deferred, like a field left out by only()
+            del self.version
+
+    @classmethod
+    def bump_versions(cls, ids):
+        """Marks the tickets of the passengers (ids or a subquery of ids) as changed"""
+        cls.objects.filter(id__in=ids).update(version=models.F("version") + 1)
+
 
 class Station(models.Model):
     """
@@ -95,22 +120,40 @@ class Ticket(models.Model):
     # The cost is dynamically calculated already, it shouldn't be editable
     cost = models.DecimalField(max_digits=10, decimal_places=2, editable=False)
 
-    # The status of a newly purchased ticket should be pending
-    status = models.CharField(max_length=20, choices=STATUS_CHOICES, default="pending")
+    # The status of a newly purchased ticket should be pending. Indexed, the admin filters on it
+    status = models.CharField(
+        max_length=20, choices=STATUS_CHOICES, default="pending", db_index=True
+    )
+    # Set by save() when the status changes. Tickets expired less than a token lifetime ago are
+    # published to the gates' revocation filter (see scanner/revocation.py)
+    status_changed_at = models.DateTimeField(default=timezone.now, db_index=True)
+
+    @classmethod
+    def from_db(cls, db, field_names, values):
+        """Remembers the status and stations read from the database, to detect changes in save()"""
+        ticket = super().from_db(db, field_names, values)
+        if "status" in field_names:
+            ticket._loaded_status = values[field_names.index("status")]
+        if "start_station_id" in field_names and "destination_id" in field_names:
+            ticket._loaded_stations = (
+                values[field_names.index("start_station_id")],
+                values[field_names.index("destination_id")],
+            )
+        return ticket
 
     def calculate_cost(self, start_station, destination_station):
         """
-        Uses the algorithm in pathfinder to calculate the cost of the path that takes
-        the least distance.
+        Uses the routing daemon, or the route table (backed by the contraction hierarchy) when
+        there is none, to calculate the cost of the path that takes the least distance. This
+        gives the same answer as the Dijkstra in pathfinder, without searching the whole network
+        for every ticket.
         """
         try:
-            cost, distance, stations_crossed = shortest_path(
-                start_station, destination_station
-            )
+            route = shortest_route(start_station.id, destination_station.id)
         except ValueError:
             return -1
 
-        return cost
+        return route.cost
 
     def save(self, *args, **kwargs):
         """
@@ -118,15 +161,160 @@ class Ticket(models.Model):
         The parent's save method, i.e super().save() is used here for convenience, in the forms we
         were dealing with multiple models (Passenger + User), so the create() was used there which
         internally calls the save().
+        The cost is only calculated when it isn't set yet or the stations changed: a status change
+        (confirmation, scans) keeps the fare the passenger was shown and charged, without routing.
+        A ticket loaded from the database is only ever updated: if it was deleted since (ex. by
+        the sweeper), saving raises DatabaseError instead of inserting it again.
         """
-        self.cost = self.calculate_cost(self.start_station, self.destination)
-        super().save(*args, **kwargs)
+        if not self._state.adding and not kwargs.get("force_insert"):
+            kwargs["force_update"] = True
+        stations = (self.start_station_id, self.destination_id)
+        if self.cost is None or (
+            not self._state.adding
+            and stations != getattr(self, "_loaded_stations", stations)
+        ):
+            self.cost = self.calculate_cost(self.start_station, self.destination)
+        self._loaded_stations = stations
+
+        previous_status = getattr(self, "_loaded_status", None)
+        if previous_status == self.status:
+            with transaction.atomic():
+                super().save(*args, **kwargs)
+                Passenger.bump_versions([self.passenger_id])
+            return
+
+        # New ticket or status change: recorded in the change feed, in the same transaction
+        self.status_changed_at = timezone.now()
+        with transaction.atomic():
+            super().save(*args, **kwargs)
+            TicketChange.record(
+                [(self.id, previous_status or "", self.status, self.cost)],
+                self.status_changed_at,
+            )
+            Passenger.bump_versions([self.passenger_id])
+        self._loaded_status = self.status
+
+    @property
+    def gate_token(self):
+        """Signed token for the gates, only for tickets that can still be used"""
+        if self.status.lower() not in ("active", "in use"):
+            return ""
+        return make_token(self)
 
     # Useful for the admin interface
     def __str__(self):
         return f"{self.passenger.user.username}, {self.start_station.name} to {self.destination.name}"
 
 
+class ArchivedTicket(models.Model):
+    """
+    Expired tickets moved out of the Ticket table by the archive_tickets command (see
+    passengers/archive.py), so the Ticket table and its indexes only hold the tickets that can
+    still be used or were used recently. Same columns and ids as Ticket, never modified.
+    """
+
+    id = models.BigIntegerField(primary_key=True)
+    passenger = models.ForeignKey(
+        Passenger, on_delete=models.CASCADE, related_name="archived_tickets"
+    )
+    start_station = models.ForeignKey(
+        Station, on_delete=models.CASCADE, related_name="+"
+    )
+    destination = models.ForeignKey(Station, on_delete=models.CASCADE, related_name="+")
+    cost = models.DecimalField(max_digits=10, decimal_places=2)
+    status = models.CharField(max_length=20, choices=Ticket.STATUS_CHOICES)
+    status_changed_at = models.DateTimeField()
+    archived_at = models.DateTimeField(default=timezone.now)
+
+    def __str__(self):
+        """Useful for the admin interface"""
+        return f"Archived ticket {self.id}"
+
+
+class TicketHistory(models.Model):
+    """
+    Read-only view (UNION ALL) over Ticket and ArchivedTicket, created by migration 0013.
+    passenger.ticket_history spans both tables, for the pages showing a passenger's whole
+    history; everything else reads and writes Ticket. The view has to be recreated whenever a
+    column is added to the tables.
+    """
+
+    id = models.BigIntegerField(primary_key=True)
+    passenger = models.ForeignKey(
+        Passenger, on_delete=models.DO_NOTHING, related_name="ticket_history"
+    )
+    start_station = models.ForeignKey(
+        Station, on_delete=models.DO_NOTHING, related_name="+"
+    )
+    destination = models.ForeignKey(
+        Station, on_delete=models.DO_NOTHING, related_name="+"
+    )
+    cost = models.DecimalField(max_digits=10, decimal_places=2)
+    status = models.CharField(max_length=20, choices=Ticket.STATUS_CHOICES)
+    status_changed_at = models.DateTimeField()
+    archived = models.BooleanField()
+
+    class Meta:
+        managed = False
+        db_table = "passengers_tickethistory"
+        verbose_name_plural = "ticket history"
+
+    @property
+    def gate_token(self):
+        if self.archived or self.status.lower() not in ("active", "in use"):
+            return ""
+        return make_token(self)
+
+
+class TicketChange(models.Model):
+    """
+    Append-only log of ticket creations and status changes, read by the change feed (see
+    passengers/changes.py). seq increases with every change, so consumers only have to remember
+    the last one they saw. previous_status is empty for a new ticket. Deleted and archived
+    tickets get a last change to "deleted" and "archived". cost is the ticket's cost when it
+    changed, so a sale keeps the fare it was paid at when the ticket is repriced or archived.
+
+    The ticket isn't a database constraint, the log outlives deleted or archived tickets.
+    """
+
+    seq = models.BigAutoField(primary_key=True)
+    ticket = models.ForeignKey(
+        Ticket,
+        on_delete=models.DO_NOTHING,
+        db_constraint=False,
+        related_name="changes",
+    )
+    previous_status = models.CharField(max_length=20, blank=True)
+    status = models.CharField(max_length=20)
+    changed_at = models.DateTimeField(default=timezone.now)
+    # NULL when the writer didn't have it (sweeper deletions, changes logged before 0016)
+    cost = models.DecimalField(max_digits=10, decimal_places=2, null=True)
+    # Set by the database, the feed is read in commit order (see metroapp/commit_order.py)
+    insert_xmax = models.BigIntegerField(null=True, editable=False)
+
+    @classmethod
+    def record(cls, changes, changed_at=None):
+        """
+        Logs [(ticket_id, previous_status, status, cost)] with a single insert, in the
+        transaction that wrote the tickets (after them, see commit_order.py).
+        """
+        changed_at = changed_at or timezone.now()
+        cls.objects.bulk_create(
+            cls(
+                ticket_id=ticket_id,
+                previous_status=previous_status,
+                status=status,
+                changed_at=changed_at,
+                cost=cost,
+            )
+            for ticket_id, previous_status, status, cost in changes
+        )
+
+    def __str__(self):
+        """Useful for the admin interface"""
+        return f"#{self.seq} ticket {self.ticket_id}: {self.previous_status or 'new'} -> {self.status}"
+
+
 class Line(models.Model):
     """
     Defines the Line model. When calculating the shortest path between 2 stations, the is_active is used
@@ -178,6 +366,28 @@ class Connection(models.Model):
         return f"{self.start_station} to {self.destination_station}, {self.line.name}"
 
 
+class NetworkVersion(models.Model):
+    """
+    Single row counter bumped whenever a Station, Line or Connection changes (see signals.py).
+    Precomputed routing data is tagged with the version it was built from, so stale copies can
+    be detected with one cheap query instead of reloading the whole network.
+
+    topology_version only changes with stations and connections. Disabling or re-enabling a Line
+    keeps it, so the routing code knows it only has to apply a new line mask.
+    stations_version only changes with stations, it versions the cached station catalogue.
+    """
+
+    version = models.PositiveBigIntegerField(default=0)
+    topology_version = models.PositiveBigIntegerField(default=0)
+    stations_version = models.PositiveBigIntegerField(default=0)
+    stations_updated_at = models.DateTimeField(default=timezone.now)
+    updated_at = models.DateTimeField(auto_now=True)
+
+    def __str__(self):
+        """Useful for the admin interface"""
+        return f"Network version {self.version}"
+
+
 class OTP(models.Model):
     """
     Defines the OTP model, needed for purchase confirmation.
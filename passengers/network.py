@@ -0,0 +1,189 @@
+"""
+In-memory snapshot of the railway network used by the routing code.
+
+Every change to a Station, Line or Connection bumps the NetworkVersion counter (see signals.py).
+Routing data (graphs, contraction hierarchies, cached routes) is tagged with the version it was
+built from, so each process can cheaply check whether its copy is still current instead of
+reloading every Connection on every request.
+"""
+from collections import namedtuple
+from decimal import Decimal
+
+# One row per Connection, only the fields the routing code needs. Plain tuples keep the
+# snapshot small and picklable, and avoid creating a model instance for every track.
+Edge = namedtuple(
+    "Edge", ["id", "line_id", "start", "end", "distance", "cost", "travel_time"]
+)
+
+# Result of a routing query. connection_ids is ordered from the start to the end station.
+Route = namedtuple("Route", ["cost", "distance", "travel_time", "connection_ids"])
+
+# The weights a route can be optimised for, i.e the Connection fields used as edge weights
+WEIGHTS = ("distance", "cost")
+
+# Per-process cache of the last loaded graph
+_graph = None
+
+
+def get_network_state():
+    """
+    Returns (version, topology_version). The version changes on every network change, the
+    topology version only when stations or connections change, not when a line is disabled or
+    re-enabled, so routing data can be updated incrementally in that case.
+    """
+    from .models import NetworkVersion
+
+    state = NetworkVersion.objects.filter(pk=1).values_list(
+        "version", "topology_version"
+    )
+    return state.first() or (0, 0)
+
+
+def get_network_version() -> int:
+    """Returns the current network version, 0 if the network was never modified"""
+    return get_network_state()[0]
+
+
+def bump_network_version(topology=True, stations=False) -> int:
+    """
+    Marks the network as changed, which invalidates all the routing data built from older
+    versions. Pass topology=False when only line statuses changed, and stations=True when
+    stations were added, renamed or removed (invalidates the station catalogue). The increments
+    happen in the database (F expressions) so concurrent bumps from different workers are
+    never lost.
+    """
+    from django.db.models import F
+    from django.utils import timezone
+    from .models import NetworkVersion
+
+    now = timezone.now()
+    changes = {"version": F("version") + 1, "updated_at": now}
+    if topology:
+        changes["topology_version"] = F("topology_version") + 1
+    if stations:
+        changes["stations_version"] = F("stations_version") + 1
+        changes["stations_updated_at"] = now
+
+    updated = NetworkVersion.objects.filter(pk=1).update(**changes)
+    if not updated:
+        NetworkVersion.objects.get_or_create(
+            pk=1,
+            defaults={
+                "version": 1,
+                "topology_version": 1,
+                "stations_version": 1,
+                "stations_updated_at": now,
+            },
+        )
+
+    return get_network_version()
+
+
+class NetworkGraph:
+    """
+    Immutable snapshot of the network at a given version.
+
+    edges holds every connection, including the ones on disabled lines. disabled_lines is the
+    line-level edge mask: adjacency only contains the connections on lines outside of it, and
+    maps every station id to a list of (neighbour_id, edge) pairs. Connections are
+    bidirectional, so each one appears in the lists of both of its stations.
+    """
+
+    def __init__(
+        self, version, edges, topology_version=None, disabled_lines=frozenset()
+    ):
+        self.version = version
+        self.topology_version = topology_version
+        self.edges = {edge.id: edge for edge in edges}
+        self._apply_mask(disabled_lines)
+
+    def _apply_mask(self, disabled_lines):
+        self.disabled_lines = frozenset(disabled_lines)
+        self.adjacency = {}
+
+        for edge in self.open_edges():
+            self.adjacency.setdefault(edge.start, []).append((edge.end, edge))
+            self.adjacency.setdefault(edge.end, []).append((edge.start, edge))
+
+    def open_edges(self):
+        """The connections on active lines"""
+        return (
+            edge
+            for edge in self.edges.values()
+            if edge.line_id not in self.disabled_lines
+        )
+
+    def with_mask(self, version, disabled_lines):
+        """
+        Copy of this graph with a different set of disabled lines. Only the adjacency lists
+        are rebuilt, the connections are shared with this graph and not reloaded.
+        """
+        graph = NetworkGraph.__new__(NetworkGraph)
+        graph.version = version
+        graph.topology_version = self.topology_version
+        graph.edges = self.edges
+        graph._apply_mask(disabled_lines)
+        return graph
+
+    def stations_on(self, line_ids):
+        """Ids of the stations served by the given lines"""
+        stations = set()
+        for edge in self.edges.values():
+            if edge.line_id in line_ids:
+                stations.update((edge.start, edge.end))
+        return stations
+
+    def route(self, connection_ids) -> Route:
+        """Builds a Route (with exact Decimal cost) from a list of connection ids"""
+        edges = [self.edges[cid] for cid in connection_ids]
+
+        return Route(
+            cost=sum((edge.cost for edge in edges), Decimal(0)),
+            distance=sum(edge.distance for edge in edges),
+            travel_time=sum(edge.travel_time for edge in edges),
+            connection_ids=list(connection_ids),
+        )
+
+
+def load_edges():
+    """Reads all the connections in a single query, without model instances"""
+    from .models import Connection
+
+    rows = Connection.objects.values_list(
+        "id",
+        "line_id",
+        "start_station_id",
+        "destination_station_id",
+        "distance",
+        "cost",
+        "travel_time",
+    )
+    return [
+        Edge(cid, line_id, start, end, float(distance), cost, travel_time)
+        for cid, line_id, start, end, distance, cost, travel_time in rows
+    ]
+
+
+def load_disabled_lines():
+    from .models import Line
+
+    return frozenset(Line.objects.filter(is_active=False).values_list("id", flat=True))
+
+
+def get_graph() -> NetworkGraph:
+    """
+    Returns the graph for the current network version. The connections are only reloaded from
+    the database when the topology changed since this process last loaded them; if only line
+    statuses changed, the new edge mask is applied to the graph already in memory.
+    """
+    global _graph
+
+    version, topology_version = get_network_state()
+    if _graph is None or _graph.topology_version != topology_version:
+        _graph = NetworkGraph(
+            version, load_edges(), topology_version, load_disabled_lines()
+        )
+    elif _graph.version != version:
+        _graph = _graph.with_mask(version, load_disabled_lines())
+
+    return _graph
@@ -0,0 +1,330 @@
+"""
+Bulk import of stations, lines and connections.
+
+Rows are streamed from the files and validated in a single pass. Connections are written with
+chunked bulk_create upserts on ("line", "start_station", "destination_station"), the
+unique_together of Connection, so re-importing a network updates distances, travel times and
+fares in place. Only one chunk of connections is held in memory at a time.
+
+bulk_create doesn't send post_save signals, so the network version is bumped once at the end
+instead of once per row. The caller is expected to run the import in a transaction, and roll
+it back if any errors were reported.
+
+Supported layouts:
+    CSV: stations.csv (name), lines.csv (name[, is_active]) and connections.csv
+        (line, start_station, destination_station, travel_time[, distance][, cost]), where
+        lines and stations are referred to by name
+    GTFS-like: stops.txt, routes.txt, trips.txt and stop_times.txt. Every pair of consecutive
+        stops of a trip becomes a connection on the trip's route. stop_times.txt must list the
+        stops of each trip together (as GTFS feeds do).
+"""
+import csv
+from collections import Counter
+from decimal import Decimal, InvalidOperation
+from itertools import groupby
+from pathlib import Path
+
+from .models import Connection, Line, Station
+from .network import bump_network_version
+
+# Connection.cost is a DecimalField(max_digits=15, decimal_places=2)
+MAX_COST = Decimal("9999999999999.99")
+
+
+def read_csv(path):
+    """Yields (line_number, row dict) for every row of a CSV file with a header"""
+    with open(path, newline="", encoding="utf-8-sig") as f:
+        reader = csv.DictReader(f)
+        for row in reader:
+            yield reader.line_num, row
+
+
+class NetworkImporter:
+    """
+    Keeps the name -> id maps of the stations and lines, the chunk of connections waiting to be
+    written, and the validation errors found so far.
+    """
+
+    def __init__(self, chunk_size=5000, max_errors=50):
+        self.chunk_size = chunk_size
+        self.max_errors = max_errors
+        self.errors = []
+        self.counts = Counter()
+
+        self.stations = dict(Station.objects.values_list("name", "id"))
+        self.lines = dict(Line.objects.values_list("name", "id"))
+
+        self._chunk = []
+        self._seen = set()
+
+    def error(self, source, line_number, message):
+        if len(self.errors) < self.max_errors:
+            self.errors.append(f"{source}:{line_number}: {message}")
+        self.counts["errors"] += 1
+
+    def add_stations(self, names):
+        """Creates the stations that don't exist yet, names is an iterable of (source, line, name)"""
+        missing = []
+        for source, line_number, name in names:
+            name = (name or "").strip()
+            if not name:
+                self.error(source, line_number, "station name is empty")
+            elif len(name) > Station._meta.get_field("name").max_length:
+                self.error(source, line_number, f"station name too long: {name}")
+            elif name not in self.stations:
+                # Placeholder until the row is created, also skips duplicates in the file
+                self.stations[name] = None
+                missing.append(Station(name=name))
+
+        for start in range(0, len(missing), self.chunk_size):
+            for station in Station.objects.bulk_create(
+                missing[start : start + self.chunk_size]
+            ):
+                self.stations[station.name] = station.id
+
+        self.counts["stations created"] += len(missing)
+
+    def add_lines(self, rows):
+        """
+        Creates the lines that don't exist yet and updates is_active of the existing ones.
+        rows is an iterable of (source, line, name, is_active), is_active None keeps it as is.
+        """
+        missing = {}
+        changed = {}
+        for source, line_number, name, is_active in rows:
+            name = (name or "").strip()
+            if not name:
+                self.error(source, line_number, "line name is empty")
+                continue
+            if len(name) > Line._meta.get_field("name").max_length:
+                self.error(source, line_number, f"line name too long: {name}")
+                continue
+
+            if name in self.lines:
+                if is_active is not None:
+                    changed[name] = is_active
+            else:
+                missing[name] = Line(
+                    name=name, is_active=True if is_active is None else is_active
+                )
+
+        for line in Line.objects.bulk_create(list(missing.values())):
+            self.lines[line.name] = line.id
+
+        for name, is_active in changed.items():
+            Line.objects.filter(id=self.lines[name]).exclude(
+                is_active=is_active
+            ).update(is_active=is_active)
+
+        self.counts["lines created"] += len(missing)
+
+    def add_connection(
+        self,
+        source,
+        line_number,
+        line,
+        start,
+        destination,
+        travel_time,
+        distance=None,
+        cost=None,
+        skip_duplicates=False,
+    ):
+        """Validates a connection row and queues it for the next chunk"""
+        line_id = self.lines.get((line or "").strip())
+        start_id = self.stations.get((start or "").strip())
+        destination_id = self.stations.get((destination or "").strip())
+
+        if line_id is None:
+            return self.error(source, line_number, f"unknown line: {line}")
+        if start_id is None:
+            return self.error(source, line_number, f"unknown station: {start}")
+        if destination_id is None:
+            return self.error(source, line_number, f"unknown station: {destination}")
+        if start_id == destination_id:
+            return self.error(source, line_number, "start and destination are the same")
+
+        key = (line_id, start_id, destination_id)
+        if key in self._seen:
+            if not skip_duplicates:
+                self.error(source, line_number, "duplicate connection")
+            return
+        self._seen.add(key)
+
+        fields = {}
+        try:
+            fields["travel_time"] = int(travel_time)
+            if distance not in (None, ""):
+                fields["distance"] = float(distance)
+            if cost not in (None, ""):
+                fields["cost"] = Decimal(cost).quantize(Decimal("0.01"))
+        except (TypeError, ValueError, InvalidOperation):
+            return self.error(
+                source, line_number, "travel_time/distance/cost is not a number"
+            )
+
+        if fields["travel_time"] < 0 or fields.get("distance", 0) < 0:
+            return self.error(source, line_number, "negative travel_time/distance")
+        if not Decimal(0) <= fields.get("cost", Decimal(0)) <= MAX_COST:
+            return self.error(source, line_number, "cost out of range")
+
+        self._chunk.append(
+            Connection(
+                line_id=line_id,
+                start_station_id=start_id,
+                destination_station_id=destination_id,
+                **fields,
+            )
+        )
+        if len(self._chunk) >= self.chunk_size:
+            self.flush()
+
+    def flush(self):
+        """Upserts the queued connections. Nothing is written once an error was found."""
+        if self._chunk and not self.errors:
+            Connection.objects.bulk_create(
+                self._chunk,
+                update_conflicts=True,
+                unique_fields=["line", "start_station", "destination_station"],
+                update_fields=["distance", "travel_time", "cost"],
+            )
+            self.counts["connections upserted"] += len(self._chunk)
+        self._chunk = []
+
+    def finish(self):
+        """Writes the last chunk and bumps the network version once for the whole import"""
+        self.flush()
+        if not self.errors:
+            bump_network_version(stations=self.counts["stations created"] > 0)
+
+    def import_csv(self, stations=None, lines=None, connections=None):
+        if stations:
+            self.add_stations(
+                (stations, line_number, row.get("name"))
+                for line_number, row in read_csv(stations)
+            )
+
+        if lines:
+            self.add_lines(
+                (lines, line_number, row.get("name"), parse_bool(row.get("is_active")))
+                for line_number, row in read_csv(lines)
+            )
+
+        if connections:
+            for line_number, row in read_csv(connections):
+                self.add_connection(
+                    connections,
+                    line_number,
+                    row.get("line"),
+                    row.get("start_station"),
+                    row.get("destination_station"),
+                    row.get("travel_time"),
+                    row.get("distance"),
+                    row.get("cost"),
+                )
+
+        self.finish()
+
+    def import_gtfs(self, directory):
+        directory = Path(directory)
+        stops_path = directory / "stops.txt"
+        routes_path = directory / "routes.txt"
+
+        # stop_id -> station name, only actual stops (location_type 0 or empty)
+        stop_names = {}
+        for line_number, row in read_csv(stops_path):
+            if row.get("location_type", "") in ("", "0"):
+                stop_names[row.get("stop_id")] = (row.get("stop_name") or "").strip()
+        self.add_stations(
+            (stops_path, "-", name) for name in sorted(set(stop_names.values()))
+        )
+
+        # route_id -> line name
+        route_names = {}
+        for line_number, row in read_csv(routes_path):
+            route_names[row.get("route_id")] = (
+                row.get("route_short_name") or row.get("route_long_name") or ""
+            ).strip()
+        self.add_lines(
+            (routes_path, "-", name, None) for name in sorted(set(route_names.values()))
+        )
+
+        trip_routes = {
+            row.get("trip_id"): route_names.get(row.get("route_id"))
+            for _, row in read_csv(directory / "trips.txt")
+        }
+
+        stop_times_path = directory / "stop_times.txt"
+        rows = read_csv(stop_times_path)
+        for trip_id, trip_rows in groupby(
+            rows, key=lambda item: item[1].get("trip_id")
+        ):
+            line = trip_routes.get(trip_id)
+            if line is None:
+                self.error(stop_times_path, "-", f"unknown trip: {trip_id}")
+                continue
+
+            try:
+                stops = sorted(
+                    trip_rows, key=lambda item: int(item[1]["stop_sequence"])
+                )
+            except (KeyError, TypeError, ValueError):
+                self.error(stop_times_path, "-", f"bad stop_sequence in trip {trip_id}")
+                continue
+
+            for (_, here), (line_number, there) in zip(stops, stops[1:]):
+                try:
+                    travel_time = max(
+                        round(
+                            (
+                                gtfs_seconds(there["arrival_time"])
+                                - gtfs_seconds(here["departure_time"])
+                            )
+                            / 60
+                        ),
+                        0,
+                    )
+                except (KeyError, TypeError, ValueError):
+                    self.error(
+                        stop_times_path, line_number, "bad arrival/departure time"
+                    )
+                    continue
+
+                distance = None
+                if here.get("shape_dist_traveled") and there.get("shape_dist_traveled"):
+                    try:
+                        distance = float(there["shape_dist_traveled"]) - float(
+                            here["shape_dist_traveled"]
+                        )
+                    except ValueError:
+                        self.error(
+                            stop_times_path, line_number, "bad shape_dist_traveled"
+                        )
+                        continue
+
+                # Many trips run over the same stops, each connection is only kept once
+                self.add_connection(
+                    stop_times_path,
+                    line_number,
+                    line,
+                    stop_names.get(here.get("stop_id")),
+                    stop_names.get(there.get("stop_id")),
+                    travel_time,
+                    distance,
+                    skip_duplicates=True,
+                )
+
+        self.finish()
+
+
+def parse_bool(value):
+    """ "true"/"1"/"yes" -> True, "false"/"0"/"no" -> False, empty -> None"""
+    if value is None or value.strip() == "":
+        return None
+    return value.strip().lower() in ("true", "1", "yes", "y")
+
+
+def gtfs_seconds(value):
+    """GTFS times are HH:MM:SS and can go past 24:00:00 for trips after midnight"""
+    hours, minutes, seconds = (int(part) for part in value.strip().split(":"))
+    return hours * 3600 + minutes * 60 + seconds
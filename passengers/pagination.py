@@ -0,0 +1,44 @@
+"""
+Paginator for very large tables.
+
+An exact COUNT(*) has to scan the whole table on Postgres, which gets slow once the tickets
+table holds millions of rows, and the admin changelist runs one on every page. For unfiltered
+lists, the planner's row estimate (pg_class.reltuples, refreshed by VACUUM/ANALYZE) is good
+enough to number the pages. Small tables, filtered lists and other databases are still counted
+exactly.
+"""
+from django.conf import settings
+from django.core.paginator import Paginator
+from django.db import connections
+from django.utils.functional import cached_property
+
+
+class EstimatedCountPaginator(Paginator):
+    @cached_property
+    def count(self):
+        estimate = estimated_count(self.object_list)
+        if estimate is not None and estimate >= settings.ESTIMATED_COUNT_THRESHOLD:
+            return estimate
+        return super().count
+
+
+def estimated_count(queryset):
+    """Row estimate of the queryset's table, None if it can't be used for this queryset"""
+    if not hasattr(queryset, "query") or queryset.query.where:
+        return None
+
+    connection = connections[queryset.db]
+    if connection.vendor != "postgresql":
+        return None
+
+    with connection.cursor() as cursor:
+        cursor.execute(
+            "SELECT reltuples::bigint FROM pg_class WHERE oid = %s::regclass",
+            [queryset.model._meta.db_table],
+        )
+        row = cursor.fetchone()
+
+    # reltuples is -1 until the table was first analyzed
+    if row is None or row[0] < 0:
+        return None
+    return row[0]
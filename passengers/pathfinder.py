@@ -1,64 +1,119 @@
 import heapq
 from decimal import Decimal
 
+from .network import get_graph
 
-def shortest_path(start_station, end_station):
+
+def dijkstra(
+    graph, start_id, end_id, weight="distance", excluded_edges=(), excluded_nodes=()
+):
     """
-    Finds the shortest path from start_station to end_station using Dijkstra's algorithm.
-    Returns (total_distance, total_cost, connection_list) along the shortest path.
-    Total cost is calculated after the path is found.
+    Plain Dijkstra over a NetworkGraph, weighted by the given Connection field.
+    Returns (total_weight, connection_ids) along the shortest path.
     Raises ValueError if no path exists.
+    The connection ids in excluded_edges and station ids in excluded_nodes are never used
+    (needed for the spur paths of the k-shortest paths search).
+
+    This is the reference implementation the contraction hierarchy is validated against.
     """
-    from .models import Station, Connection
-
-    # Build graph from active connections only
-    # Graph format: {station_id: [(neighbor_id, distance, connection_id), ...]}
-    graph = {}
-    connections = Connection.objects.filter(line__is_active=True)
-
-    # Map connection IDs to Connection objects for easy retrieval later
-    connection_map = {conn.id: conn for conn in connections}
-
-    for conn in connections:
-        # Bidirectional edges
-        graph.setdefault(conn.start_station_id, []).append(
-            (conn.destination_station_id, float(conn.distance), conn.id)
-        )
-        graph.setdefault(conn.destination_station_id, []).append(
-            (conn.start_station_id, float(conn.distance), conn.id)
-        )
-
-    start_id = start_station.id
-    end_id = end_station.id
-
-    # Priority queue: (total_distance, current_station_id, path_of_connection_ids, path_of_station_ids)
-    heap = [(0, start_id, [], [start_id])]
+    # Priority queue: (total_weight, current_station_id)
+    heap = [(0.0, start_id)]
+    best = {start_id: 0.0}
+    # station_id: (previous_station_id, connection_id) used to rebuild the path at the end
+    parent = {start_id: None}
     visited = set()
 
     while heap:
-        total_distance, current, conn_path, path_stations = heapq.heappop(heap)
+        total_weight, current = heapq.heappop(heap)
 
         if current in visited:
             continue
         visited.add(current)
 
         if current == end_id:
-            # Convert connection IDs back to Connection objects
-            connections_list = [connection_map[cid] for cid in conn_path]
-            # Calculate total cost after the path is found
-            total_cost = Decimal(sum(c.cost for c in connections_list))
-            return total_cost, total_distance, connections_list
-
-        for neighbor, distance, conn_id in graph.get(current, []):
-            if neighbor not in visited:
-                heapq.heappush(
-                    heap,
-                    (
-                        total_distance + distance,
-                        neighbor,
-                        conn_path + [conn_id],
-                        path_stations + [neighbor],
-                    ),
-                )
-
-    raise ValueError(f"No route possible from {start_station} to {end_station}")
+            conn_path = []
+            while parent[current] is not None:
+                current, conn_id = parent[current]
+                conn_path.append(conn_id)
+            conn_path.reverse()
+            return total_weight, conn_path
+
+        for neighbor, edge in graph.adjacency.get(current, []):
+            if edge.id in excluded_edges or neighbor in excluded_nodes:
+                continue
+            candidate = total_weight + float(getattr(edge, weight))
+            if neighbor not in visited and candidate < best.get(neighbor, float("inf")):
+                best[neighbor] = candidate
+                parent[neighbor] = (current, edge.id)
+                heapq.heappush(heap, (candidate, neighbor))
+
+    raise ValueError(f"No route possible from {start_id} to {end_id}")
+
+
+def shortest_path_tree(graph, start_id, weight="distance"):
+    """
+    Dijkstra from start_id without a target. Returns (best, parent):
+        best: {station_id: total_weight} for every station that can be reached
+        parent: {station_id: (previous_station_id, connection_id)}, see tree_path()
+    Connections are bidirectional, so the weights are also the distances *to* start_id.
+    """
+    best = {start_id: 0.0}
+    parent = {start_id: None}
+    heap = [(0.0, start_id)]
+
+    while heap:
+        total_weight, current = heapq.heappop(heap)
+        if total_weight > best[current]:
+            continue
+
+        for neighbor, edge in graph.adjacency.get(current, []):
+            candidate = total_weight + float(getattr(edge, weight))
+            if candidate < best.get(neighbor, float("inf")):
+                best[neighbor] = candidate
+                parent[neighbor] = (current, edge.id)
+                heapq.heappush(heap, (candidate, neighbor))
+
+    return best, parent
+
+
+def tree_path(parent, end_id):
+    """Connection ids from the root of a shortest_path_tree() to end_id, None if unreachable"""
+    if end_id not in parent:
+        return None
+
+    conn_path = []
+    current = end_id
+    while parent[current] is not None:
+        current, conn_id = parent[current]
+        conn_path.append(conn_id)
+    conn_path.reverse()
+    return conn_path
+
+
+def distances_from(graph, start_id, weight="distance"):
+    """{station_id: total_weight} for every station that can be reached from start_id"""
+    return shortest_path_tree(graph, start_id, weight)[0]
+
+
+def shortest_path(start_station, end_station):
+    """
+    Finds the shortest path from start_station to end_station using Dijkstra's algorithm.
+    Returns (total_cost, total_distance, connection_list) along the shortest path.
+    Total cost is calculated after the path is found.
+    Raises ValueError if no path exists.
+    """
+    from .models import Connection
+
+    graph = get_graph()
+
+    try:
+        total_distance, conn_path = dijkstra(graph, start_station.id, end_station.id)
+    except ValueError:
+        raise ValueError(f"No route possible from {start_station} to {end_station}")
+
+    # Convert connection IDs back to Connection objects
+    connection_map = Connection.objects.in_bulk(conn_path)
+    connections_list = [connection_map[cid] for cid in conn_path]
+    # Calculate total cost after the path is found
+    total_cost = Decimal(sum(c.cost for c in connections_list))
+    return total_cost, total_distance, connections_list
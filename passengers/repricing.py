@@ -0,0 +1,168 @@
+"""
+Repricing of pending tickets after fare changes.
+
+A pending ticket (purchase waiting for its OTP) keeps the cost computed when it was created, so
+after Connection.cost changes it shows, and is confirmed with, the old fare. Tickets don't store
+their path, so fares are recomputed from the current network: the pending tickets are grouped
+by (start, destination) in the database and every distinct pair is routed once, with the same
+route table Ticket.calculate_cost uses, no matter how many tickets share it.
+
+Tickets are then read in id order (keyset pagination) and the ones whose cost changed are
+written with bulk_update, one short transaction per chunk. The rows of a chunk are locked and
+re-checked first, so a ticket confirmed in the meantime keeps the fare that was charged.
+
+Pairs that can't be routed anymore (every line between them closed) have no fare: their tickets
+keep their cost and are reported, the sweeper deletes them if they are never confirmed.
+
+Route tables are tagged with the network version, which a fare change bumps, and alternative
+routes read their fares from the current network, so quotes don't need repricing.
+"""
+from decimal import Decimal
+
+from django.db import connection, transaction
+from django.db.models import Count
+
+from .models import Passenger, Station, Ticket
+from .network import get_graph
+from .route_table import shortest_route
+
+# Purchases always save "pending" in lower case, the status index is used
+PENDING = {"status": "pending"}
+
+REPORT_HEADER = [
+    "start_station_id",
+    "start_station",
+    "destination_id",
+    "destination",
+    "tickets",
+    "repriced",
+    "new_fare",
+]
+
+
+class RepricingReport:
+    """
+    pairs: {(start_id, destination_id): [tickets, repriced, new_fare]}, new_fare is None for
+    the pairs that can't be routed
+    tickets/repriced/unroutable: totals over every pair
+    """
+
+    def __init__(self):
+        self.pairs = {}
+        self.tickets = 0
+        self.repriced = 0
+        self.unroutable = 0
+
+    def rows(self):
+        """
+        CSV rows (header first), one per pair with at least one repriced ticket, and one per
+        unroutable pair (with an empty new_fare)
+        """
+        names = dict(Station.objects.values_list("id", "name"))
+
+        yield REPORT_HEADER
+        for (start_id, destination_id), (tickets, repriced, fare) in sorted(
+            self.pairs.items()
+        ):
+            if repriced or fare is None:
+                yield [
+                    start_id,
+                    names.get(start_id),
+                    destination_id,
+                    names.get(destination_id),
+                    tickets,
+                    repriced,
+                    "" if fare is None else fare,
+                ]
+
+
+def new_fares(report):
+    """
+    Routes every distinct pair of pending tickets once, returns {pair: fare} of the pairs that
+    can be routed
+    """
+    pairs = (
+        Ticket.objects.filter(**PENDING)
+        .values("start_station_id", "destination_id")
+        .annotate(tickets=Count("id"))
+        .values_list("start_station_id", "destination_id", "tickets")
+        .order_by()
+    )
+
+    graph = get_graph()
+    fares = {}
+    for start_id, destination_id, tickets in pairs:
+        pair = (start_id, destination_id)
+        report.tickets += tickets
+        try:
+            fare = shortest_route(start_id, destination_id, graph=graph).cost
+        except ValueError:
+            report.pairs[pair] = [tickets, 0, None]
+            report.unroutable += tickets
+            continue
+        fares[pair] = fare.quantize(Decimal("0.01"))
+        report.pairs[pair] = [tickets, 0, fares[pair]]
+
+    return fares
+
+
+def reprice_chunk(tickets, fares, report, dry_run):
+    """Updates the tickets (id, pair, cost) of a chunk whose fare changed"""
+    changed = {
+        ticket_id: fares[pair]
+        for ticket_id, pair, cost in tickets
+        if pair in fares and fares[pair] != cost
+    }
+    if not changed:
+        return
+
+    with transaction.atomic():
+        pending = Ticket.objects.filter(id__in=changed, **PENDING)
+        if not dry_run and connection.features.has_select_for_update:
+            pending = pending.select_for_update()
+
+        updated = []
+        for ticket in pending.only(
+            "id", "passenger_id", "start_station_id", "destination_id"
+        ):
+            ticket.cost = changed[ticket.id]
+            updated.append(ticket)
+            report.pairs[(ticket.start_station_id, ticket.destination_id)][1] += 1
+
+        if not dry_run:
+            Ticket.objects.bulk_update(updated, ["cost"])
+            Passenger.bump_versions({ticket.passenger_id for ticket in updated})
+        report.repriced += len(updated)
+
+
+def reprice_pending(chunk_size=5000, dry_run=False):
+    """
+    Sets the cost of every pending ticket to the current fare of its route. Returns a
+    RepricingReport; with dry_run nothing is written.
+    """
+    report = RepricingReport()
+    fares = new_fares(report)
+    if not fares:
+        return report
+
+    last_id = 0
+    while True:
+        chunk = list(
+            Ticket.objects.filter(id__gt=last_id, **PENDING)
+            .order_by("id")
+            .values_list("id", "start_station_id", "destination_id", "cost")[
+                :chunk_size
+            ]
+        )
+        if not chunk:
+            break
+
+        reprice_chunk(
+            [(ticket_id, (start, end), cost) for ticket_id, start, end, cost in chunk],
+            fares,
+            report,
+            dry_run,
+        )
+        last_id = chunk[-1][0]
+
+    return report
@@ -0,0 +1,205 @@
+"""
+Table of precomputed best routes between origin/destination pairs, kept per process.
+
+Every route is indexed by the lines it uses. When a line is disabled, only the pairs whose best
+route uses it can change, so only those are recomputed. When a line is re-enabled, a pair can
+only improve if going through one of the stations on that line is now shorter than its current
+route, which is checked with one Dijkstra tree per station on the line instead of recomputing
+every pair.
+
+The updated table is built next to the old one by a background thread, and published by
+swapping a single reference: requests never wait for it and keep reading the previous table
+meanwhile. Its routes through the newly disabled lines (or its missing routes, if lines were
+re-enabled) are computed again for the request and not stored; its other routes stay valid,
+at worst a route through a re-enabled line is a little better for a few seconds.
+"""
+import threading
+from collections import OrderedDict
+
+from django.conf import settings
+
+from .contraction_hierarchy import query_route
+from .network import get_graph
+from .pathfinder import distances_from
+
+INFINITY = float("inf")
+
+# Tolerance when comparing float route weights computed in a different order
+EPSILON = 1e-9
+
+# Marks a pair that is not in the table (None is a valid entry: the pair has no route)
+MISSING = object()
+
+# The published tables: {weight: RouteTable}
+_tables = {}
+# The threads building the updated tables: {weight: Thread}
+_updates = {}
+_refresh_lock = threading.Lock()
+
+
+class RouteTable:
+    """
+    Best routes for one network version and weight, least recently used first.
+
+    routes: {(start_id, end_id): network.Route, or None if there is no route}
+    by_line: {line_id: set of (start_id, end_id) pairs whose route uses that line}
+    """
+
+    def __init__(self, graph, weight, max_size=None):
+        self.version = graph.version
+        self.topology_version = graph.topology_version
+        self.disabled_lines = graph.disabled_lines
+        self.weight = weight
+        self.max_size = max_size or settings.ROUTE_TABLE_SIZE
+        self.routes = OrderedDict()
+        self.by_line = {}
+        self._lock = threading.Lock()
+
+    def get(self, pair):
+        with self._lock:
+            route = self.routes.get(pair, MISSING)
+            if route is not MISSING:
+                self.routes.move_to_end(pair)
+            return route
+
+    def put(self, graph, pair, route):
+        """Stores the route for a pair, ignored if it was computed for another version"""
+        if graph.version != self.version:
+            return
+
+        with self._lock:
+            self._store(graph, pair, route)
+
+            while len(self.routes) > self.max_size:
+                evicted, evicted_route = self.routes.popitem(last=False)
+                for line_id in self._lines(graph, evicted_route):
+                    self.by_line[line_id].discard(evicted)
+
+    def _store(self, graph, pair, route):
+        self.routes[pair] = route
+        for line_id in self._lines(graph, route):
+            self.by_line.setdefault(line_id, set()).add(pair)
+
+    @staticmethod
+    def _lines(graph, route):
+        if route is None:
+            return set()
+        return {graph.edges[cid].line_id for cid in route.connection_ids}
+
+    def updated(self, graph):
+        """
+        Returns a new table for graph, which must have the same connections as this table's
+        graph with a different set of disabled lines. Only the affected pairs are recomputed.
+        """
+        table = RouteTable(graph, self.weight, self.max_size)
+        disabled = graph.disabled_lines - self.disabled_lines
+        enabled = self.disabled_lines - graph.disabled_lines
+
+        affected = set()
+        with self._lock:
+            routes = list(self.routes.items())
+            for line_id in disabled:
+                affected.update(self.by_line.get(line_id, ()))
+
+        if enabled:
+            stations = graph.stations_on(enabled)
+            if len(stations) >= len(routes):
+                # Cheaper to recompute every pair than to grow a tree from every station
+                affected.update(pair for pair, _ in routes)
+            else:
+                trees = [distances_from(graph, s, self.weight) for s in stations]
+                for pair, route in routes:
+                    current = (
+                        INFINITY if route is None else route_weight(route, self.weight)
+                    )
+                    through_line = min(
+                        tree.get(pair[0], INFINITY) + tree.get(pair[1], INFINITY)
+                        for tree in trees
+                    )
+                    if through_line < current - EPSILON:
+                        affected.add(pair)
+
+        # Copied in the same order, so the least recently used pairs are still evicted first
+        for pair, route in routes:
+            if pair in affected:
+                route = compute_route(graph, pair, self.weight)
+            table._store(graph, pair, route)
+
+        return table
+
+
+def route_weight(route, weight):
+    return float(getattr(route, weight))
+
+
+def compute_route(graph, pair, weight):
+    """Route for a pair in graph, None if there is none"""
+    try:
+        return graph.route(query_route(graph, pair[0], pair[1], weight))
+    except ValueError:
+        return None
+
+
+def get_table(graph, weight="distance"):
+    """
+    Returns the published table for graph's version. If the connections changed since the last
+    one, a new empty table is started. If only line statuses changed, the update is started in
+    the background and the previous table is returned until it is published (see
+    shortest_route).
+    """
+    table = _tables.get(weight)
+    # A newer table than the request's graph is fine to read from, put() ignores it
+    if table is not None and table.version >= graph.version:
+        return table
+
+    with _refresh_lock:
+        # Another thread may have published it while this one was waiting
+        table = _tables.get(weight)
+        if table is None or table.topology_version != graph.topology_version:
+            table = RouteTable(graph, weight)
+            _tables[weight] = table
+        elif table.version < graph.version and weight not in _updates:
+            _updates[weight] = threading.Thread(
+                target=_update, args=(table, graph), daemon=True
+            )
+            _updates[weight].start()
+
+    return table
+
+
+def _update(table, graph):
+    updated = None
+    try:
+        updated = table.updated(graph)
+    finally:
+        with _refresh_lock:
+            del _updates[table.weight]
+            # Unless a new empty table was started since (the connections changed)
+            if updated is not None and _tables.get(table.weight) is table:
+                _tables[table.weight] = updated
+
+
+def shortest_route(start_id, end_id, weight="distance", graph=None):
+    """
+    Shortest route between two station ids, minimising the given weight.
+    Returns a network.Route, raises ValueError if the stations are not connected.
+    Batch callers can pass the graph from get_graph() to skip the version check of every call.
+    """
+    graph = graph or get_graph()
+    table = get_table(graph, weight)
+    pair = (start_id, end_id)
+
+    route = table.get(pair)
+    if route is MISSING:
+        route = compute_route(graph, pair, weight)
+        table.put(graph, pair, route)
+    elif table.version < graph.version and (
+        route is None or RouteTable._lines(graph, route) & graph.disabled_lines
+    ):
+        # The table is being updated and this route may have changed
+        route = compute_route(graph, pair, weight)
+
+    if route is None:
+        raise ValueError(f"No route possible from {start_id} to {end_id}")
+
+    return route
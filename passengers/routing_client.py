@@ -0,0 +1,226 @@
+"""
+Client of the routing daemon (routing_daemon.py).
+
+With settings.ROUTING_SOCKET set, routes are asked to the daemon over a Unix socket instead of
+being computed in the web worker, so the network is held (and the searches run) in one process
+per host. Each thread keeps its own connection. If the daemon can't be reached, or takes longer
+than settings.ROUTING_DAEMON_TIMEOUT, the route is computed in-process with the route table, and
+the daemon isn't tried again for settings.ROUTING_DAEMON_RETRY_SECONDS.
+
+Protocol, every message is a ">I" byte length followed by the payload:
+    request: ">H" number of queries, then ">IIB" (start_id, end_id, weight index in WEIGHTS)
+        for each query
+    response: ">I" network version the routes were computed on, then for each query a ">B"
+        status (ROUTE_FOUND, NO_ROUTE or ERROR) followed, for a route, by ">qdIH" (cost in
+        cents, distance, travel time, number of connections) and the ">I" connection ids
+"""
+import logging
+import socket
+import struct
+import threading
+import time
+from decimal import Decimal
+
+from django.conf import settings
+
+from .network import WEIGHTS, Route
+
+logger = logging.getLogger(__name__)
+
+LENGTH = struct.Struct(">I")
+COUNT = struct.Struct(">H")
+QUERY = struct.Struct(">IIB")
+VERSION = struct.Struct(">I")
+STATUS = struct.Struct(">B")
+ROUTE = struct.Struct(">qdIH")
+CONNECTION = struct.Struct(">I")
+
+ROUTE_FOUND = 1
+NO_ROUTE = 0
+ERROR = 2
+
+# Queries per message, the count is a ">H"
+MAX_QUERIES = 65535
+
+_local = threading.local()
+# Time before which the daemon isn't tried again, after a failure
+_down_until = 0
+
+
+class ProtocolError(Exception):
+    pass
+
+
+def encode_queries(pairs, weight):
+    weight_index = WEIGHTS.index(weight)
+    return COUNT.pack(len(pairs)) + b"".join(
+        QUERY.pack(start_id, end_id, weight_index) for start_id, end_id in pairs
+    )
+
+
+def decode_queries(payload):
+    """Returns [(start_id, end_id, weight), ...]"""
+    if len(payload) < COUNT.size:
+        raise ProtocolError("Truncated request")
+    (count,) = COUNT.unpack_from(payload)
+    if len(payload) != COUNT.size + count * QUERY.size:
+        raise ProtocolError("Truncated request")
+
+    queries = []
+    for start_id, end_id, weight_index in QUERY.iter_unpack(payload[COUNT.size :]):
+        if weight_index >= len(WEIGHTS):
+            raise ProtocolError(f"Unknown weight {weight_index}")
+        queries.append((start_id, end_id, WEIGHTS[weight_index]))
+    return queries
+
+
+def encode_routes(version, routes):
+    """routes holds a Route, None (no route) or ERROR for each query"""
+    parts = [VERSION.pack(version)]
+    for route in routes:
+        if route is None:
+            parts.append(STATUS.pack(NO_ROUTE))
+        elif route is ERROR:
+            parts.append(STATUS.pack(ERROR))
+        else:
+            parts.append(STATUS.pack(ROUTE_FOUND))
+            parts.append(
+                ROUTE.pack(
+                    int(route.cost * 100),
+                    route.distance,
+                    route.travel_time,
+                    len(route.connection_ids),
+                )
+            )
+            parts.extend(CONNECTION.pack(cid) for cid in route.connection_ids)
+    return b"".join(parts)
+
+
+def decode_routes(payload, count):
+    """Returns (version, [Route, None or ERROR for each query])"""
+    (version,) = VERSION.unpack_from(payload)
+    offset = VERSION.size
+
+    routes = []
+    for _ in range(count):
+        (status,) = STATUS.unpack_from(payload, offset)
+        offset += STATUS.size
+        if status == NO_ROUTE:
+            routes.append(None)
+        elif status == ERROR:
+            routes.append(ERROR)
+        else:
+            cents, distance, travel_time, length = ROUTE.unpack_from(payload, offset)
+            offset += ROUTE.size
+            connection_ids = [
+                cid
+                for (cid,) in CONNECTION.iter_unpack(
+                    payload[offset : offset + length * CONNECTION.size]
+                )
+            ]
+            offset += length * CONNECTION.size
+            routes.append(
+                Route(Decimal(cents).scaleb(-2), distance, travel_time, connection_ids)
+            )
+
+    return version, routes
+
+
+def recv_exactly(sock, size):
+    data = bytearray()
+    while len(data) < size:
+        chunk = sock.recv(size - len(data))
+        if not chunk:
+            raise ConnectionError("Routing daemon closed the connection")
+        data += chunk
+    return bytes(data)
+
+
+def _connection():
+    sock = getattr(_local, "sock", None)
+    if sock is None:
+        sock = socket.socket(socket.AF_UNIX, socket.SOCK_STREAM)
+        sock.settimeout(settings.ROUTING_DAEMON_TIMEOUT)
+        try:
+            sock.connect(settings.ROUTING_SOCKET)
+        except OSError:
+            sock.close()
+            raise
+        _local.sock = sock
+    return sock
+
+
+def _close():
+    sock = getattr(_local, "sock", None)
+    _local.sock = None
+    if sock is not None:
+        sock.close()
+
+
+def ask_daemon(pairs, weight):
+    """The daemon's answer to the queries, raises OSError if it can't be reached"""
+    payload = encode_queries(pairs, weight)
+    sock = _connection()
+    try:
+        sock.sendall(LENGTH.pack(len(payload)) + payload)
+        (size,) = LENGTH.unpack(recv_exactly(sock, LENGTH.size))
+        return decode_routes(recv_exactly(sock, size), len(pairs))[1]
+    except (OSError, struct.error):
+        # A half read answer would be read as the next one, start over
+        _close()
+        raise
+
+
+def routes_in_process(pairs, weight):
+    from .network import get_graph
+    from .route_table import shortest_route as table_route
+
+    graph = get_graph()
+    routes = []
+    for start_id, end_id in pairs:
+        try:
+            routes.append(table_route(start_id, end_id, weight, graph=graph))
+        except ValueError:
+            routes.append(None)
+    return routes
+
+
+def routes(pairs, weight="distance"):
+    """
+    Shortest routes for a list of (start_id, end_id) pairs, in one round trip to the daemon.
+    Returns a network.Route, or None if the stations are not connected, for each pair.
+    """
+    global _down_until
+
+    pairs = list(pairs)
+    if not settings.ROUTING_SOCKET or time.monotonic() < _down_until:
+        return routes_in_process(pairs, weight)
+
+    results = []
+    try:
+        for start in range(0, len(pairs), MAX_QUERIES):
+            results += ask_daemon(pairs[start : start + MAX_QUERIES], weight)
+    except (OSError, struct.error) as e:
+        logger.warning("Routing daemon unavailable, routing in-process: %s", e)
+        _down_until = time.monotonic() + settings.ROUTING_DAEMON_RETRY_SECONDS
+        return routes_in_process(pairs, weight)
+
+    # The daemon couldn't answer some queries (ex. it lost its database connection)
+    failed = [i for i, route in enumerate(results) if route is ERROR]
+    if failed:
+        for i, route in zip(
+            failed, routes_in_process([pairs[i] for i in failed], weight)
+        ):
+            results[i] = route
+    return results
+
+
+def shortest_route(start_id, end_id, weight="distance"):
+    """
+    Same as route_table.shortest_route, through the daemon when there is one.
+    Returns a network.Route, raises ValueError if the stations are not connected.
+    """
+    route = routes([(start_id, end_id)], weight)[0]
+    if route is None:
+        raise ValueError(f"No route possible from {start_id} to {end_id}")
+    return route
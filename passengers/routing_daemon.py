@@ -0,0 +1,193 @@
+"""
+Routing daemon: one process per host holds the network and answers the routing queries of every
+web worker over a Unix socket (see routing_client.py for the protocol). Started with the
+routing_daemon management command.
+
+Queries arriving from all the connections within settings.ROUTING_BATCH_WINDOW seconds are
+answered together, by a single routing thread: the network version is checked once per batch
+(get_graph() reloads the network or applies the new line mask when it changed), and a pair asked
+several times in the batch is only routed once.
+
+The contraction hierarchies are built (if missing) and loaded by prepare() before the socket
+accepts connections: until then the web workers route in-process, instead of all waiting on the
+first batches and timing out together. When the network changes in a way the loaded hierarchies
+don't cover (new stations or connections, a line reopened), HierarchyBuilder builds the new ones
+in a background thread; the batches keep being answered meanwhile, with Dijkstra wherever the
+previous hierarchy can't be used.
+"""
+import asyncio
+import logging
+import os
+import socket
+import stat
+from concurrent.futures import ThreadPoolExecutor
+
+from django.db import close_old_connections
+
+from .contraction_hierarchy import build_hierarchies, get_hierarchy
+from .network import WEIGHTS, get_graph
+from .route_table import shortest_route
+from .routing_client import (
+    ERROR,
+    LENGTH,
+    ProtocolError,
+    decode_queries,
+    encode_routes,
+)
+
+logger = logging.getLogger(__name__)
+
+
+def prepare(graph):
+    """
+    Builds the missing hierarchies of graph's version and loads them all. Yields (weight,
+    seconds taken to build, 0 if the file existed)
+    """
+    for weight, _, _, elapsed in build_hierarchies(graph):
+        get_hierarchy(weight, graph)
+        yield weight, elapsed
+
+
+class HierarchyBuilder:
+    """
+    Builds the hierarchies of a graph in a background thread, one build at a time. A build that
+    failed isn't tried again for the same network version.
+    """
+
+    def __init__(self):
+        self.executor = ThreadPoolExecutor(1, thread_name_prefix="hierarchies")
+        self.building = None
+        self.failed_version = None
+
+    def check(self, graph):
+        """Starts a build unless one is running, or the loaded hierarchies cover graph"""
+        if self.building is not None and not self.building.done():
+            return
+        if graph.version == self.failed_version:
+            return
+        if all(get_hierarchy(weight, graph) is not None for weight in WEIGHTS):
+            return
+        self.building = self.executor.submit(self.build, graph)
+
+    def build(self, graph):
+        try:
+            for weight, elapsed in prepare(graph):
+                if elapsed:
+                    logger.info(
+                        "Built the %s hierarchy of network version %s in %.2fs",
+                        weight,
+                        graph.version,
+                        elapsed,
+                    )
+        except Exception:
+            logger.exception(
+                "Could not build the hierarchies of network version %s", graph.version
+            )
+            self.failed_version = graph.version
+
+    def shutdown(self):
+        self.executor.shutdown()
+
+
+def answer_batch(requests, builder=None):
+    """
+    Takes a list of decoded requests, returns one encoded response per request. builder, if
+    given, is told about the graph the batch is answered with.
+    """
+    close_old_connections()
+    try:
+        graph = get_graph()
+    except Exception:
+        logger.exception("Could not load the network")
+        return [encode_routes(0, [ERROR] * len(queries)) for queries in requests]
+
+    if builder is not None:
+        builder.check(graph)
+
+    answers = {}
+    for queries in requests:
+        for query in queries:
+            if query in answers:
+                continue
+            start_id, end_id, weight = query
+            try:
+                answers[query] = shortest_route(start_id, end_id, weight, graph=graph)
+            except ValueError:
+                answers[query] = None
+            except Exception:
+                logger.exception("Could not route %s", query)
+                answers[query] = ERROR
+
+    return [
+        encode_routes(graph.version, [answers[query] for query in queries])
+        for queries in requests
+    ]
+
+
+class RoutingServer:
+    def __init__(self, path, batch_window):
+        self.path = path
+        self.batch_window = batch_window
+        # (decoded request, future of the encoded response)
+        self.pending = []
+        self.wakeup = asyncio.Event()
+        # The routing data isn't thread safe to build, and the searches are CPU bound anyway
+        self.executor = ThreadPoolExecutor(1, thread_name_prefix="routing")
+        self.builder = HierarchyBuilder()
+
+    async def serve(self):
+        if os.path.exists(self.path) and stat.S_ISSOCK(os.stat(self.path).st_mode):
+            os.unlink(self.path)
+
+        sock = socket.socket(socket.AF_UNIX, socket.SOCK_STREAM)
+        sock.bind(self.path)
+        # Only the web workers (same user or group) may connect. Set before listening: nothing
+        # can connect to the socket until then
+        os.chmod(self.path, 0o660)
+        sock.listen()
+        server = await asyncio.start_unix_server(self.handle, sock=sock)
+        logger.info("Routing daemon listening on %s", self.path)
+
+        async with server:
+            await asyncio.gather(server.serve_forever(), self.answer_batches())
+
+    async def handle(self, reader, writer):
+        loop = asyncio.get_running_loop()
+        try:
+            while True:
+                (size,) = LENGTH.unpack(await reader.readexactly(LENGTH.size))
+                queries = decode_queries(await reader.readexactly(size))
+
+                response = loop.create_future()
+                self.pending.append((queries, response))
+                self.wakeup.set()
+
+                payload = await response
+                writer.write(LENGTH.pack(len(payload)) + payload)
+                await writer.drain()
+        except (asyncio.IncompleteReadError, ConnectionError):
+            pass
+        except ProtocolError as e:
+            logger.warning("Closing connection: %s", e)
+        finally:
+            writer.close()
+
+    async def answer_batches(self):
+        loop = asyncio.get_running_loop()
+        while True:
+            await self.wakeup.wait()
+            # Lets the queries sent at about the same time join the batch
+            await asyncio.sleep(self.batch_window)
+
+            batch, self.pending = self.pending, []
+            self.wakeup.clear()
+
+            payloads = await loop.run_in_executor(
+                self.executor,
+                answer_batch,
+                [queries for queries, _ in batch],
+                self.builder,
+            )
+            for (queries, response), payload in zip(batch, payloads):
+                if not response.cancelled():
+                    response.set_result(payload)
@@ -1,11 +1,35 @@
 """
 Google Sign In
+Network versioning: any change to the railway network invalidates the precomputed routing data
 """
 from allauth.account.signals import user_signed_up
+from django.db.models.signals import post_delete, post_save
 from django.dispatch import receiver
-from .models import Passenger
+from .models import Passenger, Station, Line, Connection
+from .network import bump_network_version
 
 
 @receiver(user_signed_up)
 def create_passenger_on_signup(request, user, **kwargs):
     Passenger.objects.create(user=user, bank_balance=0)
+
+
+@receiver(post_save, sender=Connection)
+@receiver(post_delete, sender=Connection)
+def network_changed(sender, **kwargs):
+    bump_network_version()
+
+
+@receiver(post_save, sender=Station)
+@receiver(post_delete, sender=Station)
+def station_changed(sender, **kwargs):
+    bump_network_version(stations=True)
+
+
+# Saving a Line (ex. toggling is_active in the admin) doesn't change any connection, so the
+# routing code only has to apply the new line mask. Deleting a Line deletes its connections,
+# which bump the topology through network_changed.
+@receiver(post_save, sender=Line)
+@receiver(post_delete, sender=Line)
+def line_changed(sender, **kwargs):
+    bump_network_version(topology=False)
@@ -0,0 +1,103 @@
+"""
+Station autocomplete backed by an in-memory sorted array.
+
+Every word of every station name starts a search key (so "cen" finds both "Central" and
+"Grand Central"), and the keys are kept sorted. A prefix query is a binary search for the first
+key that could match followed by a short forward scan, so it takes microseconds no matter how
+big the network gets.
+
+The index is rebuilt from the station catalogue (catalogue.py) when the stations version
+changes. To keep the endpoint free of database round trips, the version is only rechecked every
+INDEX_RECHECK_SECONDS.
+"""
+import bisect
+import threading
+import time
+import unicodedata
+
+from .catalogue import get_station_catalogue, get_stations_state
+
+INDEX_RECHECK_SECONDS = 5
+
+# Upper bound of the results per query
+MAX_RESULTS = 50
+
+_index = None
+_index_lock = threading.Lock()
+
+
+def normalize(text):
+    """Lowercase and without accents, so "sao" matches "São"""
+    decomposed = unicodedata.normalize("NFKD", text.casefold())
+    return "".join(c for c in decomposed if not unicodedata.combining(c))
+
+
+class StationIndex:
+    """
+    Sorted array of (key, position of the word in the name, station id, name).
+    Matches at the start of a name sort before matches on a later word of the same key.
+    """
+
+    def __init__(self, version, catalogue):
+        self.version = version
+        self.checked_at = time.monotonic()
+
+        entries = []
+        for station in catalogue:
+            name = normalize(station["name"])
+            words = name.split()
+            start = 0
+            for position, word in enumerate(words):
+                start = name.index(word, start)
+                entries.append((name[start:], position, station["id"], station["name"]))
+                start += len(word)
+
+        entries.sort()
+        self.entries = entries
+        self.keys = [entry[0] for entry in entries]
+
+    def search(self, query, limit=10):
+        """Returns up to limit [{"id": ..., "name": ...}] whose name has a word starting with query"""
+        query = normalize(query).strip()
+        if not query:
+            return []
+
+        results = []
+        seen = set()
+        i = bisect.bisect_left(self.keys, query)
+
+        while i < len(self.keys) and len(results) < limit:
+            key, _, station_id, name = self.entries[i]
+            if not key.startswith(query):
+                break
+            if station_id not in seen:
+                seen.add(station_id)
+                results.append({"id": station_id, "name": name})
+            i += 1
+
+        return results
+
+
+def get_station_index():
+    """Returns the index for the current stations version, rebuilding it if they changed"""
+    global _index
+
+    index = _index
+    if (
+        index is not None
+        and time.monotonic() - index.checked_at < INDEX_RECHECK_SECONDS
+    ):
+        return index
+
+    with _index_lock:
+        version = get_stations_state()[0]
+        if _index is None or _index.version != version:
+            _index = StationIndex(version, get_station_catalogue(version))
+        else:
+            _index.checked_at = time.monotonic()
+
+    return _index
+
+
+def search_stations(query, limit=10):
+    return get_station_index().search(query, min(limit, MAX_RESULTS))
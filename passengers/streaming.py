@@ -0,0 +1,31 @@
+"""
+Helpers for streaming large CSV/JSONL responses without building them in memory.
+
+csv.writer wants a file to write to, Echo hands every formatted line straight back so it can be
+yielded to StreamingHttpResponse (or written to stdout by a management command) one row at a
+time.
+"""
+import csv
+import json
+
+from django.core.serializers.json import DjangoJSONEncoder
+
+
+class Echo:
+    """Pseudo-buffer that returns what is written to it instead of storing it"""
+
+    def write(self, value):
+        return value
+
+
+def csv_lines(rows):
+    """Formats an iterable of rows as CSV lines, lazily"""
+    writer = csv.writer(Echo())
+    for row in rows:
+        yield writer.writerow(row)
+
+
+def jsonl_lines(header, rows):
+    """Formats an iterable of rows as one JSON object per line, keyed by header, lazily"""
+    for row in rows:
+        yield json.dumps(dict(zip(header, row)), cls=DjangoJSONEncoder) + "\n"
@@ -0,0 +1,132 @@
+"""
+Sweeper for abandoned purchases.
+
+Every purchase attempt saves a pending ticket and every visit of the confirmation page an OTP.
+Attempts that are never confirmed leave both behind, so the sweeper deletes:
+    pending tickets older than settings.PENDING_TICKET_TIMEOUT_MINUTES (recorded as "deleted"
+    in the ticket change feed)
+    OTPs older than their validity (models.EXPIRYLIMIT minutes), which can't be used anymore
+
+Rows are deleted in batches ordered by id (keyset pagination: each batch starts after the last
+id of the previous one, rows already looked at are never scanned again), one short transaction
+per batch. The rows are locked when selected and deleted with the same conditions, so a ticket
+confirmed in the meantime is never deleted.
+
+Several nodes can run the sweeper at the same time: on Postgres each task takes an advisory
+lock, and a node that doesn't get it skips the task instead of deleting the same rows.
+"""
+import logging
+import time
+import zlib
+from contextlib import contextmanager
+from datetime import timedelta
+
+from django.conf import settings
+from django.db import connection, transaction
+from django.utils import timezone
+
+from .models import EXPIRYLIMIT, OTP, Passenger, Ticket, TicketChange
+
+logger = logging.getLogger(__name__)
+
+
+@contextmanager
+def advisory_lock(name):
+    """
+    Yields True if this process holds the lock for name, False if another one does. Only
+    Postgres has advisory locks, other databases always get it.
+    """
+    if connection.vendor != "postgresql":
+        yield True
+        return
+
+    key = zlib.crc32(name.encode())
+    with connection.cursor() as cursor:
+        cursor.execute("SELECT pg_try_advisory_lock(%s)", [key])
+        acquired = cursor.fetchone()[0]
+    try:
+        yield acquired
+    finally:
+        if acquired:
+            with connection.cursor() as cursor:
+                cursor.execute("SELECT pg_advisory_unlock(%s)", [key])
+
+
+def delete_in_batches(queryset, batch_size, before_delete=None):
+    """
+    Deletes the rows of queryset in batches of batch_size, ordered by id. before_delete(ids) is
+    called in the transaction of each batch. Returns (rows deleted, batches).
+    """
+    deleted = 0
+    batches = 0
+    last_id = 0
+
+    while True:
+        with transaction.atomic():
+            batch = queryset.filter(id__gt=last_id).order_by("id")
+            if connection.features.has_select_for_update_skip_locked:
+                batch = batch.select_for_update(skip_locked=True)
+            ids = list(batch.values_list("id", flat=True)[:batch_size])
+            if not ids:
+                break
+
+            if before_delete is not None:
+                before_delete(ids)
+            queryset.filter(id__in=ids).delete()
+
+        deleted += len(ids)
+        batches += 1
+        last_id = ids[-1]
+
+    return deleted, batches
+
+
+def sweep_pending_tickets(batch_size):
+    cutoff = timezone.now() - timedelta(minutes=settings.PENDING_TICKET_TIMEOUT_MINUTES)
+    # Purchases always save "pending" in lower case, the status index is used
+    abandoned = Ticket.objects.filter(status="pending", status_changed_at__lt=cutoff)
+
+    def record(ids):
+        TicketChange.record(
+            [(ticket_id, "pending", "deleted", None) for ticket_id in ids]
+        )
+        Passenger.bump_versions(
+            Ticket.objects.filter(id__in=ids).values("passenger_id")
+        )
+
+    return delete_in_batches(abandoned, batch_size, record)
+
+
+def sweep_otps(batch_size):
+    cutoff = timezone.now() - timedelta(minutes=EXPIRYLIMIT)
+    return delete_in_batches(OTP.objects.filter(creation_date__lt=cutoff), batch_size)
+
+
+TASKS = {
+    "pending_tickets": sweep_pending_tickets,
+    "otps": sweep_otps,
+}
+
+
+def sweep(batch_size=None):
+    """
+    Runs every task, returns {task: {"deleted", "batches", "seconds", "skipped"}}. A task is
+    skipped when another node holds its lock.
+    """
+    batch_size = batch_size or settings.SWEEP_BATCH_SIZE
+    metrics = {}
+
+    for name, task in TASKS.items():
+        started = time.perf_counter()
+        with advisory_lock(f"sweeper:{name}") as acquired:
+            deleted, batches = task(batch_size) if acquired else (0, 0)
+
+        metrics[name] = {
+            "deleted": deleted,
+            "batches": batches,
+            "seconds": round(time.perf_counter() - started, 3),
+            "skipped": not acquired,
+        }
+        logger.info("Sweeper %s: %s", name, metrics[name])
+
+    return metrics
@@ -1,3 +1,1623 @@
-from django.test import TestCase
+"""
+Query and routing budgets of the busiest pages.
 
-# Create your tests here.
+Every page is requested against the seeded network, then again once the data has grown (more
+stations, passengers and tickets, the logged in passenger's included). Both requests must make
+the same number of SQL queries and routing calls, and stay within the page's budget: a page
+whose cost grows with the data (ex. one query per row) fails whatever the size of the fixture.
+
+ApiTests also cover the conditional requests of the JSON API (api.py), AuthenticationTests
+cover loading the user and passenger of a session (see backends.py). ContractionHierarchyTests
+check the hierarchy against Dijkstra on random networks, RouteTableTests the incremental updates
+of the route table against full rebuilds. The other test cases cover the offline tasks on a small
+network (see build_network), ArchiveTests the archival of expired tickets and the TicketHistory
+view over both tables, SweeperTests the deletion of abandoned purchases, RepricingTests and
+ConfirmationTests the fares of pending tickets and their confirmation, AlternativeRoutesTests
+the k shortest paths against every path of small random networks, RoutingDaemonTests the routing
+daemon and its client, ImportNetworkTests the import_network command, StationSearchTests the
+station autocomplete, TicketExportTests the passengers' ticket downloads.
+"""
+import asyncio
+import io
+import json
+import os
+import random
+import stat
+import tempfile
+import threading
+import time
+from contextlib import ExitStack
+from datetime import timedelta
+from decimal import Decimal
+from unittest import mock
+
+from django.conf import settings
+from django.contrib.auth import BACKEND_SESSION_KEY, SESSION_KEY
+from django.contrib.auth.models import User
+from django.core.cache import cache
+from django.core.management import CommandError, call_command
+from django.db import DatabaseError, connections, transaction
+from django.test import SimpleTestCase, TestCase, override_settings
+from django.test.utils import CaptureQueriesContext
+from django.urls import reverse
+from django.utils import timezone
+
+from . import (
+    alternatives,
+    archive,
+    contraction_hierarchy,
+    disruption,
+    network,
+    pathfinder,
+    repricing,
+    route_table,
+    routing_client,
+    routing_daemon,
+    station_search,
+    sweeper,
+)
+from .changes import changes_since
+from .contraction_hierarchy import ContractionHierarchy, build_hierarchies, query_route
+from .loadtest import PASSWORD, seed_network, seed_passengers
+from .models import (
+    EXPIRYLIMIT,
+    OTP,
+    ArchivedTicket,
+    Connection,
+    Line,
+    Passenger,
+    Station,
+    Ticket,
+    TicketChange,
+)
+from .network_import import NetworkImporter
+from .route_table import RouteTable
+from .ticket_export import EXPORT_HEADER, export_response
+
+STATIONS = 40
+PASSENGERS = 10
+TICKETS = 20
+
+# Added by grow()
+MORE_STATIONS = 200
+MORE_PASSENGERS = 50
+MORE_TICKETS = 500
+
+
+@override_settings(
+    SECURE_SSL_REDIRECT=False,
+    SESSION_COOKIE_SECURE=False,
+    CSRF_COOKIE_SECURE=False,
+    # As deployed with REDIS_URL: the budgets don't include reading the session
+    SESSION_ENGINE="django.contrib.sessions.backends.cached_db",
+)
+class QueryBudgetTestCase(TestCase):
+    """
+    Base class of the budget tests. self.passenger is logged in (self.login_staff() switches to
+    a superuser with a passenger too), and owns TICKETS active tickets.
+    """
+
+    # The changelists use replica_reads. Inside the test's transaction the router keeps their
+    # reads on the primary, but the replica aliases must be allowed for it to be asked
+    databases = "__all__"
+
+    @classmethod
+    def setUpTestData(cls):
+        cls.stations = seed_network(STATIONS)
+        usernames = seed_passengers(PASSENGERS)
+        cls.passenger = Passenger.objects.select_related("user").get(
+            user__username=usernames[0]
+        )
+        cls.staff = User.objects.create_superuser(
+            "staff", "staff@example.com", PASSWORD
+        )
+        Passenger.objects.create(user=cls.staff, bank_balance=Decimal("1000"))
+
+        passengers = list(Passenger.objects.all())
+        cls.add_tickets(cls.stations, passengers, TICKETS)
+
+    @classmethod
+    def add_tickets(cls, stations, passengers, count):
+        """count active tickets for self.passenger and for each of passengers, between stations"""
+        Ticket.objects.bulk_create(
+            Ticket(
+                passenger=passenger,
+                start_station_id=stations[i % len(stations)],
+                destination_id=stations[(i + 1) % len(stations)],
+                cost=Decimal("2.50"),
+                status="active",
+            )
+            for passenger in {cls.passenger, *passengers}
+            for i in range(count)
+        )
+
+    def setUp(self):
+        # Routing data and the station catalogue are cached per network version, which starts
+        # over with every test's database
+        cache.clear()
+        network._graph = None
+        route_table._tables.clear()
+        contraction_hierarchy._hierarchies.clear()
+        contraction_hierarchy._missing.clear()
+        self.client.force_login(self.passenger.user)
+
+    def login_staff(self):
+        self.client.force_login(self.staff)
+
+    def grow(self):
+        stations = seed_network(MORE_STATIONS)
+        usernames = seed_passengers(PASSENGERS + MORE_PASSENGERS)[PASSENGERS:]
+        passengers = list(Passenger.objects.filter(user__username__in=usernames))
+        self.add_tickets(stations, passengers, MORE_TICKETS // 10)
+        self.add_tickets(self.stations, [self.passenger], MORE_TICKETS)
+        ArchivedTicket.objects.bulk_create(
+            ArchivedTicket(
+                id=ticket.id,
+                passenger_id=ticket.passenger_id,
+                start_station_id=ticket.start_station_id,
+                destination_id=ticket.destination_id,
+                cost=ticket.cost,
+                status="Expired",
+                status_changed_at=ticket.status_changed_at,
+            )
+            for ticket in Ticket.objects.filter(passenger=self.passenger)[
+                : MORE_TICKETS // 2
+            ]
+        )
+        Ticket.objects.filter(
+            id__in=ArchivedTicket.objects.values_list("id", flat=True)
+        ).delete()
+
+    def measure(self, request, prepare=None):
+        """
+        (queries, routing calls) made by request(prepare()), once the caches are warm.
+        prepare's own queries aren't counted.
+        """
+        for counted in (False, True):
+            argument = prepare() if prepare else None
+            if not counted:
+                request(*([argument] if prepare else []))
+                continue
+
+            with ExitStack() as stack:
+                captured = [
+                    stack.enter_context(CaptureQueriesContext(connections[alias]))
+                    for alias in connections
+                ]
+                routes = stack.enter_context(
+                    mock.patch.object(
+                        routing_client, "routes", wraps=routing_client.routes
+                    )
+                )
+                response = request(*([argument] if prepare else []))
+
+        self.assertLess(response.status_code, 400, response)
+        return sum(len(queries) for queries in captured), routes.call_count
+
+    def assertWithinBudget(self, request, queries, routing_calls=0, prepare=None):
+        before = self.measure(request, prepare)
+        self.grow()
+        after = self.measure(request, prepare)
+
+        self.assertEqual(before, after, "(queries, routing calls) grow with the data")
+        self.assertLessEqual(after[0], queries, "SQL queries")
+        self.assertLessEqual(after[1], routing_calls, "routing calls")
+
+
+class PassengerPagesTests(QueryBudgetTestCase):
+    def pending_ticket(self):
+        return Ticket.objects.create(
+            passenger=self.passenger,
+            start_station_id=self.stations[0],
+            destination_id=self.stations[-1],
+            cost=Decimal("10"),
+            status="pending",
+        )
+
+    def test_dashboard(self):
+        self.assertWithinBudget(lambda: self.client.get(reverse("dashboard")), 2)
+
+    def test_purchase_page(self):
+        self.assertWithinBudget(lambda: self.client.get(reverse("purchase")), 2)
+
+    def test_purchase(self):
+        self.assertWithinBudget(
+            lambda: self.client.post(
+                reverse("purchase"),
+                {
+                    "start_station": self.stations[0],
+                    "destination_station": self.stations[-1],
+                },
+            ),
+            13,
+            routing_calls=1,
+        )
+
+    def test_purchase_page_not_modified(self):
+        # The first response sets the CSRF cookie, the page is only validated once it has one
+        self.assertFalse(
+            self.client.get(reverse("purchase")).has_header("Last-Modified")
+        )
+        response = self.client.get(reverse("purchase"))
+        headers = {
+            "if_none_match": response["ETag"],
+            "if_modified_since": response["Last-Modified"],
+        }
+        self.assertEqual(
+            self.client.get(reverse("purchase"), headers=headers).status_code, 304
+        )
+
+        # A client without the CSRF cookie must get the page, and the cookie, again
+        del self.client.cookies[settings.CSRF_COOKIE_NAME]
+        response = self.client.get(
+            reverse("purchase"),
+            headers={"if_modified_since": headers["if_modified_since"]},
+        )
+        self.assertEqual(response.status_code, 200)
+        self.assertIn(settings.CSRF_COOKIE_NAME, response.cookies)
+
+    def test_export_tickets(self):
+        def export():
+            response = self.client.get(reverse("export-tickets"))
+            # The rows are only read while the response is streamed
+            response.getvalue()
+            return response
+
+        self.assertWithinBudget(export, 2)
+
+    def test_confirmation_page(self):
+        self.assertWithinBudget(
+            lambda ticket: self.client.get(reverse("confirmation", args=[ticket.id])),
+            5,
+            prepare=self.pending_ticket,
+        )
+
+    def test_confirmation(self):
+        def prepare():
+            OTP.objects.create(user=self.passenger, code="123456")
+            return self.pending_ticket()
+
+        self.assertWithinBudget(
+            lambda ticket: self.client.post(
+                reverse("confirmation", args=[ticket.id]), {"otp": "123456"}
+            ),
+            # Including the passenger and ticket locked again, and the savepoint around them
+            16,
+            prepare=prepare,
+        )
+
+
+class AdminChangelistTests(QueryBudgetTestCase):
+    def setUp(self):
+        super().setUp()
+        self.login_staff()
+
+    def assertChangelistWithinBudget(self, model, queries):
+        # Budgets include the row estimate the large tables' paginators ask Postgres for
+        url = reverse(f"admin:passengers_{model._meta.model_name}_changelist")
+        self.assertWithinBudget(lambda: self.client.get(url), queries)
+
+    def test_tickets(self):
+        self.assertChangelistWithinBudget(Ticket, 4)
+
+    def test_archived_tickets(self):
+        self.assertChangelistWithinBudget(ArchivedTicket, 4)
+
+    def test_stations(self):
+        self.assertChangelistWithinBudget(Station, 6)
+
+    def test_connections(self):
+        self.assertChangelistWithinBudget(Connection, 5)
+
+    def test_lines(self):
+        self.assertChangelistWithinBudget(Line, 4)
+
+    def test_passengers(self):
+        self.assertChangelistWithinBudget(Passenger, 4)
+
+
+class ApiTests(QueryBudgetTestCase):
+    def get(self, name, etag=None, **params):
+        headers = {"if_none_match": etag} if etag else {}
+        return self.client.get(reverse(f"api:{name}"), params, headers=headers)
+
+    def post(self, url, data):
+        return self.client.post(url, data, content_type="application/json")
+
+    def purchase(self):
+        return self.post(
+            reverse("api:purchase"),
+            {"start": self.stations[0], "destination": self.stations[-1]},
+        )
+
+    def test_balance(self):
+        self.assertWithinBudget(lambda: self.get("balance"), 1)
+
+    def test_tickets(self):
+        self.assertWithinBudget(lambda: self.get("tickets"), 2)
+
+    def test_stations(self):
+        self.assertWithinBudget(lambda: self.get("stations"), 2)
+
+    def test_quote(self):
+        self.assertWithinBudget(
+            lambda: self.get(
+                "quote", start=self.stations[0], destination=self.stations[-1]
+            ),
+            3,
+            routing_calls=1,
+        )
+
+    def test_purchase(self):
+        self.assertWithinBudget(self.purchase, 12, routing_calls=1)
+
+    def test_confirm(self):
+        def prepare():
+            OTP.objects.create(user=self.passenger, code="123456")
+            return self.purchase().json()["ticket"]["id"]
+
+        self.assertWithinBudget(
+            lambda ticket_id: self.post(
+                reverse("api:confirm", args=[ticket_id]), {"otp": "123456"}
+            ),
+            15,
+            prepare=prepare,
+        )
+
+    def test_not_modified_until_the_balance_changes(self):
+        response = self.get("balance")
+        etag = response["ETag"]
+
+        not_modified = self.get("balance", etag)
+        self.assertEqual(not_modified.status_code, 304)
+        self.assertEqual(not_modified.content, b"")
+
+        self.client.post(reverse("money"), {"amount": "5"})
+        response = self.get("balance", etag)
+        self.assertEqual(response.status_code, 200)
+        self.assertNotEqual(response["ETag"], etag)
+        self.assertEqual(
+            Decimal(response.json()["balance"]),
+            self.passenger.bank_balance + Decimal("5"),
+        )
+
+    def test_purchase_and_confirm(self):
+        etag = self.get("tickets")["ETag"]
+        ticket = self.purchase().json()["ticket"]
+        self.assertEqual(ticket["status"], "pending")
+        self.assertEqual(self.get("tickets", etag).status_code, 200)
+
+        otp = OTP.objects.filter(user=self.passenger).last()
+        url = reverse("api:confirm", args=[ticket["id"]])
+        self.assertEqual(self.post(url, {"otp": "wrong"}).status_code, 400)
+
+        response = self.post(url, {"otp": otp.code}).json()
+        self.assertEqual(response["ticket"]["status"], "active")
+        self.assertEqual(
+            Decimal(response["balance"]),
+            self.passenger.bank_balance - Decimal(ticket["cost"]),
+        )
+        self.assertEqual(self.post(url, {"otp": otp.code}).status_code, 409)
+
+    def test_ticket_pages_and_fields(self):
+        first = self.get("tickets", fields="id,status", limit=5).json()
+        self.assertEqual(len(first["tickets"]), 5)
+        self.assertEqual(set(first["tickets"][0]), {"id", "status"})
+
+        second = self.get("tickets", fields="id", limit=5, before=first["next"]).json()
+        self.assertLess(second["tickets"][0]["id"], first["tickets"][-1]["id"])
+
+        self.assertEqual(self.get("tickets", fields="id,password").status_code, 400)
+
+    def test_anonymous(self):
+        self.client.logout()
+        self.assertEqual(self.get("balance").status_code, 401)
+
+
+@override_settings(
+    SECURE_SSL_REDIRECT=False, SESSION_COOKIE_SECURE=False, CSRF_COOKIE_SECURE=False
+)
+class AuthenticationTests(TestCase):
+    def test_user_without_passenger_is_logged_out(self):
+        user = User.objects.create_user("nopassenger", password=PASSWORD)
+        self.client.force_login(user)
+
+        response = self.client.get(reverse("dashboard"))
+
+        self.assertRedirects(
+            response, reverse("passenger-login"), fetch_redirect_response=False
+        )
+        self.assertNotIn(SESSION_KEY, self.client.session)
+
+    def test_session_of_a_previous_backend(self):
+        user = User.objects.create_user("legacy", password=PASSWORD)
+        Passenger.objects.create(user=user)
+        self.client.force_login(user, "django.contrib.auth.backends.ModelBackend")
+
+        response = self.client.get(reverse("dashboard"))
+
+        self.assertEqual(response.status_code, 200)
+        self.assertEqual(
+            self.client.session[BACKEND_SESSION_KEY], "passengers.backends.ModelBackend"
+        )
+
+
+def random_graph(stations, edges, lines=5, seed=0, version=1, disabled_lines=()):
+    """NetworkGraph of random connections, some stations are left unconnected"""
+    rng = random.Random(seed)
+    return network.NetworkGraph(
+        version,
+        [
+            network.Edge(
+                cid,
+                rng.randint(1, lines),
+                *rng.sample(range(1, stations + 1), 2),
+                round(rng.uniform(0.5, 10), 2),
+                Decimal(rng.randint(50, 500)) / 100,
+                rng.randint(1, 10),
+            )
+            for cid in range(1, edges + 1)
+        ],
+        topology_version=1,
+        disabled_lines=frozenset(disabled_lines),
+    )
+
+
+class ContractionHierarchyTests(SimpleTestCase):
+    STATIONS = 80
+
+    def setUp(self):
+        contraction_hierarchy._hierarchies.clear()
+        contraction_hierarchy._missing.clear()
+        self.addCleanup(contraction_hierarchy._hierarchies.clear)
+        self.addCleanup(contraction_hierarchy._missing.clear)
+
+        routing_data = tempfile.TemporaryDirectory()
+        self.addCleanup(routing_data.cleanup)
+        routing_settings = override_settings(ROUTING_DATA_DIR=routing_data.name)
+        routing_settings.enable()
+        self.addCleanup(routing_settings.disable)
+
+    def pairs(self, seed):
+        rng = random.Random(seed)
+        return [tuple(rng.sample(range(1, self.STATIONS + 1), 2)) for _ in range(300)]
+
+    def dijkstra_weight(self, graph, start_id, end_id, weight):
+        try:
+            return pathfinder.dijkstra(graph, start_id, end_id, weight)[0]
+        except ValueError:
+            return None
+
+    def route_weight(self, graph, connection_ids, weight):
+        return sum(float(getattr(graph.edges[cid], weight)) for cid in connection_ids)
+
+    def test_same_weights_as_dijkstra(self):
+        for seed in range(5):
+            graph = random_graph(self.STATIONS, 150, seed=seed)
+            for weight in network.WEIGHTS:
+                hierarchy = ContractionHierarchy.build(graph, weight)
+                for start_id, end_id in self.pairs(seed):
+                    with self.subTest(
+                        seed=seed, weight=weight, pair=(start_id, end_id)
+                    ):
+                        expected = self.dijkstra_weight(graph, start_id, end_id, weight)
+                        if expected is None:
+                            with self.assertRaises(ValueError):
+                                hierarchy.query(start_id, end_id)
+                            continue
+
+                        total, connection_ids = hierarchy.query(start_id, end_id)
+                        self.assertAlmostEqual(total, expected)
+                        # The unpacked connections are a real path of that weight
+                        self.assertAlmostEqual(
+                            self.route_weight(graph, connection_ids, weight), expected
+                        )
+                        self.assertEqual(
+                            graph.route(connection_ids).connection_ids, connection_ids
+                        )
+
+    def test_disabled_lines_after_the_build(self):
+        graph = random_graph(self.STATIONS, 150, seed=7)
+        list(build_hierarchies(graph, ["distance"]))
+        hierarchy = contraction_hierarchy.get_hierarchy("distance", graph)
+        disrupted = graph.with_mask(2, {1, 2})
+        # Kept until the hierarchy of the new version is built
+        self.assertIs(
+            contraction_hierarchy.get_hierarchy("distance", disrupted), hierarchy
+        )
+
+        for start_id, end_id in self.pairs(7):
+            expected = self.dijkstra_weight(disrupted, start_id, end_id, "distance")
+            if expected is None:
+                with self.assertRaises(ValueError):
+                    query_route(disrupted, start_id, end_id)
+                continue
+            connection_ids = query_route(disrupted, start_id, end_id)
+            self.assertAlmostEqual(
+                self.route_weight(disrupted, connection_ids, "distance"), expected
+            )
+            self.assertFalse(
+                {disrupted.edges[cid].line_id for cid in connection_ids} & {1, 2}
+            )
+
+    def test_dijkstra_until_the_hierarchy_is_built(self):
+        graph = random_graph(self.STATIONS, 150, seed=3)
+        start_id, end_id = next(
+            pair
+            for pair in self.pairs(3)
+            if self.dijkstra_weight(graph, *pair, "distance") is not None
+        )
+
+        with (
+            mock.patch.object(ContractionHierarchy, "build") as build,
+            self.assertLogs(contraction_hierarchy.logger, "WARNING"),
+        ):
+            self.assertIsNone(contraction_hierarchy.get_hierarchy("distance", graph))
+            connection_ids = query_route(graph, start_id, end_id)
+        build.assert_not_called()
+        self.assertAlmostEqual(
+            self.route_weight(graph, connection_ids, "distance"),
+            self.dijkstra_weight(graph, start_id, end_id, "distance"),
+        )
+
+        list(build_hierarchies(graph, ["distance"]))
+        contraction_hierarchy._missing.clear()
+        self.assertEqual(
+            contraction_hierarchy.get_hierarchy("distance", graph).version,
+            graph.version,
+        )
+
+
+class RouteTableTests(SimpleTestCase):
+    def setUp(self):
+        route_table._tables.clear()
+        self.addCleanup(route_table._tables.clear)
+        # Dijkstra only, without looking for a hierarchy file
+        patcher = mock.patch.object(
+            contraction_hierarchy, "get_hierarchy", return_value=None
+        )
+        patcher.start()
+        self.addCleanup(patcher.stop)
+
+        self.graph = random_graph(60, 120, lines=6, seed=11)
+        rng = random.Random(11)
+        self.pairs = [tuple(rng.sample(range(1, 61), 2)) for _ in range(400)]
+
+    def filled_table(self, graph):
+        table = route_table.RouteTable(graph, "distance", max_size=len(self.pairs))
+        for pair in self.pairs:
+            table.put(graph, pair, route_table.compute_route(graph, pair, "distance"))
+        return table
+
+    def assertSameRoutes(self, table, graph):
+        rebuilt = self.filled_table(graph)
+        for pair in self.pairs:
+            route, expected = table.get(pair), rebuilt.get(pair)
+            with self.subTest(pair=pair, disabled=graph.disabled_lines):
+                if expected is None:
+                    self.assertIsNone(route)
+                else:
+                    self.assertAlmostEqual(route.distance, expected.distance)
+                    self.assertFalse(
+                        RouteTable._lines(graph, route) & graph.disabled_lines
+                    )
+        self.assertEqual(table.by_line, rebuilt.by_line)
+
+    def test_incremental_update_matches_full_rebuild(self):
+        table = self.filled_table(self.graph)
+        for version, disabled in enumerate([{1}, {1, 2}, {2}, set(), {3, 4, 5}], 2):
+            graph = self.graph.with_mask(version, disabled)
+            table = table.updated(graph)
+            self.assertEqual(table.version, version)
+            self.assertSameRoutes(table, graph)
+
+    def test_previous_table_until_the_update_is_published(self):
+        table = self.filled_table(self.graph)
+        route_table._tables["distance"] = table
+        start_id, end_id = next(
+            pair
+            for pair in self.pairs
+            if table.get(pair) and 1 in RouteTable._lines(self.graph, table.get(pair))
+        )
+        graph = self.graph.with_mask(2, {1})
+
+        release = threading.Event()
+        updated = RouteTable.updated
+
+        def slow_update(*args):
+            release.wait(5)
+            return updated(*args)
+
+        with mock.patch.object(RouteTable, "updated", slow_update):
+            self.assertIs(route_table.get_table(graph), table)
+            route = route_table.shortest_route(start_id, end_id, graph=graph)
+            self.assertNotIn(1, RouteTable._lines(graph, route))
+            # The previous table isn't changed
+            self.assertIn(1, RouteTable._lines(graph, table.get((start_id, end_id))))
+
+            update = route_table._updates["distance"]
+            release.set()
+            update.join(5)
+
+        published = route_table.get_table(graph)
+        self.assertEqual(published.version, 2)
+        self.assertEqual(published.get((start_id, end_id)).distance, route.distance)
+
+
+def build_network(lines):
+    """
+    {name: Station} for the stations of lines, {line name: [(start, end, distance, cost), ...]}
+    with station names. Every connection takes a minute.
+    """
+    stations = {}
+    for line_name, connections in lines.items():
+        line = Line.objects.create(name=line_name)
+        for start, end, distance, cost in connections:
+            for name in (start, end):
+                if name not in stations:
+                    stations[name] = Station.objects.create(name=name)
+            Connection.objects.create(
+                line=line,
+                start_station=stations[start],
+                destination_station=stations[end],
+                distance=distance,
+                cost=Decimal(cost),
+                travel_time=1,
+            )
+    return stations
+
+
+@override_settings(
+    SECURE_SSL_REDIRECT=False, SESSION_COOKIE_SECURE=False, CSRF_COOKIE_SECURE=False
+)
+class NetworkTestCase(TestCase):
+    """
+    A passenger and a small network: the Red line A-B-C with a branch B-E, and the longer Blue
+    line A-D-C.
+    """
+
+    LINES = {
+        "Red": [("A", "B", 1, "1"), ("B", "C", 1, "1"), ("B", "E", 1, "1")],
+        "Blue": [("A", "D", 2, "2"), ("D", "C", 2, "2")],
+    }
+
+    @classmethod
+    def setUpTestData(cls):
+        cls.stations = build_network(cls.LINES)
+        cls.red, cls.blue = Line.objects.order_by("id")
+        user = User.objects.create_user("rider", "rider@example.com", PASSWORD)
+        cls.passenger = Passenger.objects.create(user=user, bank_balance=Decimal("100"))
+
+    def setUp(self):
+        cache.clear()
+        network._graph = None
+        route_table._tables.clear()
+        contraction_hierarchy._hierarchies.clear()
+        contraction_hierarchy._missing.clear()
+
+    def ticket(self, start, destination, status="active", cost="10", passenger=None):
+        return Ticket.objects.create(
+            passenger=passenger or self.passenger,
+            start_station=self.stations[start],
+            destination=self.stations[destination],
+            cost=Decimal(cost),
+            status=status,
+        )
+
+    def pair(self, start, destination):
+        return (self.stations[start].id, self.stations[destination].id)
+
+
+class DisruptionTests(NetworkTestCase):
+    def setUp(self):
+        super().setUp()
+        self.ticket("A", "C")
+        self.ticket("A", "C")
+        self.ticket("A", "E", "In Use")
+        # Not on the Red line, or not open
+        self.ticket("D", "C")
+        self.ticket("A", "C", "pending")
+        self.ticket("A", "C", "Expired")
+
+    def test_affected_pairs(self):
+        expected = {
+            # Rerouted on the Blue line
+            self.pair("A", "C"): (2, Decimal("2"), Decimal("4")),
+            # Only reachable on the Red line
+            self.pair("A", "E"): (1, Decimal("2"), None),
+        }
+        self.assertEqual(disruption.affected_pairs([self.red.id]), expected)
+
+        # Same report once the line is disabled
+        self.red.is_active = False
+        self.red.save()
+        self.assertEqual(disruption.affected_pairs([self.red.id]), expected)
+
+    def test_unused_line(self):
+        self.assertEqual(disruption.affected_pairs([Line.objects.create().id]), {})
+
+    def test_rows(self):
+        a, c, e = (self.stations[name].id for name in "ACE")
+        pairs = list(disruption.pair_rows([self.red.id]))
+        self.assertEqual(
+            pairs,
+            [
+                disruption.PAIR_HEADER,
+                [a, "A", c, "C", 2, Decimal("2"), Decimal("4"), "yes"],
+                [a, "A", e, "E", 1, Decimal("2"), "", "no"],
+            ],
+        )
+
+        tickets = list(disruption.ticket_rows([self.red.id]))
+        self.assertEqual(tickets[0], disruption.TICKET_HEADER)
+        self.assertEqual(
+            [(row[2], row[3], row[4], row[-1]) for row in tickets[1:]],
+            [("A", "C", "active", "yes")] * 2 + [("A", "E", "In Use", "no")],
+        )
+
+
+class ChangeFeedTests(NetworkTestCase):
+    def test_changes_since(self):
+        _, start, _ = changes_since(None)
+        ticket = self.ticket("A", "C", "pending")
+        ticket.status = "active"
+        ticket.save()
+
+        rows, cursor, more = changes_since(start)
+        self.assertEqual(
+            [row[1:4] for row in rows],
+            [(ticket.id, "", "pending"), (ticket.id, "pending", "active")],
+        )
+        self.assertFalse(more)
+        self.assertEqual(changes_since(None)[1], cursor)
+        self.assertEqual(changes_since(cursor), ([], cursor, False))
+
+        rows, _, more = changes_since(start, limit=1)
+        self.assertEqual((len(rows), more), (1, True))
+
+    def test_stops_before_uncommitted_changes(self):
+        tickets = [self.ticket("A", "C") for _ in range(4)]
+        changes = list(TicketChange.objects.order_by("seq"))
+        # The snapshot xmax each change was inserted with, transactions below 100 are finished
+        for change, insert_xmax in zip(changes, [50, 150, 90, 200]):
+            change.insert_xmax = insert_xmax
+            change.save()
+
+        with mock.patch("metroapp.commit_order.snapshot_xmin", return_value=100):
+            rows, cursor, _ = changes_since(0)
+            position = changes_since(None)[1]
+
+        # The second change may still have been preceded by a running transaction, but the
+        # third can't have been, so the second is visible already
+        self.assertEqual([row[1] for row in rows], [t.id for t in tickets[:3]])
+        self.assertEqual(cursor, changes[2].seq)
+        self.assertEqual(position, changes[2].seq)
+
+    def test_archived_tickets(self):
+        ticket = self.ticket("A", "C", "Expired")
+        Ticket.objects.filter(id=ticket.id).update(
+            status_changed_at=archive.archive_cutoff() - timedelta(days=1)
+        )
+        _, cursor, _ = changes_since(None)
+
+        self.assertEqual(archive.archive_expired(), 1)
+
+        rows, _, _ = changes_since(cursor)
+        self.assertEqual(
+            [row[1:4] for row in rows], [(ticket.id, "Expired", "archived")]
+        )
+
+
+class ArchiveTests(NetworkTestCase):
+    def setUp(self):
+        super().setUp()
+        self.client.force_login(self.passenger.user)
+
+    def expired(self, start="A", destination="C", days_ago=None):
+        """An expired ticket, old enough to be archived unless days_ago is given"""
+        ticket = self.ticket(start, destination, "Expired")
+        changed_at = (
+            archive.archive_cutoff() - timedelta(days=1)
+            if days_ago is None
+            else timezone.now() - timedelta(days=days_ago)
+        )
+        Ticket.objects.filter(id=ticket.id).update(status_changed_at=changed_at)
+        return ticket
+
+    def test_archive_expired(self):
+        old = self.expired()
+        recent = self.expired(days_ago=0)
+        active = self.ticket("A", "E")
+
+        self.assertEqual(archive.archive_expired(), 1)
+
+        self.assertEqual(
+            set(Ticket.objects.values_list("id", flat=True)), {recent.id, active.id}
+        )
+        archived = ArchivedTicket.objects.get()
+        self.assertEqual(
+            (
+                archived.id,
+                archived.passenger_id,
+                archived.start_station_id,
+                archived.destination_id,
+                archived.cost,
+                archived.status,
+            ),
+            (old.id, self.passenger.id, *self.pair("A", "C"), Decimal("10"), "Expired"),
+        )
+        # Nothing left to move
+        self.assertEqual(archive.archive_expired(), 0)
+
+    def test_batches(self):
+        tickets = [self.expired() for _ in range(5)]
+
+        self.assertEqual(archive.archive_expired(batch_size=2, max_batches=1), 2)
+        self.assertEqual(
+            list(ArchivedTicket.objects.order_by("id").values_list("id", flat=True)),
+            [ticket.id for ticket in tickets[:2]],
+        )
+
+        out = io.StringIO()
+        call_command("archive_tickets", "--batch-size", "2", stdout=out)
+        self.assertIn("Archived 3 tickets", out.getvalue())
+        self.assertFalse(Ticket.objects.exists())
+
+    def test_history_spans_both_tables(self):
+        archived = self.expired("D", "C")
+        active = self.ticket("A", "E")
+        archive.archive_expired()
+
+        history = {ticket.id: ticket for ticket in self.passenger.ticket_history.all()}
+        self.assertEqual(set(history), {archived.id, active.id})
+        self.assertTrue(history[archived.id].archived)
+        self.assertEqual(history[archived.id].start_station_id, self.stations["D"].id)
+        self.assertEqual(history[archived.id].gate_token, "")
+        self.assertFalse(history[active.id].archived)
+        self.assertTrue(history[active.id].gate_token)
+
+        # The passenger's pages and API read the history
+        response = self.client.get(reverse("dashboard"))
+        self.assertEqual(
+            {ticket.id for ticket in response.context["tickets"]},
+            {archived.id, active.id},
+        )
+        response = self.client.get(reverse("api:tickets"), {"fields": "id"})
+        self.assertEqual(
+            response.json()["tickets"], [{"id": active.id}, {"id": archived.id}]
+        )
+
+
+class SweeperTests(NetworkTestCase):
+    def abandoned(self, status="pending"):
+        ticket = self.ticket("A", "C", status)
+        Ticket.objects.filter(id=ticket.id).update(
+            status_changed_at=timezone.now()
+            - timedelta(minutes=settings.PENDING_TICKET_TIMEOUT_MINUTES + 1)
+        )
+        return ticket
+
+    def test_sweep(self):
+        abandoned = self.abandoned()
+        recent = self.ticket("A", "C", "pending")
+        paid = self.abandoned("active")
+        old_otp = OTP.objects.create(user=self.passenger, code="123456")
+        OTP.objects.filter(id=old_otp.id).update(
+            creation_date=timezone.now() - timedelta(minutes=EXPIRYLIMIT + 1)
+        )
+        otp = OTP.objects.create(user=self.passenger, code="654321")
+        version = Passenger.objects.get().version
+
+        metrics = sweeper.sweep(batch_size=10)
+
+        self.assertEqual(
+            {task: (m["deleted"], m["skipped"]) for task, m in metrics.items()},
+            {"pending_tickets": (1, False), "otps": (1, False)},
+        )
+        self.assertEqual(
+            set(Ticket.objects.values_list("id", flat=True)), {recent.id, paid.id}
+        )
+        self.assertEqual(list(OTP.objects.values_list("id", flat=True)), [otp.id])
+        self.assertEqual(
+            TicketChange.objects.filter(ticket_id=abandoned.id)
+            .values_list("previous_status", "status")
+            .last(),
+            ("pending", "deleted"),
+        )
+        self.assertEqual(Passenger.objects.get().version, version + 1)
+
+    def test_batches(self):
+        for _ in range(5):
+            self.abandoned()
+
+        self.assertEqual(
+            sweeper.delete_in_batches(
+                Ticket.objects.filter(status="pending"), batch_size=2
+            ),
+            (5, 3),
+        )
+
+    def test_confirmation_after_the_sweep(self):
+        ticket = self.abandoned()
+        OTP.objects.create(user=self.passenger, code="123456")
+        self.client.force_login(self.passenger.user)
+        page = self.client.get(reverse("confirmation", args=[ticket.id]))
+        self.assertEqual(page.status_code, 200)
+
+        sweeper.sweep()
+        # A copy loaded before the sweep is never saved again
+        ticket.status = "active"
+        with self.assertRaises(DatabaseError), transaction.atomic():
+            ticket.save()
+
+        # Swept while the confirmation was running, after the page loaded the ticket
+        with mock.patch("passengers.views.get_object_or_404", return_value=ticket):
+            response = self.client.post(
+                reverse("confirmation", args=[ticket.id]), {"otp": "123456"}
+            )
+        self.assertRedirects(response, reverse("dashboard"))
+        self.assertFalse(Ticket.objects.exists())
+        self.assertEqual(Passenger.objects.get().bank_balance, Decimal("100"))
+
+    def test_interval(self):
+        with (
+            mock.patch(
+                "passengers.management.commands.sweep.time.sleep",
+                side_effect=[None, KeyboardInterrupt],
+            ),
+            mock.patch(
+                "passengers.management.commands.sweep.close_old_connections"
+            ) as close_old_connections,
+            self.assertRaises(KeyboardInterrupt),
+        ):
+            call_command("sweep", "--interval", "60", stdout=io.StringIO())
+
+        close_old_connections.assert_called_once()
+
+
+class RepricingTests(NetworkTestCase):
+    def test_reprice_pending(self):
+        pending = self.ticket("A", "C", "pending")
+        active = self.ticket("A", "C")
+
+        report = repricing.reprice_pending(chunk_size=1)
+
+        self.assertEqual(
+            (report.tickets, report.repriced, report.unroutable), (1, 1, 0)
+        )
+        # Red line A-B-C
+        self.assertEqual(Ticket.objects.get(id=pending.id).cost, Decimal("2"))
+        self.assertEqual(Ticket.objects.get(id=active.id).cost, Decimal("10"))
+
+    def test_dry_run(self):
+        pending = self.ticket("A", "C", "pending")
+
+        report = repricing.reprice_pending(dry_run=True)
+
+        self.assertEqual(report.repriced, 1)
+        self.assertEqual(Ticket.objects.get(id=pending.id).cost, Decimal("10"))
+
+    def test_unroutable_tickets_are_skipped(self):
+        unroutable = self.ticket("A", "E", "pending")
+        self.red.is_active = False
+        self.red.save()
+
+        report = repricing.reprice_pending()
+
+        self.assertEqual(
+            (report.tickets, report.repriced, report.unroutable), (1, 0, 1)
+        )
+        self.assertEqual(Ticket.objects.get(id=unroutable.id).cost, Decimal("10"))
+        a, e = self.pair("A", "E")
+        self.assertEqual(list(report.rows())[1:], [[a, "A", e, "E", 1, 0, ""]])
+
+
+class ConfirmationTests(NetworkTestCase):
+    def setUp(self):
+        super().setUp()
+        self.client.force_login(self.passenger.user)
+        OTP.objects.create(user=self.passenger, code="123456")
+
+    def confirm(self, ticket):
+        return self.client.post(
+            reverse("confirmation", args=[ticket.id]), {"otp": "123456"}
+        )
+
+    def test_confirm(self):
+        ticket = self.ticket("A", "C", "pending")
+
+        self.assertRedirects(self.confirm(ticket), reverse("dashboard"))
+
+        self.assertEqual(Ticket.objects.get().status, "active")
+        self.assertEqual(Passenger.objects.get().bank_balance, Decimal("90"))
+
+    def test_insufficient_balance(self):
+        ticket = self.ticket("A", "C", "pending", cost="60")
+        # Spent by another purchase since the page was loaded
+        Passenger.objects.update(bank_balance=Decimal("50"))
+
+        response = self.confirm(ticket)
+
+        self.assertContains(response, "Insufficient balance")
+        self.assertEqual(Ticket.objects.get().status, "pending")
+        self.assertEqual(Passenger.objects.get().bank_balance, Decimal("50"))
+
+    def test_confirmed_twice(self):
+        ticket = self.ticket("A", "C", "pending")
+        self.confirm(ticket)
+
+        response = self.confirm(ticket)
+
+        self.assertRedirects(response, reverse("dashboard"))
+        self.assertEqual(Passenger.objects.get().bank_balance, Decimal("90"))
+
+
+def simple_paths(graph, start_id, end_id, weight):
+    """Every loopless path between two stations as (total weight, connection ids), best first"""
+    paths = []
+
+    def walk(node, visited, path):
+        if node == end_id:
+            total = sum(float(getattr(graph.edges[cid], weight)) for cid in path)
+            paths.append((round(total, 6), path))
+            return
+        for neighbour, edge in graph.adjacency.get(node, []):
+            if neighbour not in visited:
+                walk(neighbour, visited | {neighbour}, path + [edge.id])
+
+    walk(start_id, {start_id}, [])
+    return sorted(paths)
+
+
+class AlternativeRoutesTests(NetworkTestCase):
+    def test_k_shortest_paths(self):
+        for seed, disabled in [(1, ()), (2, ()), (3, {1}), (4, {2, 3})]:
+            graph = random_graph(8, 16, lines=4, seed=seed, disabled_lines=disabled)
+            for start_id, end_id in [(1, 8), (2, 7), (3, 5)]:
+                expected = simple_paths(graph, start_id, end_id, "distance")
+                for k in (1, 3, 10):
+                    with self.subTest(seed=seed, pair=(start_id, end_id), k=k):
+                        paths = alternatives.k_shortest_paths(
+                            graph, start_id, end_id, k
+                        )
+                        # Fewer than k when there aren't as many paths
+                        self.assertEqual(len(paths), min(k, len(expected)))
+                        self.assertEqual(len(set(map(tuple, paths))), len(paths))
+                        # Loopless and on open lines only
+                        for path in paths:
+                            self.assertIn(path, [path for _, path in expected])
+                        self.assertEqual(
+                            [
+                                round(sum(graph.edges[cid].distance for cid in path), 6)
+                                for path in paths
+                            ],
+                            [total for total, _ in expected[: len(paths)]],
+                        )
+
+    def test_fewer_than_k_routes(self):
+        routes = alternatives.alternative_routes(*self.pair("A", "C"))
+        self.assertEqual(
+            [(route.distance, route.cost) for route in routes],
+            [(2, Decimal("2")), (4, Decimal("4"))],
+        )
+
+    def test_disabled_line(self):
+        self.red.is_active = False
+        self.red.save()
+
+        routes = alternatives.alternative_routes(*self.pair("A", "C"))
+        self.assertEqual([route.distance for route in routes], [4])
+        self.assertEqual(alternatives.alternative_routes(*self.pair("A", "E")), [])
+
+    def test_cached_per_topology_and_disabled_lines(self):
+        search = mock.patch.object(
+            alternatives, "k_shortest_paths", wraps=alternatives.k_shortest_paths
+        )
+        with search as k_shortest_paths:
+            alternatives.alternative_routes(*self.pair("A", "C"))
+            # A change that isn't the topology or a line status
+            network.bump_network_version(topology=False)
+            alternatives.alternative_routes(*self.pair("A", "C"))
+            self.assertEqual(k_shortest_paths.call_count, 1)
+
+            self.red.is_active = False
+            self.red.save()
+            self.assertEqual(
+                len(alternatives.alternative_routes(*self.pair("A", "C"))), 1
+            )
+            self.red.is_active = True
+            self.red.save()
+            self.assertEqual(
+                len(alternatives.alternative_routes(*self.pair("A", "C"))), 2
+            )
+            self.assertEqual(k_shortest_paths.call_count, 2)
+
+            # New fares are searched again
+            Connection.objects.filter(line=self.blue).update(cost=Decimal("3"))
+            network.bump_network_version()
+            routes = alternatives.alternative_routes(*self.pair("A", "C"))
+            self.assertEqual(routes[1].cost, Decimal("6"))
+            self.assertEqual(k_shortest_paths.call_count, 3)
+
+    def test_loaded_after_the_confirmation_page(self):
+        self.client.force_login(self.passenger.user)
+        ticket = self.ticket("A", "C", "pending")
+
+        with mock.patch.object(alternatives, "k_shortest_paths") as k_shortest_paths:
+            response = self.client.get(reverse("confirmation", args=[ticket.id]))
+        self.assertFalse(k_shortest_paths.called)
+        start_id, destination_id = self.pair("A", "C")
+        query = f"?start={start_id}&amp;destination={destination_id}"
+        self.assertContains(response, reverse("alternatives") + query)
+
+        response = self.client.get(
+            reverse("alternatives"), {"start": start_id, "destination": destination_id}
+        )
+        self.assertContains(response, "Shortest")
+        self.assertContains(response, "Alternative 1")
+        self.assertNotContains(response, "Alternative 2")
+
+        response = self.client.get(reverse("alternatives"), {"start": "A"})
+        self.assertEqual(response.status_code, 400)
+
+
+class RoutingDaemonTests(NetworkTestCase):
+    def setUp(self):
+        super().setUp()
+        directory = tempfile.TemporaryDirectory()
+        self.addCleanup(directory.cleanup)
+        self.socket_path = os.path.join(directory.name, "routing.sock")
+        daemon_settings = override_settings(
+            ROUTING_DATA_DIR=directory.name, ROUTING_SOCKET=self.socket_path
+        )
+        daemon_settings.enable()
+        self.addCleanup(daemon_settings.disable)
+        routing_client._close()
+        self.addCleanup(routing_client._close)
+        routing_client._down_until = 0
+
+        # The daemon's routing thread has its own database connection, which can't see this
+        # test's data: it gets the graph loaded here
+        self.graph = network.get_graph()
+        patcher = mock.patch.object(
+            routing_daemon, "get_graph", return_value=self.graph
+        )
+        patcher.start()
+        self.addCleanup(patcher.stop)
+
+    def start_daemon(self):
+        server = routing_daemon.RoutingServer(self.socket_path, 0.001)
+        loop = asyncio.new_event_loop()
+        task = loop.create_task(server.serve())
+        thread = threading.Thread(
+            target=loop.run_until_complete,
+            args=[asyncio.gather(task, return_exceptions=True)],
+        )
+        thread.start()
+
+        def stop():
+            routing_client._close()
+            loop.call_soon_threadsafe(task.cancel)
+            thread.join()
+            # The connections' handlers
+            pending = asyncio.all_tasks(loop)
+            for handler in pending:
+                handler.cancel()
+            if pending:
+                loop.run_until_complete(
+                    asyncio.gather(*pending, return_exceptions=True)
+                )
+            server.executor.shutdown()
+            server.builder.shutdown()
+            loop.close()
+
+        self.addCleanup(stop)
+        for _ in range(100):
+            if os.path.exists(self.socket_path):
+                break
+            time.sleep(0.01)
+
+    def test_prepare(self):
+        built = dict(routing_daemon.prepare(self.graph))
+
+        self.assertEqual(set(built), set(network.WEIGHTS))
+        for weight in network.WEIGHTS:
+            self.assertEqual(
+                contraction_hierarchy._hierarchies[weight].version, self.graph.version
+            )
+        # Already built
+        self.assertEqual(set(dict(routing_daemon.prepare(self.graph)).values()), {0.0})
+
+    def test_rebuilt_in_the_background(self):
+        builder = routing_daemon.HierarchyBuilder()
+        self.addCleanup(builder.shutdown)
+
+        def built(graph):
+            builder.check(graph)
+            builder.building.result(5)
+            return {
+                weight: hierarchy.version
+                for weight, hierarchy in contraction_hierarchy._hierarchies.items()
+            }
+
+        self.assertEqual(
+            built(self.graph), dict.fromkeys(network.WEIGHTS, self.graph.version)
+        )
+
+        # Up to date, or still covered once a line is disabled
+        building = builder.building
+        builder.check(self.graph)
+        self.red.is_active = False
+        self.red.save()
+        builder.check(network.get_graph())
+        self.assertIs(builder.building, building)
+
+        # New connections
+        Connection.objects.create(
+            line=self.blue,
+            start_station=self.stations["E"],
+            destination_station=self.stations["D"],
+            distance=1,
+            cost=Decimal("1"),
+            travel_time=1,
+        )
+        graph = network.get_graph()
+        self.assertEqual(built(graph), dict.fromkeys(network.WEIGHTS, graph.version))
+
+        # Reopened: the hierarchy built while it was disabled doesn't cover it
+        self.red.is_active = True
+        self.red.save()
+        graph = network.get_graph()
+        self.assertEqual(built(graph), dict.fromkeys(network.WEIGHTS, graph.version))
+
+    def test_failed_build_is_not_retried(self):
+        builder = routing_daemon.HierarchyBuilder()
+        self.addCleanup(builder.shutdown)
+
+        with mock.patch.object(
+            routing_daemon, "prepare", side_effect=RuntimeError
+        ) as prepare:
+            with self.assertLogs(routing_daemon.logger, "ERROR"):
+                builder.check(self.graph)
+                builder.building.result(5)
+            builder.check(self.graph)
+            builder.building.result(5)
+        self.assertEqual(prepare.call_count, 1)
+
+    def test_round_trip(self):
+        self.start_daemon()
+        self.assertEqual(stat.S_IMODE(os.stat(self.socket_path).st_mode), 0o660)
+        pairs = [self.pair("A", "C"), self.pair("E", "D"), self.pair("A", "A")]
+        # No station 0, so no route
+        pairs.append((self.stations["A"].id, 0))
+
+        for weight in network.WEIGHTS:
+            with self.subTest(weight=weight):
+                with mock.patch.object(
+                    routing_client, "routes_in_process", side_effect=AssertionError
+                ):
+                    routes = routing_client.routes(pairs, weight)
+                self.assertEqual(
+                    routes, routing_client.routes_in_process(pairs, weight)
+                )
+        self.assertEqual(routes[0].cost, Decimal("2"))
+        self.assertIsNone(routes[-1])
+
+    def test_fallback_without_the_daemon(self):
+        with self.assertLogs(routing_client.logger, "WARNING"):
+            route = routing_client.shortest_route(*self.pair("A", "C"))
+        self.assertEqual(route.cost, Decimal("2"))
+        self.assertGreater(routing_client._down_until, 0)
+
+    def test_protocol_errors(self):
+        with self.assertRaises(routing_client.ProtocolError):
+            routing_client.decode_queries(b"\x00\x02" + bytes(9))
+        with self.assertRaises(routing_client.ProtocolError):
+            routing_client.decode_queries(
+                routing_client.COUNT.pack(1) + routing_client.QUERY.pack(1, 2, 99)
+            )
+
+
+class ImportNetworkTests(TestCase):
+    CSV = {
+        "stations.csv": "name\nA\nB\nC\n",
+        "lines.csv": "name,is_active\nRed,true\nBlue,false\n",
+        "connections.csv": (
+            "line,start_station,destination_station,travel_time,distance,cost\n"
+            "Red,A,B,2,1.5,1.25\n"
+            "Red,B,C,3,,\n"
+            "Blue,A,C,4,2,3\n"
+        ),
+    }
+    GTFS = {
+        "stops.txt": (
+            "stop_id,stop_name,location_type\n"
+            "s1,A,0\n"
+            "s2,B,\n"
+            "s3,C,0\n"
+            "p1,A station,1\n"
+        ),
+        "routes.txt": "route_id,route_short_name,route_long_name\nr1,Red,\nr2,,Blue\n",
+        "trips.txt": "trip_id,route_id\nt1,r1\nt2,r1\nt3,r2\n",
+        "stop_times.txt": (
+            "trip_id,stop_id,stop_sequence,arrival_time,departure_time,shape_dist_traveled\n"
+            "t1,s2,2,08:02:00,08:03:00,1.5\n"
+            "t1,s1,1,08:00:00,08:00:00,0\n"
+            "t1,s3,3,08:06:00,08:06:00,4\n"
+            "t2,s1,1,24:10:00,24:10:00,\n"
+            "t2,s2,2,24:12:00,24:12:00,\n"
+            "t3,s1,1,09:00:00,09:00:00,\n"
+            "t3,s3,2,09:05:00,09:05:00,\n"
+        ),
+    }
+
+    def setUp(self):
+        directory = tempfile.TemporaryDirectory()
+        self.addCleanup(directory.cleanup)
+        self.directory = directory.name
+
+    def write(self, files):
+        for name, content in files.items():
+            with open(os.path.join(self.directory, name), "w") as f:
+                f.write(content)
+
+    def run_command(self, *args):
+        out, self.errors = io.StringIO(), io.StringIO()
+        call_command("import_network", *args, stdout=out, stderr=self.errors)
+        return out.getvalue()
+
+    def import_csv(self, *args):
+        return self.run_command(
+            *(
+                f"--{name}={os.path.join(self.directory, name + '.csv')}"
+                for name in ("stations", "lines", "connections")
+            ),
+            *args,
+        )
+
+    def network(self):
+        """{(line, start, destination): (travel_time, distance, cost)}"""
+        return {
+            (line, start, destination): rest
+            for line, start, destination, *rest in Connection.objects.values_list(
+                "line__name",
+                "start_station__name",
+                "destination_station__name",
+                "travel_time",
+                "distance",
+                "cost",
+            )
+        }
+
+    def test_csv(self):
+        self.write(self.CSV)
+
+        self.assertIn("3 connections upserted", self.import_csv())
+
+        self.assertEqual(
+            self.network(),
+            {
+                ("Red", "A", "B"): [2, 1.5, Decimal("1.25")],
+                # The model's defaults
+                ("Red", "B", "C"): [3, 5, Decimal("10")],
+                ("Blue", "A", "C"): [4, 2, Decimal("3")],
+            },
+        )
+        self.assertFalse(Line.objects.get(name="Blue").is_active)
+        self.assertEqual(network.get_network_version(), 1)
+
+    def test_gtfs(self):
+        self.write(self.GTFS)
+
+        self.run_command(f"--gtfs={self.directory}")
+
+        self.assertEqual(
+            {key: value[:2] for key, value in self.network().items()},
+            {
+                ("Red", "A", "B"): [2, 1.5],
+                ("Red", "B", "C"): [3, 2.5],
+                ("Blue", "A", "C"): [5, 5],
+            },
+        )
+        # Only actual stops
+        self.assertEqual(
+            sorted(Station.objects.values_list("name", flat=True)), ["A", "B", "C"]
+        )
+
+    def test_reimport_updates_in_place(self):
+        self.write(self.CSV)
+        self.import_csv()
+        ids = set(Connection.objects.values_list("id", flat=True))
+
+        self.write(
+            {
+                "lines.csv": "name,is_active\nBlue,true\n",
+                "connections.csv": (
+                    "line,start_station,destination_station,travel_time,distance,cost\n"
+                    "Red,A,B,7,1.5,2\n"
+                ),
+            }
+        )
+        self.import_csv()
+
+        self.assertEqual(set(Connection.objects.values_list("id", flat=True)), ids)
+        self.assertEqual(self.network()[("Red", "A", "B")], [7, 1.5, Decimal("2")])
+        self.assertEqual(Station.objects.count(), 3)
+        self.assertTrue(Line.objects.get(name="Blue").is_active)
+        self.assertEqual(network.get_network_version(), 2)
+
+    def test_nothing_is_imported_on_errors(self):
+        for files, error in [
+            (
+                {
+                    "connections.csv": self.CSV["connections.csv"]
+                    + "Red,A,Z,1,1,1\nRed,A,C,soon,1,1\n"
+                },
+                "connections.csv:6: travel_time/distance/cost is not a number",
+            ),
+            (
+                {"lines.csv": "name\n" + "L" * 101 + "\n"},
+                "lines.csv:2: line name too long",
+            ),
+        ]:
+            with self.subTest(error=error):
+                self.write({**self.CSV, **files})
+                with self.assertRaisesMessage(CommandError, "nothing was imported"):
+                    self.import_csv()
+                self.assertIn(error, self.errors.getvalue())
+                self.assertFalse(Station.objects.exists())
+                self.assertFalse(Connection.objects.exists())
+
+        # Reported as a row error, not a crash
+        self.write(
+            {
+                **self.GTFS,
+                "stop_times.txt": self.GTFS["stop_times.txt"].replace(
+                    "08:06:00,4", "08:06:00,far"
+                ),
+            }
+        )
+        importer = NetworkImporter()
+        importer.import_gtfs(self.directory)
+        self.assertEqual(
+            importer.errors,
+            [f"{self.directory}/stop_times.txt:4: bad shape_dist_traveled"],
+        )
+        self.assertFalse(Connection.objects.exists())
+
+    def test_dry_run(self):
+        self.write(self.CSV)
+
+        output = self.import_csv("--dry-run")
+
+        self.assertIn("Dry run, would have imported", output)
+        self.assertIn("3 stations created", output)
+        self.assertFalse(Station.objects.exists())
+        self.assertFalse(Line.objects.exists())
+        self.assertEqual(network.get_network_version(), 0)
+
+
+class StationSearchTests(TestCase):
+    NAMES = ["Central", "Grand Central", "Centre-Ville", "São Paulo", "Straße", "Park"]
+
+    @classmethod
+    def setUpTestData(cls):
+        for name in cls.NAMES:
+            Station.objects.create(name=name)
+
+    def setUp(self):
+        cache.clear()
+        station_search._index = None
+        self.addCleanup(setattr, station_search, "_index", None)
+
+    def names(self, query, limit=10):
+        return [
+            station["name"] for station in station_search.search_stations(query, limit)
+        ]
+
+    def test_prefix_of_any_word(self):
+        # Matches at the start of the name first
+        self.assertEqual(
+            self.names("cen"), ["Central", "Grand Central", "Centre-Ville"]
+        )
+        self.assertEqual(self.names("central"), ["Central", "Grand Central"])
+        self.assertEqual(self.names("gr"), ["Grand Central"])
+        self.assertEqual(self.names("grand cen"), ["Grand Central"])
+        # Words only match from their start
+        self.assertEqual(self.names("tral"), [])
+        self.assertEqual(self.names("  "), [])
+
+    def test_case_and_accents(self):
+        self.assertEqual(self.names("CENTRE"), ["Centre-Ville"])
+        self.assertEqual(self.names("sao"), ["São Paulo"])
+        self.assertEqual(self.names("SÃO P"), ["São Paulo"])
+        self.assertEqual(self.names("strasse"), ["Straße"])
+
+    def test_limit(self):
+        self.assertEqual(self.names("cen", limit=2), ["Central", "Grand Central"])
+        with mock.patch.object(station_search, "MAX_RESULTS", 1):
+            self.assertEqual(self.names("cen", limit=10), ["Central"])
+
+        response = self.client.get(reverse("station-search"), {"q": "c", "limit": 1})
+        self.assertEqual(
+            response.json(),
+            {
+                "results": [
+                    {"id": Station.objects.get(name="Central").id, "name": "Central"}
+                ]
+            },
+        )
+        response = self.client.get(reverse("station-search"), {"q": "c", "limit": "x"})
+        self.assertEqual(len(response.json()["results"]), 3)
+
+    def test_rebuilt_when_the_stations_change(self):
+        index = station_search.get_station_index()
+        self.assertEqual(self.names("new"), [])
+
+        Station.objects.create(name="Newtown")
+        # The version is only checked again after a while
+        self.assertEqual(self.names("new"), [])
+
+        later = time.monotonic() + station_search.INDEX_RECHECK_SECONDS
+        with mock.patch.object(station_search.time, "monotonic", return_value=later):
+            self.assertEqual(self.names("new"), ["Newtown"])
+            rebuilt = station_search.get_station_index()
+        self.assertIsNot(rebuilt, index)
+
+        # Unchanged stations: the same index is kept
+        later += station_search.INDEX_RECHECK_SECONDS
+        with mock.patch.object(station_search.time, "monotonic", return_value=later):
+            self.assertIs(station_search.get_station_index(), rebuilt)
+
+
+class TicketExportTests(NetworkTestCase):
+    def setUp(self):
+        super().setUp()
+        self.client.force_login(self.passenger.user)
+
+        self.active = self.ticket("A", "C", cost="2")
+        self.archived = self.ticket("D", "C", "Expired", cost="4")
+        Ticket.objects.filter(id=self.archived.id).update(
+            status_changed_at=archive.archive_cutoff() - timedelta(days=1)
+        )
+        self.assertEqual(archive.archive_expired(), 1)
+        other = User.objects.create_user("other", "other@example.com", PASSWORD)
+        self.ticket("A", "E", passenger=Passenger.objects.create(user=other))
+
+    def export(self, **params):
+        return self.client.get(reverse("export-tickets"), params)
+
+    def test_csv(self):
+        response = self.export()
+
+        self.assertEqual(response["Content-Type"], "text/csv")
+        self.assertEqual(
+            response["Content-Disposition"], 'attachment; filename="my-tickets.csv"'
+        )
+        self.assertEqual(
+            response.getvalue().decode().splitlines(),
+            [
+                "ticket_id,passenger,start_station,destination,cost,status",
+                f"{self.active.id},rider,A,C,2.00,active",
+                f"{self.archived.id},rider,D,C,4.00,Expired",
+            ],
+        )
+
+    def test_jsonl(self):
+        response = self.export(format="jsonl")
+
+        self.assertEqual(response["Content-Type"], "application/x-ndjson")
+        self.assertEqual(
+            response["Content-Disposition"], 'attachment; filename="my-tickets.jsonl"'
+        )
+        rows = [json.loads(line) for line in response.getvalue().splitlines()]
+        self.assertEqual(list(rows[0]), EXPORT_HEADER)
+        self.assertEqual(
+            [(row["ticket_id"], row["cost"], row["status"]) for row in rows],
+            [(self.active.id, "2.00", "active"), (self.archived.id, "4.00", "Expired")],
+        )
+
+    def test_unknown_format(self):
+        self.assertEqual(self.export(format="xlsx").status_code, 404)
+        with self.assertRaises(ValueError):
+            export_response(Ticket.objects.all(), "xlsx")
@@ -0,0 +1,92 @@
+"""
+Signed ticket tokens that gates can verify without the database.
+
+A token carries the ticket id, its stations and a validity window, followed by a truncated
+HMAC-SHA256 of those fields, base64url encoded (55 characters). Ticket ids are sequential and
+easy to guess, a token can't be forged without the key (settings.TICKET_TOKEN_KEY), which the
+gates share with the server. Verifying one takes a few microseconds.
+
+A token stays valid until the end of its window even once the ticket was used up, so gates also
+check the revocation filter published by the server (see scanner/revocation.py).
+
+Layout (big endian): version (1 byte), ticket id (8), start station id (4), destination id (4),
+valid from (4, unix time), valid until (4), HMAC (16).
+"""
+import base64
+import hashlib
+import hmac
+import struct
+import time
+from collections import namedtuple
+
+from django.conf import settings
+from django.utils.crypto import salted_hmac
+
+TOKEN_VERSION = 1
+PAYLOAD = struct.Struct(">BQIIII")
+MAC_SIZE = 16
+TOKEN_SIZE = PAYLOAD.size + MAC_SIZE
+
+# Tolerated difference between the clocks of the server and the gates, in seconds
+CLOCK_SKEW = 60
+
+TokenClaims = namedtuple(
+    "TokenClaims",
+    ["ticket_id", "start_station_id", "destination_id", "valid_from", "valid_until"],
+)
+
+
+class InvalidToken(Exception):
+    """The token is malformed, forged or outside of its validity window"""
+
+
+def token_key():
+    """The gates' shared key, derived from SECRET_KEY if TICKET_TOKEN_KEY isn't set"""
+    if settings.TICKET_TOKEN_KEY:
+        return settings.TICKET_TOKEN_KEY.encode()
+    return salted_hmac("passengers.ticket_tokens", "gate key").digest()
+
+
+def _mac(key, payload):
+    return hmac.new(key, payload, hashlib.sha256).digest()[:MAC_SIZE]
+
+
+def make_token(ticket, now=None, key=None):
+    """Signed token for a ticket, valid for settings.TICKET_TOKEN_LIFETIME seconds from now"""
+    valid_from = int(now if now is not None else time.time())
+    payload = PAYLOAD.pack(
+        TOKEN_VERSION,
+        ticket.id,
+        ticket.start_station_id,
+        ticket.destination_id,
+        valid_from,
+        valid_from + settings.TICKET_TOKEN_LIFETIME,
+    )
+    raw = payload + _mac(key or token_key(), payload)
+    return base64.urlsafe_b64encode(raw).rstrip(b"=").decode()
+
+
+def verify_token(token, now=None, key=None) -> TokenClaims:
+    """Returns the claims of a valid token, raises InvalidToken otherwise"""
+    try:
+        raw = base64.urlsafe_b64decode(token + "=" * (-len(token) % 4))
+    except (TypeError, ValueError):
+        raise InvalidToken("Malformed token")
+
+    if len(raw) != TOKEN_SIZE:
+        raise InvalidToken("Malformed token")
+
+    payload, mac = raw[: PAYLOAD.size], raw[PAYLOAD.size :]
+    if not hmac.compare_digest(mac, _mac(key or token_key(), payload)):
+        raise InvalidToken("Invalid signature")
+
+    version, *fields = PAYLOAD.unpack(payload)
+    if version != TOKEN_VERSION:
+        raise InvalidToken("Unsupported token version")
+
+    claims = TokenClaims(*fields)
+    now = now if now is not None else time.time()
+    if not claims.valid_from - CLOCK_SKEW <= now <= claims.valid_until + CLOCK_SKEW:
+        raise InvalidToken("Token expired")
+
+    return claims
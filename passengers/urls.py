@@ -15,11 +15,15 @@ urlpatterns = [
     path("logout/", auth_views.LogoutView.as_view(), name="passenger-logout"),
     path("dashboard/", views.dashboard, name="dashboard"),
     path("dashboard/purchase", views.purchase, name="purchase"),
+    path("dashboard/tickets/export", views.export_tickets, name="export-tickets"),
     path(
         "dashboard/purchase/confirmation/<int:ticket_id>",
         views.confirmation,
         name="confirmation",
     ),
+    path("dashboard/purchase/alternatives", views.alternatives, name="alternatives"),
     path("signup/", views.signup, name="signup"),
     path("finances/", views.add_money, name="money"),
+    path("stations/search", views.station_search, name="station-search"),
+    path("tickets/changes", views.ticket_changes, name="ticket-changes"),
 ]
@@ -5,14 +5,26 @@ The authentication decorator (login_required) is used to protect pages meant to
 with them (ex. dashboard)
 IntegrityError is needed to catch users trying to reuse the same username/email
 Decimal is used when updating user bank balance
+replica_reads sends the reads of pure read pages to a read replica, pin_to_primary keeps a
+passenger's reads on the primary right after their own purchase/top-up
 """
+from django.contrib.admin.views.decorators import staff_member_required
 from django.contrib.auth.decorators import login_required
 from django.contrib import messages
-from django.db import IntegrityError
-from django.shortcuts import render, redirect
-from .models import Ticket, Station, OTP
+from django.db import IntegrityError, transaction
+from django.http import Http404, HttpResponseBadRequest, JsonResponse
+from django.shortcuts import get_object_or_404, render, redirect
+from django.views.decorators.cache import cache_control
+from django.views.decorators.http import condition, require_GET
+from metroapp.replicas import pin_to_primary, replica_reads
+from .models import Passenger, Ticket, Station, OTP
 from .forms import PassengerSignupForm, OTPForm, AddMoneyForm
 from .otp_generation import generate_otp, send_verification_email
+from .alternatives import alternative_routes
+from .catalogue import purchase_etag, purchase_last_modified
+from .station_search import search_stations
+from .ticket_export import CONTENT_TYPES, export_response
+from .changes import FIELDS as CHANGE_FIELDS, changes_since
 
 from decimal import Decimal
 
@@ -52,12 +64,16 @@ def signup(request):
 
 
 @login_required
+@replica_reads
 def dashboard(request):
     """
     Renders the user dashboard, displaying all their tickets
     """
     passenger = request.user.passenger
-    tickets = passenger.tickets.all()
+    # Current and archived tickets
+    tickets = passenger.ticket_history.select_related(
+        "start_station", "destination"
+    ).order_by("id")
 
     context = {
         "passenger": passenger,
@@ -68,15 +84,17 @@ def dashboard(request):
 
 
 @login_required
+@replica_reads
+@cache_control(private=True, no_cache=True)
+@condition(etag_func=purchase_etag, last_modified_func=purchase_last_modified)
 def purchase(request):
     """
     Handles ticket purchasing
+    Stations are picked with the station_search autocomplete, so the page doesn't grow with the
+    network. Browsers revalidate the page (no-cache) and get a 304 for an unchanged GET.
     """
     passenger = request.user.passenger
-    stations = Station.objects.all()
-    context = {
-        "stations": stations,
-    }
+    context = {}
 
     if request.method == "POST":
         start_station_id = request.POST.get("start_station")
@@ -87,13 +105,19 @@ def purchase(request):
                 request,
                 "passengers/purchase.html",
                 {
-                    "stations": stations,
+                    **context,
                     "error": "Start and destination cannot be the same.",
                 },
             )
 
-        start_station = Station.objects.get(id=start_station_id)
-        dest_station = Station.objects.get(id=dest_station_id)
+        # The ids come from the autocomplete's hidden inputs, they're empty if the passenger
+        # typed a name without picking a suggestion
+        try:
+            start_station = Station.objects.get(id=int(start_station_id))
+            dest_station = Station.objects.get(id=int(dest_station_id))
+        except (TypeError, ValueError, Station.DoesNotExist):
+            context["error"] = "Select both stations from the suggestions."
+            return render(request, "passengers/purchase.html", context)
 
         temp_ticket = Ticket(
             passenger=passenger, start_station=start_station, destination=dest_station
@@ -108,14 +132,67 @@ def purchase(request):
             context["error"] = "Insufficent balance"
             return render(request, "passengers/purchase.html", context)
 
+        # Charged on confirmation, the ticket keeps the fare shown at purchase
+        temp_ticket.cost = cost
         temp_ticket.status = "pending"
         temp_ticket.save()
+        pin_to_primary(request)
 
         return redirect("confirmation", ticket_id=temp_ticket.id)
 
     return render(request, "passengers/purchase.html", context)
 
 
+@require_GET
+def station_search(request):
+    """
+    Station autocomplete, used by the purchase pages instead of listing every station.
+    GET ?q=<start of any word of the name>&limit=<max results>
+    Returns {"results": [{"id": ..., "name": ...}, ...]}
+    """
+    try:
+        limit = max(int(request.GET.get("limit", 10)), 1)
+    except ValueError:
+        limit = 10
+
+    results = search_stations(request.GET.get("q", ""), limit)
+    return JsonResponse({"results": results})
+
+
+@login_required
+@require_GET
+def export_tickets(request):
+    """
+    Downloads the passenger's ticket history, as CSV (default) or JSON lines (?format=jsonl).
+    The file is streamed, so it doesn't matter how many tickets they have.
+    """
+    export_format = request.GET.get("format", "csv")
+    if export_format not in CONTENT_TYPES:
+        raise Http404("Unknown export format")
+
+    tickets = request.user.passenger.ticket_history.all()
+    return export_response(tickets, export_format, "my-tickets")
+
+
+@staff_member_required
+@require_GET
+def ticket_changes(request):
+    """
+    Ticket change feed (see changes.py). ?since=<cursor> returns the changes after the cursor,
+    without it only the current cursor. Rows are arrays in the order of "fields".
+    """
+    try:
+        since = int(request.GET["since"]) if "since" in request.GET else None
+        limit = int(request.GET["limit"]) if "limit" in request.GET else None
+    except ValueError:
+        return HttpResponseBadRequest("since and limit must be integers")
+
+    rows, cursor, more = changes_since(since, limit)
+    return JsonResponse(
+        {"fields": CHANGE_FIELDS, "changes": rows, "cursor": cursor, "more": more}
+    )
+
+
 @login_required
 def add_money(request):
     """
@@ -134,6 +211,7 @@ def add_money(request):
             # Updates user bank balance
             passenger.bank_balance += amount
             passenger.save()
+            pin_to_primary(request)
 
             return redirect("dashboard")
     else:
@@ -148,7 +226,8 @@ def confirmation(request, ticket_id):
     Confirms purchase on OTP verificatoin, deducts balance, marks ticket as active
     """
     passenger = request.user.passenger
-    ticket = Ticket.objects.get(id=ticket_id)
+    # Unconfirmed tickets are deleted by the sweeper after a while
+    ticket = get_object_or_404(Ticket, id=ticket_id, passenger=passenger)
 
     form = OTPForm()
 
@@ -169,17 +248,59 @@ def confirmation(request, ticket_id):
 
             # Check if entered OTP exists and is valid
             if otp_database_log and otp_database_log.is_valid():
-                # Updates ticket status and deducts cost
-                ticket.status = "active"
-                passenger.bank_balance -= ticket.cost
-
-                passenger.save()
-                ticket.save()
-
-                return redirect("dashboard")
+                with transaction.atomic():
+                    # Locked and checked again, like api.confirm: the sweeper may have deleted
+                    # the ticket, or another request confirmed it or spent the balance, since
+                    # they were loaded
+                    passenger = Passenger.objects.select_for_update().get(
+                        id=passenger.id
+                    )
+                    ticket = (
+                        Ticket.objects.select_for_update()
+                        .filter(id=ticket_id, passenger=passenger)
+                        .first()
+                    )
+                    if ticket is None or ticket.status != "pending":
+                        messages.error(request, "This ticket is no longer pending")
+                        return redirect("dashboard")
+
+                    paid = passenger.bank_balance >= ticket.cost
+                    if paid:
+                        # Updates ticket status and deducts cost
+                        ticket.status = "active"
+                        passenger.bank_balance -= ticket.cost
+
+                        passenger.save()
+                        ticket.save()
+
+                if paid:
+                    pin_to_primary(request)
+                    return redirect("dashboard")
+                messages.error(request, "Insufficient balance")
             else:
                 messages.error(request, "Invalid or expired OTP")
 
     return render(
         request, "passengers/confirmation.html", {"ticket": ticket, "form": form}
     )
+
+
+@login_required
+@require_GET
+def alternatives(request):
+    """
+    Fallback routes in case a segment of the shortest one is congested or closing, loaded by the
+    confirmation page once it is displayed: the search never delays the OTP form.
+    GET ?start=<station id>&destination=<station id>
+    """
+    try:
+        start_id = int(request.GET["start"])
+        destination_id = int(request.GET["destination"])
+    except (KeyError, ValueError):
+        return HttpResponseBadRequest("start and destination must be station ids")
+
+    return render(
+        request,
+        "passengers/alternatives.html",
+        {"alternatives": alternative_routes(start_id, destination_id)},
+    )
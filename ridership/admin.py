@@ -0,0 +1,44 @@
+from django.contrib import admin
+from django.utils.decorators import method_decorator
+from metroapp.replicas import replica_reads
+from passengers.admin import ReplicaChangelistAdmin
+from .models import ODHourly, StationHourly
+from .reports import station_totals, top_od_pairs
+
+
+class SummaryAdmin(ReplicaChangelistAdmin):
+    """The summaries are only written by the rollup job"""
+
+    date_hierarchy = "hour"
+
+    def has_add_permission(self, request):
+        return False
+
+    def has_change_permission(self, request, obj=None):
+        return False
+
+
+@admin.register(StationHourly)
+class StationHourlyAdmin(SummaryAdmin):
+    """The changelist starts with the last 30 days totals per station and OD pair"""
+
+    list_display = ["hour", "station", "tickets_sold", "entries", "exits"]
+    list_select_related = ["station"]
+    autocomplete_fields = ["station"]
+    change_list_template = "admin/ridership/stationhourly/change_list.html"
+
+    # The reports are read before the parent's changelist_view, on the replica as well
+    @method_decorator(replica_reads)
+    def changelist_view(self, request, extra_context=None):
+        extra_context = {
+            **(extra_context or {}),
+            "station_totals": station_totals(30),
+            "top_od_pairs": top_od_pairs(30, 20),
+        }
+        return super().changelist_view(request, extra_context)
+
+
+@admin.register(ODHourly)
+class ODHourlyAdmin(SummaryAdmin):
+    list_display = ["hour", "start_station", "destination", "tickets", "revenue"]
+    list_select_related = ["start_station", "destination"]
@@ -0,0 +1,24 @@
+"""
+Adds the tickets and taps recorded since the last run to the hourly ridership summaries. Meant
+to run every few minutes (ex. from cron), runs can overlap safely.
+"""
+
+from django.core.management.base import BaseCommand
+
+from ridership.rollups import run_rollups
+
+
+class Command(BaseCommand):
+    help = "Rolls up new tickets and tap events into the hourly ridership summaries"
+
+    def add_arguments(self, parser):
+        parser.add_argument("--batch-size", type=int, default=None)
+
+    def handle(self, *args, **options):
+        totals = run_rollups(options["batch_size"])
+        self.stdout.write(
+            self.style.SUCCESS(
+                f"Rolled up {totals['ticket_changes']} tickets and "
+                f"{totals['tap_events']} taps"
+            )
+        )
@@ -0,0 +1,97 @@
+# Generated by Django 5.2.8 on 2026-10-19 15:34
+
+import django.db.models.deletion
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    initial = True
+
+    dependencies = [
+        ("passengers", "0012_ticketchange"),
+    ]
+
+    operations = [
+        migrations.CreateModel(
+            name="RollupMark",
+            fields=[
+                (
+                    "source",
+                    models.CharField(max_length=50, primary_key=True, serialize=False),
+                ),
+                ("position", models.BigIntegerField(default=0)),
+                ("updated_at", models.DateTimeField(auto_now=True)),
+            ],
+        ),
+        migrations.CreateModel(
+            name="ODHourly",
+            fields=[
+                (
+                    "id",
+                    models.BigAutoField(
+                        auto_created=True,
+                        primary_key=True,
+                        serialize=False,
+                        verbose_name="ID",
+                    ),
+                ),
+                ("hour", models.DateTimeField(db_index=True)),
+                ("tickets", models.PositiveIntegerField(default=0)),
+                (
+                    "revenue",
+                    models.DecimalField(decimal_places=2, default=0, max_digits=14),
+                ),
+                (
+                    "destination",
+                    models.ForeignKey(
+                        on_delete=django.db.models.deletion.CASCADE,
+                        related_name="hourly_od_destination",
+                        to="passengers.station",
+                    ),
+                ),
+                (
+                    "start_station",
+                    models.ForeignKey(
+                        on_delete=django.db.models.deletion.CASCADE,
+                        related_name="hourly_od_start",
+                        to="passengers.station",
+                    ),
+                ),
+            ],
+            options={
+                "verbose_name_plural": "origin/destination hourly ridership",
+                "unique_together": {("start_station", "destination", "hour")},
+            },
+        ),
+        migrations.CreateModel(
+            name="StationHourly",
+            fields=[
+                (
+                    "id",
+                    models.BigAutoField(
+                        auto_created=True,
+                        primary_key=True,
+                        serialize=False,
+                        verbose_name="ID",
+                    ),
+                ),
+                ("hour", models.DateTimeField(db_index=True)),
+                ("tickets_sold", models.PositiveIntegerField(default=0)),
+                ("entries", models.PositiveIntegerField(default=0)),
+                ("exits", models.PositiveIntegerField(default=0)),
+                (
+                    "station",
+                    models.ForeignKey(
+                        on_delete=django.db.models.deletion.CASCADE,
+                        related_name="hourly_ridership",
+                        to="passengers.station",
+                    ),
+                ),
+            ],
+            options={
+                "verbose_name_plural": "station hourly ridership",
+                "unique_together": {("station", "hour")},
+            },
+        ),
+    ]
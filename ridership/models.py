@@ -0,0 +1,61 @@
+"""
+Hourly ridership summaries, filled incrementally by the rollup job (see rollups.py) so reports
+never have to scan the tickets or tap events tables.
+
+hour is the start of the hour (UTC) the tickets were bought/the taps happened in.
+"""
+from django.db import models
+from passengers.models import Station
+
+
+class StationHourly(models.Model):
+    """Tickets sold from, and accepted entries/exits at, a station during one hour"""
+
+    station = models.ForeignKey(
+        Station, on_delete=models.CASCADE, related_name="hourly_ridership"
+    )
+    hour = models.DateTimeField(db_index=True)
+    tickets_sold = models.PositiveIntegerField(default=0)
+    entries = models.PositiveIntegerField(default=0)
+    exits = models.PositiveIntegerField(default=0)
+
+    class Meta:
+        unique_together = ("station", "hour")
+        verbose_name_plural = "station hourly ridership"
+
+    def __str__(self):
+        """Useful for the admin interface"""
+        return f"{self.station_id} at {self.hour:%Y-%m-%d %H:00}"
+
+
+class ODHourly(models.Model):
+    """Tickets sold for an origin/destination pair during one hour, and their total fare"""
+
+    start_station = models.ForeignKey(
+        Station, on_delete=models.CASCADE, related_name="hourly_od_start"
+    )
+    destination = models.ForeignKey(
+        Station, on_delete=models.CASCADE, related_name="hourly_od_destination"
+    )
+    hour = models.DateTimeField(db_index=True)
+    tickets = models.PositiveIntegerField(default=0)
+    revenue = models.DecimalField(max_digits=14, decimal_places=2, default=0)
+
+    class Meta:
+        unique_together = ("start_station", "destination", "hour")
+        verbose_name_plural = "origin/destination hourly ridership"
+
+
+class RollupMark(models.Model):
+    """
+    High-water mark of a rollup source: the last TicketChange seq / TapEvent id already counted.
+    Moved in the same transaction as the summaries, so nothing is counted twice.
+    """
+
+    source = models.CharField(max_length=50, primary_key=True)
+    position = models.BigIntegerField(default=0)
+    updated_at = models.DateTimeField(auto_now=True)
+
+    def __str__(self):
+        """Useful for the admin interface"""
+        return f"{self.source} at {self.position}"
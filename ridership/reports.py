@@ -0,0 +1,75 @@
+"""
+Reports over the hourly summaries. They only read the summary tables, filtered on the indexed
+hour column: 30 days of a whole network is a few hundred thousand small rows at most, summed in
+the database.
+"""
+from datetime import timedelta
+
+from django.db.models import Sum
+from django.utils import timezone
+
+from .models import ODHourly, StationHourly
+
+# Longest period a report can cover
+MAX_DAYS = 366
+
+
+def since(days):
+    return timezone.now() - timedelta(days=min(days, MAX_DAYS))
+
+
+def station_totals(days=30):
+    """[{station_id, station, tickets_sold, entries, exits}] over the last days, busiest first"""
+    rows = (
+        StationHourly.objects.filter(hour__gte=since(days))
+        .values("station_id", "station__name")
+        .annotate(
+            tickets_sold=Sum("tickets_sold"), entries=Sum("entries"), exits=Sum("exits")
+        )
+        .order_by("-entries", "-tickets_sold")
+    )
+    return [
+        {
+            "station_id": row["station_id"],
+            "station": row["station__name"],
+            "tickets_sold": row["tickets_sold"],
+            "entries": row["entries"],
+            "exits": row["exits"],
+        }
+        for row in rows
+    ]
+
+
+def station_hours(station_id, days=30):
+    """[(hour, tickets_sold, entries, exits)] of one station over the last days"""
+    return list(
+        StationHourly.objects.filter(station_id=station_id, hour__gte=since(days))
+        .order_by("hour")
+        .values_list("hour", "tickets_sold", "entries", "exits")
+    )
+
+
+def top_od_pairs(days=30, limit=50):
+    """The origin/destination pairs with the most tickets over the last days"""
+    return list(
+        ODHourly.objects.filter(hour__gte=since(days))
+        .values("start_station_id", "destination_id")
+        .annotate(tickets=Sum("tickets"), revenue=Sum("revenue"))
+        .order_by("-tickets")[:limit]
+    )
+
+
+def od_matrix(days=30, limit=1000):
+    """
+    The origin/destination matrix over the last days as sparse (start_id, destination_id,
+    tickets) entries, the limit busiest pairs first. Pairs without tickets are left out: a
+    network of thousands of stations has millions of cells, and only a small share of them
+    ever sees a ticket.
+    """
+    return list(
+        ODHourly.objects.filter(hour__gte=since(days))
+        .values("start_station_id", "destination_id")
+        .annotate(tickets=Sum("tickets"))
+        .order_by("-tickets", "start_station_id", "destination_id")
+        .values_list("start_station_id", "destination_id", "tickets")[:limit]
+    )
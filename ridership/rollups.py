@@ -0,0 +1,265 @@
+"""
+Incremental ridership rollups.
+
+Each run picks up the new ticket sales (from the ticket change feed) and accepted taps (from
+the tap log) after the source's high-water mark, in batches, and adds them to the hourly
+summaries. The summary rows and the mark are updated in the same transaction, so a crashed or
+concurrent run never counts anything twice. Both logs are read in commit order (see
+metroapp/commit_order.py): a row inserted by a transaction still running holds the mark back,
+it is never skipped.
+
+A ticket is sold when it goes from pending to active (purchases) or is issued active or in use
+straight away (offline and group issues). Pending tickets, paid for or not, aren't counted. The
+revenue is the cost logged with the sale: repricing changes the ticket's cost afterwards. The
+stations are read from the ticket history, which still has the archived tickets.
+
+A batch is aggregated with NumPy: stations are mapped to dense indices (np.unique), each row
+gets a single integer key for its (hour, station) or (hour, start, destination) cell, and the
+cells are counted with np.unique/np.bincount instead of dictionaries updated row by row.
+"""
+from datetime import datetime, timezone as dt_timezone
+from decimal import Decimal
+
+import numpy as np
+from django.conf import settings
+from django.db import connections, router, transaction
+from django.db.models import Q
+from metroapp.commit_order import committed_rows
+
+from passengers.models import TicketChange, TicketHistory
+from scanner.models import TapEvent
+from .models import ODHourly, RollupMark, StationHourly
+
+TICKETS = "ticket_changes"
+TAPS = "tap_events"
+
+
+def epoch_hour(moment):
+    """Hours since the epoch, the hour buckets of a batch are computed from it"""
+    return int(moment.timestamp()) // 3600
+
+
+def hour_start(hour):
+    return datetime.fromtimestamp(int(hour) * 3600, tz=dt_timezone.utc)
+
+
+# The changes selling a ticket, statuses aren't always saved in lower case
+SALES = (Q(previous_status__iexact="pending") & Q(status__iexact="active")) | (
+    Q(previous_status="") & (Q(status__iexact="active") | Q(status__iexact="in use"))
+)
+
+
+def ticket_stations(ticket_ids):
+    """{ticket_id: (start_station_id, destination_id, cost)}, archived tickets included"""
+    return {
+        ticket_id: (start, destination, cost)
+        for ticket_id, start, destination, cost in TicketHistory.objects.filter(
+            id__in=ticket_ids
+        ).values_list("id", "start_station_id", "destination_id", "cost")
+    }
+
+
+def lock_mark(source):
+    """The source's high-water mark, locked until the end of the transaction"""
+    RollupMark.objects.get_or_create(source=source)
+    return RollupMark.objects.select_for_update().get(source=source)
+
+
+def count_cells(hours, *station_columns):
+    """
+    Counts the rows per (hour, station...) cell. Returns (cells, inverse, counts): one tuple of
+    (hour, station ids...) per distinct cell, the cell of every row, and the row count per cell.
+    """
+    stations, dense = np.unique(np.concatenate(station_columns), return_inverse=True)
+    dense = dense.reshape(len(station_columns), -1)
+    size = len(stations)
+
+    keys = hours - hours.min()
+    for column in dense:
+        keys = keys * size + column
+    cell_keys, inverse, counts = np.unique(
+        keys, return_inverse=True, return_counts=True
+    )
+
+    cells = []
+    for key in cell_keys.tolist():
+        ids = []
+        for _ in station_columns:
+            key, index = divmod(key, size)
+            ids.append(int(stations[index]))
+        cells.append((int(hours.min()) + key, *reversed(ids)))
+
+    return cells, inverse, counts
+
+
+def add_increments(model, key_fields, value_fields, increments):
+    """
+    Adds {key tuple: value tuple} to the rows of model with those keys, creating the missing
+    ones, in a single INSERT ... ON CONFLICT DO UPDATE (Postgres and SQLite) per batch. The
+    existing rows never have to be read.
+    """
+    if not increments:
+        return
+
+    connection = connections[router.db_for_write(model)]
+    quote = connection.ops.quote_name
+    fields = [model._meta.get_field(name) for name in key_fields + value_fields]
+    table = quote(model._meta.db_table)
+    columns = [quote(field.column) for field in fields]
+    values = columns[len(key_fields) :]
+
+    sql = (
+        f"INSERT INTO {table} ({', '.join(columns)}) "
+        f"VALUES ({', '.join(['%s'] * len(columns))}) "
+        f"ON CONFLICT ({', '.join(columns[: len(key_fields)])}) DO UPDATE SET "
+        + ", ".join(
+            f"{column} = {table}.{column} + EXCLUDED.{column}" for column in values
+        )
+    )
+    rows = [
+        [
+            field.get_db_prep_save(value, connection)
+            for field, value in zip(fields, key + tuple(increment))
+        ]
+        for key, increment in increments.items()
+    ]
+    with connection.cursor() as cursor:
+        cursor.executemany(sql, rows)
+
+
+def add_to_station_hours(increments, field):
+    """Adds {(hour, station_id): count} to the given StationHourly field"""
+    columns = ["tickets_sold", "entries", "exits"]
+    add_increments(
+        StationHourly,
+        ["hour", "station"],
+        columns,
+        {
+            (hour_start(hour), station_id): [
+                count if column == field else 0 for column in columns
+            ]
+            for (hour, station_id), count in increments.items()
+        },
+    )
+
+
+def add_to_od_hours(increments):
+    """Adds {(hour, start_id, destination_id): (tickets, revenue)} to the OD summaries"""
+    add_increments(
+        ODHourly,
+        ["hour", "start_station", "destination"],
+        ["tickets", "revenue"],
+        {
+            (hour_start(hour), start, destination): values
+            for (hour, start, destination), values in increments.items()
+        },
+    )
+
+
+def rollup_tickets(batch_size):
+    """Counts the sales in the next batch of ticket changes, returns the changes read"""
+    with transaction.atomic():
+        mark = lock_mark(TICKETS)
+        rows = committed_rows(
+            TicketChange.objects.filter(SALES),
+            "seq",
+            ["seq", "changed_at", "ticket_id", "cost"],
+            mark.position,
+            batch_size,
+        )
+        if not rows:
+            return 0
+
+        tickets = ticket_stations({row[2] for row in rows})
+        sales = []
+        for _, changed_at, ticket_id, cost in rows:
+            if ticket_id not in tickets:
+                # Deleted outright (not archived), nothing left to count it against
+                continue
+            start, destination, current_cost = tickets[ticket_id]
+            # Changes logged before migration 0016 have no cost, the ticket's is used
+            cost = current_cost if cost is None else cost
+            sales.append((epoch_hour(changed_at), start, destination, int(cost * 100)))
+
+        if sales:
+            hours, starts, destinations, cents = (
+                np.array(column, dtype=np.int64) for column in zip(*sales)
+            )
+
+            cells, _, counts = count_cells(hours, starts)
+            add_to_station_hours(
+                {cell: int(count) for cell, count in zip(cells, counts)},
+                "tickets_sold",
+            )
+
+            cells, inverse, counts = count_cells(hours, starts, destinations)
+            revenue = np.bincount(inverse, weights=cents, minlength=len(cells))
+            add_to_od_hours(
+                {
+                    cell: (int(count), Decimal(int(total)) / 100)
+                    for cell, count, total in zip(cells, counts, revenue)
+                }
+            )
+
+        mark.position = rows[-1][0]
+        mark.save()
+        return len(rows)
+
+
+def rollup_taps(batch_size):
+    """Counts the next batch of accepted taps, returns the number of taps read"""
+    with transaction.atomic():
+        mark = lock_mark(TAPS)
+        rows = committed_rows(
+            TapEvent.objects.filter(accepted=True),
+            "id",
+            ["id", "tapped_at", "station_id", "direction", "ticket_id"],
+            mark.position,
+            batch_size,
+        )
+        if not rows:
+            return 0
+
+        # The scanner pages don't know the station, it's the ticket's start or destination
+        tickets = ticket_stations({row[4] for row in rows if row[2] is None})
+
+        for direction, field, end in (
+            ("incoming", "entries", 0),
+            ("outgoing", "exits", 1),
+        ):
+            hours, stations = [], []
+            for _, tapped_at, station_id, row_direction, ticket_id in rows:
+                if row_direction != direction:
+                    continue
+                if station_id is None:
+                    if ticket_id not in tickets:
+                        continue
+                    station_id = tickets[ticket_id][end]
+                hours.append(epoch_hour(tapped_at))
+                stations.append(station_id)
+
+            if hours:
+                cells, _, counts = count_cells(
+                    np.array(hours, dtype=np.int64), np.array(stations, dtype=np.int64)
+                )
+                add_to_station_hours(
+                    {cell: int(count) for cell, count in zip(cells, counts)}, field
+                )
+
+        mark.position = rows[-1][0]
+        mark.save()
+        return len(rows)
+
+
+def run_rollups(batch_size=None):
+    """Rolls up everything new, returns {source: rows counted}"""
+    batch_size = batch_size or settings.ROLLUP_BATCH_SIZE
+    totals = {}
+    for source, rollup in ((TICKETS, rollup_tickets), (TAPS, rollup_taps)):
+        totals[source] = 0
+        while True:
+            counted = rollup(batch_size)
+            totals[source] += counted
+            if counted < batch_size:
+                break
+    return totals
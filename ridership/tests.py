@@ -0,0 +1,216 @@
+"""
+Tests of the rollups and reports on the small network of passengers.tests.NetworkTestCase.
+"""
+from datetime import timedelta
+from decimal import Decimal
+from unittest import mock
+
+from django.contrib.auth.models import User
+from django.urls import reverse
+from django.utils import timezone
+from metroapp import replicas
+
+from passengers import archive
+from passengers.loadtest import PASSWORD
+from passengers.models import Ticket
+from passengers.tests import NetworkTestCase
+from scanner.models import TapEvent
+from . import reports
+from .models import ODHourly, StationHourly
+from .rollups import epoch_hour, hour_start, run_rollups
+
+
+class RollupTests(NetworkTestCase):
+    def setUp(self):
+        super().setUp()
+        self.hour = hour_start(epoch_hour(timezone.now()))
+
+    def sold(self):
+        """{station name: tickets sold} and {(start, destination): (tickets, revenue)}"""
+        names = {station.id: name for name, station in self.stations.items()}
+        return (
+            {
+                names[station_id]: sold
+                for station_id, sold in StationHourly.objects.filter(
+                    tickets_sold__gt=0
+                ).values_list("station_id", "tickets_sold")
+            },
+            {
+                (names[start], names[destination]): (tickets, revenue)
+                for start, destination, tickets, revenue in ODHourly.objects.values_list(
+                    "start_station_id", "destination_id", "tickets", "revenue"
+                )
+            },
+        )
+
+    def tap(self, ticket, direction, station=None, accepted=True, **fields):
+        return TapEvent.objects.create(
+            ticket_id=ticket.id,
+            station_id=station and self.stations[station].id,
+            direction=direction,
+            accepted=accepted,
+            result="",
+            **fields,
+        )
+
+    def test_sales(self):
+        # Never paid for
+        self.ticket("A", "C", "pending")
+        bought = self.ticket("A", "C", "pending", cost="2")
+        bought.status = "active"
+        bought.save()
+        # Offline issue
+        self.ticket("A", "E", "In Use", cost="3")
+        # Scanned afterwards, still a single sale
+        bought.status = "In Use"
+        bought.save()
+
+        self.assertEqual(run_rollups()["ticket_changes"], 2)
+        self.assertEqual(
+            self.sold(),
+            ({"A": 2}, {("A", "C"): (1, Decimal("2")), ("A", "E"): (1, Decimal("3"))}),
+        )
+        self.assertEqual(StationHourly.objects.get().hour, self.hour)
+
+        # Nothing is counted twice
+        self.assertEqual(run_rollups()["ticket_changes"], 0)
+        self.assertEqual(self.sold()[0], {"A": 2})
+
+    def test_revenue_of_repriced_and_archived_tickets(self):
+        repriced = self.ticket("A", "C", cost="2")
+        Ticket.objects.filter(id=repriced.id).update(cost=Decimal("4"))
+        archived = self.ticket("D", "C", cost="5")
+        archived.status = "Expired"
+        archived.save()
+        Ticket.objects.filter(id=archived.id).update(
+            status_changed_at=archive.archive_cutoff() - timedelta(days=1)
+        )
+        self.assertEqual(archive.archive_expired(), 1)
+
+        run_rollups()
+
+        self.assertEqual(
+            self.sold()[1],
+            {("A", "C"): (1, Decimal("2")), ("D", "C"): (1, Decimal("5"))},
+        )
+
+    def test_taps(self):
+        ticket = self.ticket("A", "C")
+        archived = self.ticket("D", "C", "Expired")
+        Ticket.objects.filter(id=archived.id).update(
+            status_changed_at=archive.archive_cutoff() - timedelta(days=1)
+        )
+        archive.archive_expired()
+        # Gates know the station, the scanner pages leave it to the ticket
+        self.tap(ticket, "incoming", "A")
+        self.tap(ticket, "outgoing")
+        self.tap(archived, "outgoing")
+        self.tap(ticket, "incoming", "A", accepted=False)
+
+        self.assertEqual(run_rollups(batch_size=2)["tap_events"], 3)
+        names = {station.id: name for name, station in self.stations.items()}
+        self.assertEqual(
+            {
+                names[station_id]: (entries, exits)
+                for station_id, entries, exits in StationHourly.objects.values_list(
+                    "station_id", "entries", "exits"
+                )
+            },
+            {"A": (1, 0), "C": (0, 2)},
+        )
+
+    def test_late_taps(self):
+        ticket = self.ticket("A", "C")
+        # Flushed by a gate after the next one's, with an earlier tap time
+        taps = [
+            self.tap(ticket, "incoming", "A"),
+            self.tap(
+                ticket,
+                "incoming",
+                "B",
+                tapped_at=timezone.now() - timedelta(hours=2),
+            ),
+            self.tap(ticket, "incoming", "D"),
+        ]
+        # The snapshot xmax each tap was inserted with, transactions below 100 are finished
+        for tap, insert_xmax in zip(taps, [50, 150, 200]):
+            TapEvent.objects.filter(id=tap.id).update(insert_xmax=insert_xmax)
+
+        with mock.patch("metroapp.commit_order.snapshot_xmin", return_value=100):
+            self.assertEqual(run_rollups()["tap_events"], 1)
+        self.assertEqual(run_rollups()["tap_events"], 2)
+
+        self.assertEqual(
+            sorted(StationHourly.objects.values_list("station_id", "hour")),
+            sorted(
+                [
+                    (self.stations["A"].id, self.hour),
+                    (self.stations["B"].id, self.hour - timedelta(hours=2)),
+                    (self.stations["D"].id, self.hour),
+                ]
+            ),
+        )
+
+
+class ReportTests(NetworkTestCase):
+    @classmethod
+    def setUpTestData(cls):
+        super().setUpTestData()
+        now = timezone.now()
+        hours = [now - timedelta(hours=1), now - timedelta(hours=2)]
+        old = now - timedelta(days=40)
+        for start, destination, tickets in [
+            ("A", "C", 3),
+            ("A", "E", 1),
+            ("D", "C", 2),
+        ]:
+            for hour in hours + [old]:
+                ODHourly.objects.create(
+                    start_station=cls.stations[start],
+                    destination=cls.stations[destination],
+                    hour=hour,
+                    tickets=tickets,
+                    revenue=tickets * 2,
+                )
+        for name, entries in [("A", 5), ("C", 7)]:
+            for hour in hours + [old]:
+                StationHourly.objects.create(
+                    station=cls.stations[name], hour=hour, entries=entries
+                )
+        cls.staff = User.objects.create_superuser(
+            "staff", "staff@example.com", PASSWORD
+        )
+
+    def test_station_totals(self):
+        self.assertEqual(
+            [(row["station"], row["entries"]) for row in reports.station_totals(30)],
+            [("C", 14), ("A", 10)],
+        )
+
+    def test_od_matrix(self):
+        self.assertEqual(
+            reports.od_matrix(30, limit=2),
+            [(*self.pair("A", "C"), 6), (*self.pair("D", "C"), 4)],
+        )
+
+        self.client.force_login(self.staff)
+        response = self.client.get(
+            reverse("ridership:od-matrix"), {"days": 60, "limit": 1}
+        )
+        self.assertEqual(
+            response.json(), {"days": 60, "entries": [[*self.pair("A", "C"), 9]]}
+        )
+
+    def test_changelist_reads_the_reports_from_a_replica(self):
+        self.client.force_login(self.staff)
+        routed = []
+        with mock.patch(
+            "ridership.admin.station_totals",
+            side_effect=lambda days: routed.append(replicas._use_replica.get()) or [],
+        ):
+            response = self.client.get(
+                reverse("admin:ridership_stationhourly_changelist")
+            )
+
+        self.assertEqual(response.status_code, 200)
+        self.assertEqual(routed, [True])
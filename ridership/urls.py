@@ -0,0 +1,11 @@
+from django.urls import path
+from . import views
+
+app_name = "ridership"
+
+urlpatterns = [
+    path("stations", views.stations, name="stations"),
+    path("stations/<int:station_id>", views.station_hours, name="station-hours"),
+    path("od", views.od_pairs, name="od-pairs"),
+    path("od/matrix", views.od_matrix, name="od-matrix"),
+]
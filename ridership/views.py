@@ -0,0 +1,68 @@
+"""
+Read API over the ridership summaries, for ops dashboards. Staff only, every view takes
+?days= (default 30).
+"""
+from functools import wraps
+
+from django.contrib.admin.views.decorators import staff_member_required
+from django.http import HttpResponseBadRequest, JsonResponse
+from django.views.decorators.http import require_GET
+
+from . import reports
+
+
+def get_int(request, name, default):
+    value = request.GET.get(name, default)
+    try:
+        value = int(value)
+    except ValueError:
+        raise ValueError(f"{name} must be an integer")
+    if value < 1:
+        raise ValueError(f"{name} must be positive")
+    return value
+
+
+def report_view(view):
+    """Reads ?days= and answers 400 on invalid parameters"""
+
+    @wraps(view)
+    def wrapper(request, *args, **kwargs):
+        try:
+            return view(request, get_int(request, "days", 30), *args, **kwargs)
+        except ValueError as e:
+            return HttpResponseBadRequest(str(e))
+
+    return staff_member_required(require_GET(wrapper))
+
+
+@report_view
+def stations(request, days):
+    """Totals per station"""
+    return JsonResponse({"days": days, "stations": reports.station_totals(days)})
+
+
+@report_view
+def station_hours(request, days, station_id):
+    """Hourly series of one station"""
+    hours = [
+        {"hour": hour, "tickets_sold": sold, "entries": entries, "exits": exits}
+        for hour, sold, entries, exits in reports.station_hours(station_id, days)
+    ]
+    return JsonResponse({"days": days, "station_id": station_id, "hours": hours})
+
+
+@report_view
+def od_pairs(request, days):
+    """Busiest origin/destination pairs, ?limit= (default 50)"""
+    limit = min(get_int(request, "limit", 50), 1000)
+    return JsonResponse({"days": days, "pairs": reports.top_od_pairs(days, limit)})
+
+
+@report_view
+def od_matrix(request, days):
+    """
+    Sparse origin/destination matrix, [start_id, destination_id, tickets] entries of the
+    busiest pairs, ?limit= (default 1000)
+    """
+    limit = min(get_int(request, "limit", 1000), 10000)
+    return JsonResponse({"days": days, "entries": reports.od_matrix(days, limit)})
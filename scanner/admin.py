@@ -1,3 +1,28 @@
 from django.contrib import admin
+from passengers.admin import ReplicaChangelistAdmin
+from passengers.pagination import EstimatedCountPaginator
+from .models import TapEvent
 
-# Register your models here.
+
+@admin.register(TapEvent)
+class TapEventAdmin(ReplicaChangelistAdmin):
+    """Read-only view of the tap log, which only grows"""
+
+    list_display = [
+        "tapped_at",
+        "ticket_id",
+        "station_id",
+        "direction",
+        "accepted",
+        "result",
+    ]
+    list_filter = ["direction", "accepted"]
+    search_fields = ["=ticket_id"]
+    paginator = EstimatedCountPaginator
+    show_full_result_count = False
+
+    def has_add_permission(self, request):
+        return False
+
+    def has_change_permission(self, request, obj=None):
+        return False
@@ -0,0 +1,84 @@
+"""
+Background batch writers, so the scanner never waits for the database to record what it did.
+
+Items are queued in memory and a daemon thread writes everything queued every few tenths of a
+second, in batches. Whatever is still queued when the process exits is written by an atexit
+handler. With max_size, the queue is bounded: once full, new items are dropped (and counted)
+rather than letting memory grow while the database is down.
+"""
+import atexit
+import logging
+import queue
+import threading
+import time
+
+from django.db import close_old_connections
+
+logger = logging.getLogger(__name__)
+
+
+class BatchWriter:
+    """Subclasses implement write(batch), called with lists of at most batch_size items"""
+
+    name = "batch-writer"
+
+    def __init__(self, batch_size, interval, max_size=0):
+        self.batch_size = batch_size
+        self.interval = interval
+        self.queue = queue.Queue(maxsize=max_size)
+        self.dropped = 0
+        self._thread = None
+        self._start_lock = threading.Lock()
+        # Held while writing, so the flush at shutdown waits for the batch in progress
+        self._write_lock = threading.Lock()
+
+    def submit(self, item):
+        if self._thread is None:
+            self._start()
+        try:
+            self.queue.put_nowait(item)
+        except queue.Full:
+            self.dropped += 1
+            if self.dropped % 1000 == 1:
+                logger.warning(
+                    "%s buffer full, %d items dropped", self.name, self.dropped
+                )
+
+    def _start(self):
+        with self._start_lock:
+            if self._thread is None:
+                self._thread = threading.Thread(
+                    target=self._run, name=self.name, daemon=True
+                )
+                self._thread.start()
+                atexit.register(self.flush)
+
+    def _run(self):
+        while True:
+            time.sleep(self.interval)
+            self.flush()
+
+    def flush(self):
+        """Writes everything queued so far, from the calling thread"""
+        with self._write_lock:
+            while True:
+                batch = []
+                while len(batch) < self.batch_size:
+                    try:
+                        batch.append(self.queue.get_nowait())
+                    except queue.Empty:
+                        break
+                if not batch:
+                    return
+
+                try:
+                    self.write(batch)
+                except Exception:
+                    logger.exception(
+                        "%s could not write %d items", self.name, len(batch)
+                    )
+                finally:
+                    close_old_connections()
+
+    def write(self, batch):
+        raise NotImplementedError
@@ -1,5 +1,5 @@
 from django import forms
-from passengers.models import Ticket
+from passengers.models import Passenger, Station, Ticket
 
 
 class TicketForm(forms.ModelForm):
@@ -7,6 +7,11 @@ class TicketForm(forms.ModelForm):
         model = Ticket
         fields = ["passenger", "start_station", "destination"]
 
+    def __init__(self, *args, **kwargs):
+        super().__init__(*args, **kwargs)
+        # The passenger choices are labelled with the username, loaded in the same query
+        self.fields["passenger"].queryset = Passenger.objects.select_related("user")
+
 
 class TicketIncomingForm(forms.Form):
     ticket_id = forms.IntegerField(label="Enter your ticket ID")
@@ -14,3 +19,66 @@ class TicketIncomingForm(forms.Form):
 
 class TicketOutgoingForm(forms.Form):
     ticket_id = forms.IntegerField(label="Enter your ticket ID")
+
+
+class GroupTicketForm(forms.Form):
+    """
+    Group issue: one (origin, destination) and a list of passengers, one "username quantity"
+    pair per line (the quantity defaults to 1).
+    """
+
+    # Largest number of tickets issued in one go
+    MAX_TICKETS = 500
+
+    start_station = forms.ModelChoiceField(queryset=Station.objects.all())
+    destination = forms.ModelChoiceField(queryset=Station.objects.all())
+    passengers = forms.CharField(
+        widget=forms.Textarea(attrs={"rows": 6}),
+        help_text="One passenger per line: username and number of tickets",
+    )
+
+    def clean_passengers(self):
+        """Returns [(Passenger, quantity)], the passengers are loaded in a single query"""
+        quantities = {}
+        for line_number, line in enumerate(
+            self.cleaned_data["passengers"].splitlines(), start=1
+        ):
+            parts = line.replace(",", " ").split()
+            if not parts:
+                continue
+            if len(parts) > 2:
+                raise forms.ValidationError(f"Line {line_number}: too many values")
+
+            try:
+                quantity = int(parts[1]) if len(parts) == 2 else 1
+            except ValueError:
+                raise forms.ValidationError(f"Line {line_number}: invalid quantity")
+            if quantity < 1:
+                raise forms.ValidationError(f"Line {line_number}: invalid quantity")
+
+            quantities[parts[0]] = quantities.get(parts[0], 0) + quantity
+
+        if not quantities:
+            raise forms.ValidationError("Enter at least one passenger")
+        if sum(quantities.values()) > self.MAX_TICKETS:
+            raise forms.ValidationError(
+                f"At most {self.MAX_TICKETS} tickets can be issued at once"
+            )
+
+        passengers = Passenger.objects.select_related("user").filter(
+            user__username__in=quantities
+        )
+        by_username = {p.user.username: p for p in passengers}
+        unknown = sorted(set(quantities) - set(by_username))
+        if unknown:
+            raise forms.ValidationError(f"Unknown passengers: {', '.join(unknown)}")
+
+        return [(by_username[name], quantity) for name, quantity in quantities.items()]
+
+    def clean(self):
+        cleaned_data = super().clean()
+        start = cleaned_data.get("start_station")
+        destination = cleaned_data.get("destination")
+        if start is not None and start == destination:
+            raise forms.ValidationError("Select different stations.")
+        return cleaned_data
@@ -0,0 +1,139 @@
+"""
+Ticket checks at the gates, without the database.
+
+A gate validates the signed token (passengers/ticket_tokens.py) and the revocation filters
+(revocation.py) locally, answers straight away, and hands the status change to a background
+thread that writes it to the database in batches (see batching.py). A slow database delays the
+writes, never the scans. Every tap is recorded in the tap log.
+
+The revocation filters hold the tickets in use too, so a ticket can't be tapped in again at
+another gate, nor tapped out without having been tapped in. Each process also remembers the tickets it scanned recently, for the taps made
+before the filters catch up. Accepted scans update the live station occupancy counters
+(occupancy.py).
+"""
+import threading
+from collections import OrderedDict
+
+from django.conf import settings
+from django.db import transaction
+from django.db.models import Q
+from django.utils import timezone
+
+from passengers.models import Passenger, Ticket, TicketChange
+from passengers.ticket_tokens import InvalidToken, verify_token
+from .batching import BatchWriter
+from .occupancy import record_entry, record_exit
+from .revocation import get_revocation_filter
+from .tap_log import record_tap
+
+INCOMING = "incoming"
+OUTGOING = "outgoing"
+
+# direction: (status before the scan, status after). The scanner views store the capitalised
+# statuses, the checks are case insensitive like theirs
+TRANSITIONS = {
+    INCOMING: ("active", "In Use"),
+    OUTGOING: ("in use", "Expired"),
+}
+
+# Number of recent scans remembered per process
+RECENT_SCANS_SIZE = 100000
+
+
+class StatusWriter(BatchWriter):
+    """Applies the status changes of the scans in batches, from a background thread"""
+
+    name = "gate-status-writer"
+
+    def write(self, batch):
+        now = timezone.now()
+        for direction, (before, after) in TRANSITIONS.items():
+            ids = [ticket_id for ticket_id, d in batch if d == direction]
+            if ids:
+                self._transition(ids, before, after, now)
+
+    @staticmethod
+    def _transition(ids, before, after, now):
+        """Moves the tickets still in status before to after, and logs it in the change feed"""
+        with transaction.atomic():
+            changed = list(
+                Ticket.objects.select_for_update()
+                .filter(Q(status__iexact=before), id__in=ids)
+                .values_list("id", "status", "cost", "passenger_id")
+            )
+            Ticket.objects.filter(
+                id__in=[ticket_id for ticket_id, *_ in changed]
+            ).update(status=after, status_changed_at=now)
+            TicketChange.record(
+                [
+                    (ticket_id, status, after, cost)
+                    for ticket_id, status, cost, _ in changed
+                ],
+                now,
+            )
+            Passenger.bump_versions({passenger_id for *_, passenger_id in changed})
+
+
+# Unbounded: the status changes are the final state of the tickets, they are never dropped
+writer = StatusWriter(settings.GATE_WRITE_BATCH_SIZE, settings.GATE_WRITE_INTERVAL)
+
+_recent_scans = OrderedDict()
+_recent_lock = threading.Lock()
+
+
+def scan(token, station_id, direction):
+    """
+    Checks a token presented at a gate of station_id. Returns (accepted, message), queues the
+    status change if the ticket was accepted, and records the tap either way.
+    """
+    claims, accepted, message = check(token, station_id, direction)
+    ticket_id = claims.ticket_id if claims else None
+    if accepted:
+        writer.submit((ticket_id, direction))
+        if direction == INCOMING:
+            record_entry(claims.start_station_id)
+        else:
+            record_exit(claims.start_station_id, claims.destination_id)
+    record_tap(ticket_id, station_id, direction, accepted, message)
+    return accepted, message
+
+
+def check(token, station_id, direction):
+    """Returns (token claims or None if the token is invalid, accepted, message)"""
+    try:
+        claims = verify_token(token)
+    except InvalidToken as e:
+        return None, False, str(e)
+
+    ticket_id = claims.ticket_id
+    if direction == INCOMING and claims.start_station_id != station_id:
+        return claims, False, "Ticket is not valid from this station"
+    if direction == OUTGOING and claims.destination_id != station_id:
+        return claims, False, "Ticket is not valid to this station"
+
+    revocations = get_revocation_filter()
+    if ticket_id in revocations.expired:
+        return claims, False, "Ticket expired"
+    if direction == INCOMING and ticket_id in revocations.in_use:
+        return claims, False, "Already scanned"
+
+    with _recent_lock:
+        previous = _recent_scans.get(ticket_id)
+        if previous == OUTGOING or previous == direction:
+            return claims, False, "Already scanned"
+        # An exit needs an entry: published in the filters, or scanned here before they
+        # caught up. An active ticket would otherwise leave without being used up
+        if (
+            direction == OUTGOING
+            and previous != INCOMING
+            and ticket_id not in revocations.in_use
+        ):
+            return claims, False, "Ticket was not scanned in"
+
+        _recent_scans[ticket_id] = direction
+        _recent_scans.move_to_end(ticket_id)
+        if len(_recent_scans) > RECENT_SCANS_SIZE:
+            _recent_scans.popitem(last=False)
+
+    message = "Journey completed" if direction == OUTGOING else "Welcome"
+    return claims, True, message
@@ -0,0 +1,45 @@
+"""
+Publishes the revocation filters of the gates (see scanner.revocation). Runs once, or forever
+with --interval (as a worker, the web processes then leave the filters to it).
+"""
+import time
+
+from django.conf import settings
+from django.core.management.base import BaseCommand
+from django.db import close_old_connections
+
+from scanner.revocation import publish_revocations
+
+
+class Command(BaseCommand):
+    help = "Builds the revocation filters and publishes them to the gates"
+
+    def add_arguments(self, parser):
+        parser.add_argument(
+            "--interval",
+            type=int,
+            default=None,
+            help=(
+                "Keep running, publishing every this many seconds (at most "
+                "REVOCATION_REFRESH_SECONDS)"
+            ),
+        )
+
+    def handle(self, *args, **options):
+        interval = options["interval"]
+        if interval is not None:
+            interval = min(interval, settings.REVOCATION_REFRESH_SECONDS)
+
+        while True:
+            close_old_connections()
+            revocations = publish_revocations()
+            self.stdout.write(
+                self.style.SUCCESS(
+                    f"Published the revocation filters: {revocations.expired.size} "
+                    f"and {revocations.in_use.size} bits"
+                )
+            )
+
+            if interval is None:
+                return
+            time.sleep(interval)
@@ -0,0 +1,45 @@
+# Generated by Django 5.2.8 on 2026-10-19 15:31
+
+import django.utils.timezone
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    initial = True
+
+    dependencies = []
+
+    operations = [
+        migrations.CreateModel(
+            name="TapEvent",
+            fields=[
+                (
+                    "id",
+                    models.BigAutoField(
+                        auto_created=True,
+                        primary_key=True,
+                        serialize=False,
+                        verbose_name="ID",
+                    ),
+                ),
+                ("ticket_id", models.BigIntegerField(db_index=True, null=True)),
+                ("station_id", models.BigIntegerField(null=True)),
+                (
+                    "direction",
+                    models.CharField(
+                        choices=[("incoming", "Incoming"), ("outgoing", "Outgoing")],
+                        max_length=10,
+                    ),
+                ),
+                (
+                    "tapped_at",
+                    models.DateTimeField(
+                        db_index=True, default=django.utils.timezone.now
+                    ),
+                ),
+                ("accepted", models.BooleanField()),
+                ("result", models.CharField(max_length=100)),
+            ],
+        ),
+    ]
@@ -0,0 +1,36 @@
+# Generated by Django 5.2.8 on 2026-10-19 16:27
+
+from django.db import migrations, models
+
+# The function is created by passengers/migrations/0015, see metroapp/commit_order.py
+CREATE_TRIGGER = """
+CREATE TRIGGER record_insert_xmax BEFORE INSERT ON scanner_tapevent
+FOR EACH ROW EXECUTE FUNCTION record_insert_xmax()
+"""
+
+
+def create_trigger(apps, schema_editor):
+    if schema_editor.connection.vendor == "postgresql":
+        schema_editor.execute(CREATE_TRIGGER)
+
+
+def drop_trigger(apps, schema_editor):
+    if schema_editor.connection.vendor == "postgresql":
+        schema_editor.execute("DROP TRIGGER record_insert_xmax ON scanner_tapevent")
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ("passengers", "0015_ticketchange_insert_xmax"),
+        ("scanner", "0001_initial"),
+    ]
+
+    operations = [
+        migrations.AddField(
+            model_name="tapevent",
+            name="insert_xmax",
+            field=models.BigIntegerField(editable=False, null=True),
+        ),
+        migrations.RunPython(create_trigger, drop_trigger),
+    ]
@@ -1,3 +1,32 @@
 from django.db import models
+from django.utils import timezone
 
-# Create your models here.
+
+class TapEvent(models.Model):
+    """
+    Append-only log of the taps at the gates and scanner pages, accepted or not. Written in
+    batches by the tap log (see tap_log.py), never updated.
+
+    ticket_id isn't a foreign key: invalid or forged tickets are logged too, and the log must
+    outlive archived tickets. station_id is unknown (null) for the scanner pages.
+    """
+
+    DIRECTION_CHOICES = [
+        ("incoming", "Incoming"),
+        ("outgoing", "Outgoing"),
+    ]
+
+    ticket_id = models.BigIntegerField(null=True, db_index=True)
+    station_id = models.BigIntegerField(null=True)
+    direction = models.CharField(max_length=10, choices=DIRECTION_CHOICES)
+    tapped_at = models.DateTimeField(default=timezone.now, db_index=True)
+    accepted = models.BooleanField()
+    # The message shown at the gate, ex. "Already scanned"
+    result = models.CharField(max_length=100)
+    # Set by the database, the rollups read the log in commit order (see
+    # metroapp/commit_order.py)
+    insert_xmax = models.BigIntegerField(null=True, editable=False)
+
+    def __str__(self):
+        """Useful for the admin interface"""
+        return f"{self.direction} tap of ticket {self.ticket_id}: {self.result}"
@@ -0,0 +1,209 @@
+"""
+Live station occupancy: passengers tapped in per origin station, and exits per minute.
+
+Counters live in the cache, so every process sees the same values (a shared cache such as
+Redis is needed once there is more than one process, see settings.REDIS_URL):
+    occupancy:in-use:<station_id>: tickets "In Use" that started at the station
+    occupancy:exits:<station_id>:<minute>: exits at the station during that minute (epoch)
+
+The scanner updates them on every transition through an in-memory buffer flushed by a
+background thread (see batching.py), so a scan never waits for the cache. Counts that drift
+(ex. a ticket scanned twice before the status writer caught up) are corrected by recounting the
+open tickets from the database every settings.OCCUPANCY_RESYNC_SECONDS, by one process at a time.
+
+Viewers are served by a single producer per ASGI process: OccupancyFeed reads every counter
+once per tick and pushes the changes to all the connected streams (views.occupancy_stream),
+however many there are.
+"""
+import asyncio
+import time
+from collections import Counter
+
+from asgiref.sync import sync_to_async
+from django.conf import settings
+from django.core.cache import cache
+from django.db.models import Count
+
+from passengers.catalogue import get_station_catalogue
+from passengers.models import Ticket
+from .batching import BatchWriter
+
+# Exit counters are only read for the previous minute, they can expire soon after
+EXITS_TIMEOUT = 5 * 60
+
+# Set by the process that recounted the open tickets, for settings.OCCUPANCY_RESYNC_SECONDS
+RESYNC_KEY = "occupancy:resynced"
+
+# Statuses of tapped in tickets as written by the scanner (and by older code, in lower case)
+IN_USE_STATUSES = ["In Use", "in use"]
+
+# Events a viewer can fall behind by before it is sent a new snapshot instead
+SUBSCRIBER_QUEUE_SIZE = 100
+
+
+def in_use_key(station_id):
+    return f"occupancy:in-use:{station_id}"
+
+
+def exits_key(station_id, minute):
+    return f"occupancy:exits:{station_id}:{minute}"
+
+
+def current_minute():
+    return int(time.time() // 60)
+
+
+def add_to_counter(key, delta, timeout=None):
+    """Atomic on Redis/Memcached, creates the counter if it doesn't exist yet"""
+    try:
+        cache.incr(key, delta)
+    except ValueError:
+        # Missing key: create it, unless another process just did
+        if not cache.add(key, delta, timeout):
+            cache.incr(key, delta)
+
+
+class CounterWriter(BatchWriter):
+    """Adds up the buffered (key, delta, timeout) changes and applies one incr per key"""
+
+    name = "occupancy-writer"
+
+    def write(self, batch):
+        totals = Counter()
+        timeouts = {}
+        for key, delta, timeout in batch:
+            totals[key] += delta
+            timeouts[key] = timeout
+
+        for key, delta in totals.items():
+            if delta:
+                add_to_counter(key, delta, timeouts[key])
+
+
+# Bounded: the counters are only indicative, and recounted from the database anyway
+writer = CounterWriter(
+    settings.GATE_WRITE_BATCH_SIZE,
+    settings.OCCUPANCY_FLUSH_INTERVAL,
+    settings.TAP_LOG_BUFFER_SIZE,
+)
+
+
+def record_entry(start_id, tickets=1):
+    """Tickets tapped in (or issued "In Use") at start_id"""
+    writer.submit((in_use_key(start_id), tickets, None))
+
+
+def record_exit(start_id, destination_id):
+    """A ticket from start_id tapped out at destination_id"""
+    writer.submit((in_use_key(start_id), -1, None))
+    writer.submit((exits_key(destination_id, current_minute()), 1, EXITS_TIMEOUT))
+
+
+def resync():
+    """Recounts the open tickets of every station from the database"""
+    counts = dict(
+        Ticket.objects.filter(status__in=IN_USE_STATUSES)
+        .values("start_station_id")
+        .annotate(tickets=Count("id"))
+        .values_list("start_station_id", "tickets")
+        .order_by()
+    )
+    cache.set_many(
+        {
+            in_use_key(station["id"]): counts.get(station["id"], 0)
+            for station in get_station_catalogue()
+        },
+        None,
+    )
+
+
+def read_counters():
+    """
+    Returns {station_id: {"in_use": ..., "exits_per_minute": ...}} for the stations with
+    non-zero counts. Exits are counted over the last complete minute.
+    """
+    if cache.add(RESYNC_KEY, True, settings.OCCUPANCY_RESYNC_SECONDS):
+        resync()
+
+    minute = current_minute() - 1
+    station_ids = [station["id"] for station in get_station_catalogue()]
+    keys = [in_use_key(station_id) for station_id in station_ids]
+    keys += [exits_key(station_id, minute) for station_id in station_ids]
+    values = cache.get_many(keys)
+
+    counters = {}
+    for station_id in station_ids:
+        in_use = max(values.get(in_use_key(station_id), 0), 0)
+        exits = values.get(exits_key(station_id, minute), 0)
+        if in_use or exits:
+            counters[station_id] = {"in_use": in_use, "exits_per_minute": exits}
+    return counters
+
+
+def changes(previous, current):
+    """{station_id: counts} of the stations whose counts changed, zeros for the ones gone"""
+    zero = {"in_use": 0, "exits_per_minute": 0}
+    return {
+        station_id: current.get(station_id, zero)
+        for station_id in previous.keys() | current.keys()
+        if previous.get(station_id) != current.get(station_id)
+    }
+
+
+class Subscriber:
+    def __init__(self):
+        self.queue = asyncio.Queue(maxsize=SUBSCRIBER_QUEUE_SIZE)
+        self.needs_snapshot = True
+
+
+class OccupancyFeed:
+    """
+    The producer of an ASGI process. It runs while at least one viewer is connected: every
+    settings.OCCUPANCY_TICK_SECONDS it reads the counters and queues ("snapshot", counters)
+    for new (or lagging) viewers and ("delta", changes) for the others.
+    """
+
+    def __init__(self):
+        self.subscribers = set()
+        self.counters = {}
+        self._task = None
+
+    def subscribe(self):
+        subscriber = Subscriber()
+        self.subscribers.add(subscriber)
+        if self._task is None:
+            self._task = asyncio.create_task(self._run())
+        return subscriber
+
+    def unsubscribe(self, subscriber):
+        self.subscribers.discard(subscriber)
+
+    async def _run(self):
+        try:
+            while self.subscribers:
+                counters = await sync_to_async(read_counters)()
+                delta = changes(self.counters, counters)
+                self.counters = counters
+
+                for subscriber in list(self.subscribers):
+                    if subscriber.needs_snapshot:
+                        event = ("snapshot", counters)
+                    elif delta:
+                        event = ("delta", delta)
+                    else:
+                        continue
+
+                    try:
+                        subscriber.queue.put_nowait(event)
+                        subscriber.needs_snapshot = False
+                    except asyncio.QueueFull:
+                        # Too slow to keep up: skip the deltas, send a snapshot once it catches up
+                        subscriber.needs_snapshot = True
+
+                await asyncio.sleep(settings.OCCUPANCY_TICK_SECONDS)
+        finally:
+            self._task = None
+            self.counters = {}
+
+
+feed = OccupancyFeed()
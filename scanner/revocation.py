@@ -0,0 +1,188 @@
+"""
+Revocation filters published to the gates.
+
+A signed token stays valid until the end of its window, so the tickets that were used up since
+(scanned out) have to be revoked, and the tickets in use must not be let in again at another
+gate. The gates sync a Bloom filter of the ids of each: a compact bit array that never misses
+a ticket it holds and wrongly reports another one with probability
+settings.REVOCATION_FALSE_POSITIVE_RATE. Only tickets expired less than a token lifetime ago are
+in the first filter, tokens issued before that are rejected by their window anyway. The second
+one holds every ticket in use, and is only checked at the entrance.
+
+The filters are built from the database every settings.REVOCATION_REFRESH_SECONDS, by the
+publish_revocations command or else by a background thread of the web processes (one process
+per interval, elected through the cache), and shared through the cache. The gate checks only
+read the published filters and never query the database; until the first ones are published,
+nothing is revoked.
+
+Wire format (big endian), for the used up tickets then the tickets in use: number of bits
+(4 bytes), number of hash functions (1), the bits.
+"""
+import hashlib
+import logging
+import math
+import struct
+import threading
+import time
+from collections import namedtuple
+from datetime import timedelta
+
+from django.conf import settings
+from django.core.cache import cache
+from django.db import close_old_connections
+from django.db.models import Q
+from django.utils import timezone
+
+from passengers.models import Ticket
+
+logger = logging.getLogger(__name__)
+
+HEADER = struct.Struct(">IB")
+# (published at, serialized filters), kept until new ones are published
+CACHE_KEY = "ticket-revocations"
+# Set for REVOCATION_REFRESH_SECONDS by the process publishing the filters
+PUBLISHED_KEY = "ticket-revocations-published"
+
+Revocations = namedtuple("Revocations", ["expired", "in_use"])
+
+# Per-process copy: (fetched_at, Revocations)
+_filter = (0, None)
+_refresher = None
+_refresher_lock = threading.Lock()
+
+
+class BloomFilter:
+    def __init__(self, size, hashes, bits=None):
+        self.size = size
+        self.hashes = hashes
+        self.bits = bytearray(bits) if bits is not None else bytearray((size + 7) // 8)
+
+    @classmethod
+    def for_capacity(cls, capacity, false_positive_rate):
+        """Smallest filter holding capacity items with the given false positive rate"""
+        capacity = max(capacity, 1)
+        size = math.ceil(-capacity * math.log(false_positive_rate) / math.log(2) ** 2)
+        hashes = max(1, round(size / capacity * math.log(2)))
+        return cls(size, hashes)
+
+    def _positions(self, item):
+        # Double hashing: the k positions are h1 + i * h2
+        digest = hashlib.blake2b(str(item).encode(), digest_size=16).digest()
+        h1 = int.from_bytes(digest[:8], "big")
+        h2 = int.from_bytes(digest[8:], "big") | 1
+        return ((h1 + i * h2) % self.size for i in range(self.hashes))
+
+    def add(self, item):
+        for position in self._positions(item):
+            self.bits[position >> 3] |= 1 << (position & 7)
+
+    def __contains__(self, item):
+        return all(
+            self.bits[position >> 3] & (1 << (position & 7))
+            for position in self._positions(item)
+        )
+
+    def to_bytes(self):
+        return HEADER.pack(self.size, self.hashes) + bytes(self.bits)
+
+    @classmethod
+    def from_bytes(cls, data, offset=0):
+        size, hashes = HEADER.unpack_from(data, offset)
+        start = offset + HEADER.size
+        return cls(size, hashes, data[start : start + (size + 7) // 8])
+
+
+def build_filter(tickets):
+    """Bloom filter of the ids of a Ticket queryset"""
+    ids = tickets.values_list("id", flat=True)
+    bloom = BloomFilter.for_capacity(
+        ids.count(), settings.REVOCATION_FALSE_POSITIVE_RATE
+    )
+    for ticket_id in ids.iterator(chunk_size=10000):
+        bloom.add(ticket_id)
+    return bloom
+
+
+def build_revocations():
+    """Filters of the tickets used up within the last token lifetime, and of those in use"""
+    since = timezone.now() - timedelta(seconds=settings.TICKET_TOKEN_LIFETIME)
+    return Revocations(
+        expired=build_filter(
+            Ticket.objects.filter(
+                Q(status__iexact="expired"), status_changed_at__gte=since
+            )
+        ),
+        in_use=build_filter(Ticket.objects.filter(status__iexact="in use")),
+    )
+
+
+def to_bytes(revocations):
+    return b"".join(bloom.to_bytes() for bloom in revocations)
+
+
+def from_bytes(data):
+    expired = BloomFilter.from_bytes(data)
+    in_use = BloomFilter.from_bytes(data, HEADER.size + len(expired.bits))
+    return Revocations(expired, in_use)
+
+
+# Published while there are no filters yet
+EMPTY = to_bytes(Revocations(BloomFilter(8, 1), BloomFilter(8, 1)))
+
+
+def publish_revocations():
+    """Builds the filters and publishes them to the gates, returns them"""
+    revocations = build_revocations()
+    cache.set(CACHE_KEY, (time.time(), to_bytes(revocations)), None)
+    cache.set(PUBLISHED_KEY, True, settings.REVOCATION_REFRESH_SECONDS)
+    return revocations
+
+
+def _refresh_forever():
+    while True:
+        close_old_connections()
+        try:
+            # Unless another process (or the command) published them within the interval
+            if cache.add(PUBLISHED_KEY, True, settings.REVOCATION_REFRESH_SECONDS):
+                publish_revocations()
+        except Exception:
+            logger.exception("Could not publish the revocation filters")
+        time.sleep(settings.REVOCATION_REFRESH_SECONDS)
+
+
+def start_refresher():
+    """Starts this process' background thread publishing the filters, if it isn't running"""
+    global _refresher
+
+    if _refresher is not None:
+        return
+    with _refresher_lock:
+        if _refresher is None:
+            _refresher = threading.Thread(
+                target=_refresh_forever, name="revocation-refresher", daemon=True
+            )
+            _refresher.start()
+
+
+def get_revocation_data():
+    """The serialized filters last published, empty ones if none were yet"""
+    start_refresher()
+    published = cache.get(CACHE_KEY)
+    if published is None:
+        logger.warning("No revocation filters published yet")
+        return EMPTY
+    return published[1]
+
+
+def get_revocation_filter():
+    """The Revocations as a gate sees them, re-synced every REVOCATION_REFRESH_SECONDS"""
+    global _filter
+
+    fetched_at, revocations = _filter
+    if (
+        revocations is None
+        or time.monotonic() - fetched_at > settings.REVOCATION_REFRESH_SECONDS
+    ):
+        revocations = from_bytes(get_revocation_data())
+        _filter = (time.monotonic(), revocations)
+    return revocations
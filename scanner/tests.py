@@ -1,3 +1,494 @@
-from django.test import TestCase
+"""
+Query and routing budgets of the scanner pages, see passengers/tests.py, and tests of the group
+issue, the gates, the scanner pages, the tap log and the live occupancy feed on the small
+network of passengers.tests.NetworkTestCase.
+"""
+import asyncio
+import io
+import json
+from decimal import Decimal
+from unittest import mock
 
-# Create your tests here.
+from asgiref.sync import sync_to_async
+from django.contrib.auth.models import User
+from django.core.cache import cache
+from django.test import override_settings
+from django.urls import reverse
+from django.utils import timezone
+
+from passengers.loadtest import PASSWORD
+from passengers.models import Passenger, Ticket, TicketChange
+from passengers.tests import NetworkTestCase, QueryBudgetTestCase
+from . import gate, occupancy, revocation
+from .models import TapEvent
+from .tap_log import TapLog, tap_log
+
+REFRESHER = "scanner.revocation.start_refresher"
+
+
+class ScannerPagesTests(QueryBudgetTestCase):
+    def setUp(self):
+        super().setUp()
+        # Taps and occupancy changes stay queued in memory: the writer threads would write
+        # outside the test's transaction
+        # Same for the thread publishing the revocation filters
+        for target in ("scanner.batching.BatchWriter._start", REFRESHER):
+            patcher = mock.patch(target)
+            patcher.start()
+            self.addCleanup(patcher.stop)
+
+    def ticket(self, status):
+        return Ticket.objects.create(
+            passenger=self.passenger,
+            start_station_id=self.stations[0],
+            destination_id=self.stations[-1],
+            cost=Decimal("10"),
+            status=status,
+        )
+
+    def test_incoming(self):
+        self.assertWithinBudget(
+            lambda ticket: self.client.post(
+                reverse("scanner:scanner-incoming"), {"ticket_id": ticket.id}
+            ),
+            7,
+            prepare=lambda: self.ticket("active"),
+        )
+
+    def test_outgoing(self):
+        self.assertWithinBudget(
+            lambda ticket: self.client.post(
+                reverse("scanner:scanner-outgoing"), {"ticket_id": ticket.id}
+            ),
+            7,
+            prepare=lambda: self.ticket("In Use"),
+        )
+
+    def test_gate(self):
+        self.assertWithinBudget(
+            lambda ticket: self.client.post(
+                reverse("scanner:gate-incoming", args=[ticket.start_station_id]),
+                {"token": ticket.gate_token},
+            ),
+            0,
+            prepare=lambda: self.ticket("active"),
+        )
+
+    def test_purchase_offline_page(self):
+        self.login_staff()
+        self.assertWithinBudget(lambda: self.client.get(reverse("scanner:offline")), 2)
+
+    def test_purchase_offline(self):
+        self.login_staff()
+        self.assertWithinBudget(
+            lambda: self.client.post(
+                reverse("scanner:offline"),
+                {
+                    "passenger": self.passenger.id,
+                    "start_station": self.stations[0],
+                    "destination": self.stations[-1],
+                },
+            ),
+            14,
+            routing_calls=1,
+        )
+
+    def test_tap_log_changelist(self):
+        self.login_staff()
+        self.assertWithinBudget(
+            # Including the row estimate on Postgres
+            lambda: self.client.get(reverse("admin:scanner_tapevent_changelist")),
+            4,
+        )
+
+
+class GroupPurchaseTests(NetworkTestCase):
+    @classmethod
+    def setUpTestData(cls):
+        super().setUpTestData()
+        staff = User.objects.create_superuser("staff", "staff@example.com", PASSWORD)
+        cls.other = Passenger.objects.create(user=staff)
+
+    def setUp(self):
+        super().setUp()
+        self.client.force_login(self.other.user)
+        patcher = mock.patch("scanner.views.record_entry")
+        self.record_entry = patcher.start()
+        self.addCleanup(patcher.stop)
+
+    def issue(self, passengers, start="A", destination="C"):
+        return self.client.post(
+            reverse("scanner:offline-group"),
+            {
+                "start_station": self.stations[start].id,
+                "destination": self.stations[destination].id,
+                "passengers": passengers,
+            },
+        )
+
+    def test_issue(self):
+        versions = dict(Passenger.objects.values_list("id", "version"))
+
+        response = self.issue("rider 2\nstaff")
+
+        self.assertContains(response, "Issued 3 tickets at $2.00 each")
+        tickets = Ticket.objects.order_by("id")
+        self.assertEqual(
+            [(t.passenger_id, t.status, t.cost) for t in tickets],
+            [(self.passenger.id, "In Use", Decimal("2"))] * 2
+            + [(self.other.id, "In Use", Decimal("2"))],
+        )
+        # In the change feed, and the passengers' tickets changed
+        self.assertEqual(
+            list(TicketChange.objects.values_list("ticket_id", "previous_status")),
+            [(ticket.id, "") for ticket in tickets],
+        )
+        for passenger_id, version in Passenger.objects.values_list("id", "version"):
+            self.assertEqual(version, versions[passenger_id] + 1)
+        self.record_entry.assert_called_once_with(self.stations["A"].id, 3)
+
+    def test_unknown_passenger(self):
+        response = self.issue("rider\nnobody 2")
+
+        self.assertContains(response, "Unknown passengers: nobody")
+        self.assertFalse(Ticket.objects.exists())
+
+    def test_too_many_tickets(self):
+        response = self.issue("rider 400\nstaff 101")
+
+        self.assertContains(response, "At most 500 tickets can be issued at once")
+        self.assertFalse(Ticket.objects.exists())
+
+    def test_no_route(self):
+        self.red.is_active = False
+        self.red.save()
+
+        response = self.issue("rider", destination="E")
+
+        self.assertContains(response, "No operational lines between these stations.")
+        self.assertFalse(Ticket.objects.exists())
+        self.record_entry.assert_not_called()
+
+
+class GateTests(NetworkTestCase):
+    def setUp(self):
+        super().setUp()
+        for target in ("scanner.batching.BatchWriter._start", REFRESHER):
+            patcher = mock.patch(target)
+            patcher.start()
+            self.addCleanup(patcher.stop)
+        revocation._filter = (0, None)
+        self.addCleanup(setattr, revocation, "_filter", (0, None))
+        gate._recent_scans.clear()
+        self.addCleanup(gate._recent_scans.clear)
+
+    def scan(self, ticket, direction, station=None):
+        station = station or (
+            ticket.start_station if direction == gate.INCOMING else ticket.destination
+        )
+        # A gate of another process, which never saw the ticket
+        gate._recent_scans.clear()
+        return gate.check(ticket.gate_token, station.id, direction)[1:]
+
+    def test_published_filters(self):
+        active = self.ticket("A", "C")
+        in_use = self.ticket("A", "C", "In Use")
+        used_up = self.ticket("A", "C", "active")
+        token = used_up.gate_token
+        used_up.status = "Expired"
+        used_up.save()
+
+        revocation.publish_revocations()
+
+        self.assertEqual(self.scan(active, gate.INCOMING), (True, "Welcome"))
+        self.assertEqual(self.scan(in_use, gate.INCOMING), (False, "Already scanned"))
+        self.assertEqual(self.scan(in_use, gate.OUTGOING), (True, "Journey completed"))
+        self.assertEqual(
+            gate.check(token, self.stations["C"].id, gate.OUTGOING)[1:],
+            (False, "Ticket expired"),
+        )
+
+    def test_exit_without_an_entry(self):
+        active = self.ticket("A", "C")
+        revocation.publish_revocations()
+
+        with (
+            mock.patch.object(gate, "record_exit") as record_exit,
+            mock.patch.object(gate.writer, "submit") as submit,
+        ):
+            self.assertEqual(
+                gate.scan(active.gate_token, self.stations["C"].id, gate.OUTGOING),
+                (False, "Ticket was not scanned in"),
+            )
+        record_exit.assert_not_called()
+        submit.assert_not_called()
+
+        # Scanned in at this process, before the filters caught up
+        gate._recent_scans.clear()
+        gate.check(active.gate_token, self.stations["A"].id, gate.INCOMING)
+        self.assertEqual(
+            gate.check(active.gate_token, self.stations["C"].id, gate.OUTGOING)[1:],
+            (True, "Journey completed"),
+        )
+
+    def test_gates_never_build_the_filters(self):
+        in_use = self.ticket("A", "C", "In Use")
+
+        with (
+            self.assertNumQueries(0),
+            self.assertLogs(revocation.logger, "WARNING"),
+        ):
+            # Nothing published yet
+            self.assertEqual(self.scan(in_use, gate.INCOMING), (True, "Welcome"))
+        revocation.start_refresher.assert_called()
+
+        revocation.publish_revocations()
+        # Gates re-sync every REVOCATION_REFRESH_SECONDS
+        revocation._filter = (0, None)
+        with self.assertNumQueries(0):
+            self.assertEqual(
+                self.scan(in_use, gate.INCOMING), (False, "Already scanned")
+            )
+
+    def test_revocations_view(self):
+        in_use = self.ticket("A", "C", "In Use")
+        revocation.publish_revocations()
+
+        response = self.client.get(reverse("scanner:gate-revocations"))
+
+        revocations = revocation.from_bytes(response.content)
+        self.assertIn(in_use.id, revocations.in_use)
+        self.assertNotIn(in_use.id, revocations.expired)
+
+
+class ScannerViewTests(NetworkTestCase):
+    def setUp(self):
+        super().setUp()
+        patcher = mock.patch("scanner.batching.BatchWriter._start")
+        patcher.start()
+        self.addCleanup(patcher.stop)
+        self.queued_taps()
+        self.client.force_login(self.passenger.user)
+
+    def queued_taps(self):
+        """Takes the taps queued in the tap log, by this test or the previous ones"""
+        taps = []
+        while not tap_log.queue.empty():
+            taps.append(tap_log.queue.get_nowait())
+        return taps
+
+    def test_outgoing_statuses(self):
+        messages = {
+            "in use": "Journey completed",
+            "In Use": "Journey completed",
+            "expired": "Already scanned",
+            "Expired": "Already scanned",
+            "active": "Invalid, go to the incoming platform",
+            "pending": "Payment pending",
+        }
+        for status, message in messages.items():
+            with self.subTest(status=status):
+                ticket = self.ticket("A", "C", status)
+                response = self.client.post(
+                    reverse("scanner:scanner-outgoing"), {"ticket_id": ticket.id}
+                )
+                self.assertContains(response, message)
+
+        self.assertEqual(
+            [tap[-1] for tap in self.queued_taps()], list(messages.values())
+        )
+
+
+class TapLogTests(NetworkTestCase):
+    def events(self):
+        now = timezone.now()
+        return [
+            (1, None, "incoming", now, True, "Welcome"),
+            (2, 5, "outgoing", now, False, ""),
+        ]
+
+    def test_flush_with_an_empty_result(self):
+        log = TapLog(batch_size=10, interval=1)
+        with mock.patch.object(TapLog, "_start"):
+            for event in self.events():
+                log.submit(event)
+        log.flush()
+
+        self.assertEqual(
+            list(
+                TapEvent.objects.order_by("ticket_id").values_list(
+                    "station_id", "result"
+                )
+            ),
+            [(None, "Welcome"), (5, "")],
+        )
+
+    def test_copy_keeps_empty_results(self):
+        connection = mock.MagicMock()
+        connection.ops.quote_name = lambda name: f'"{name}"'
+        cursor = connection.cursor.return_value.__enter__.return_value
+        copied = []
+        cursor.copy_expert.side_effect = lambda sql, buffer: copied.append(
+            (sql, buffer.read())
+        )
+
+        TapLog.copy(connection, self.events())
+
+        sql, data = copied[0]
+        self.assertIn('FORCE_NOT_NULL ("direction", "result")', sql)
+        # The missing station is NULL (empty), the empty result is kept by FORCE_NOT_NULL
+        rows = data.splitlines()
+        self.assertTrue(rows[0].startswith("1,,incoming,"))
+        self.assertTrue(rows[1].endswith(",False,"))
+
+
+@override_settings(OCCUPANCY_TICK_SECONDS=0.01)
+class OccupancyTests(NetworkTestCase):
+    def setUp(self):
+        super().setUp()
+        patcher = mock.patch("scanner.batching.BatchWriter._start")
+        patcher.start()
+        self.addCleanup(patcher.stop)
+        # Left by the previous tests
+        while not occupancy.writer.queue.empty():
+            occupancy.writer.queue.get_nowait()
+
+    def counts(self, in_use, exits=0):
+        return {"in_use": in_use, "exits_per_minute": exits}
+
+    def test_counter_writer(self):
+        occupancy.writer.write(
+            [
+                ("a", 1, None),
+                ("a", 1, None),
+                ("b", -1, 60),
+                # Adds up to nothing, never written
+                ("c", 1, None),
+                ("c", -1, None),
+            ]
+        )
+        occupancy.writer.write([("a", 3, None)])
+
+        self.assertEqual(cache.get_many(["a", "b", "c"]), {"a": 5, "b": -1})
+
+    def test_read_counters(self):
+        a, c = (self.stations[name].id for name in "AC")
+        self.ticket("A", "C", "In Use")
+        self.ticket("A", "E", "in use")
+        self.ticket("D", "C", "active")
+
+        # Recounted from the tickets on the first read
+        self.assertEqual(occupancy.read_counters(), {a: self.counts(2)})
+
+        minute = occupancy.current_minute()
+        occupancy.record_exit(a, c)
+        occupancy.record_entry(c, tickets=3)
+        occupancy.writer.flush()
+        # Exits are counted over the last complete minute
+        self.assertEqual(
+            occupancy.read_counters(), {a: self.counts(1), c: self.counts(3)}
+        )
+        with mock.patch.object(occupancy, "current_minute", return_value=minute + 1):
+            self.assertEqual(
+                occupancy.read_counters(), {a: self.counts(1), c: self.counts(3, 1)}
+            )
+
+    def test_changes(self):
+        self.assertEqual(
+            occupancy.changes(
+                {1: self.counts(1), 2: self.counts(2)},
+                {2: self.counts(2), 3: self.counts(0, 1)},
+            ),
+            {1: self.counts(0), 3: self.counts(0, 1)},
+        )
+
+    async def next_event(self, subscriber):
+        return await asyncio.wait_for(subscriber.queue.get(), 5)
+
+    async def test_feed(self):
+        feed = occupancy.OccupancyFeed()
+        counters = {1: self.counts(1)}
+        with mock.patch.object(occupancy, "read_counters", lambda: dict(counters)):
+            first = feed.subscribe()
+            self.assertEqual(
+                await self.next_event(first), ("snapshot", {1: self.counts(1)})
+            )
+
+            counters[2] = self.counts(1)
+            self.assertEqual(
+                await self.next_event(first), ("delta", {2: self.counts(1)})
+            )
+
+            # A new viewer gets a snapshot, then the same deltas as the others
+            second = feed.subscribe()
+            self.assertEqual(
+                await self.next_event(second),
+                ("snapshot", {1: self.counts(1), 2: self.counts(1)}),
+            )
+            del counters[1]
+            for subscriber in (first, second):
+                self.assertEqual(
+                    await self.next_event(subscriber), ("delta", {1: self.counts(0)})
+                )
+            self.assertTrue(first.queue.empty())
+
+            # The producer stops with the last viewer
+            task = feed._task
+            feed.unsubscribe(first)
+            feed.unsubscribe(second)
+            await asyncio.wait_for(task, 5)
+            self.assertIsNone(feed._task)
+            self.assertEqual(feed.counters, {})
+
+    async def test_lagging_viewer_gets_a_new_snapshot(self):
+        feed = occupancy.OccupancyFeed()
+        counters = {1: self.counts(1)}
+        with (
+            mock.patch.object(occupancy, "SUBSCRIBER_QUEUE_SIZE", 1),
+            mock.patch.object(occupancy, "read_counters", lambda: dict(counters)),
+        ):
+            subscriber = feed.subscribe()
+            while subscriber.queue.empty():
+                await asyncio.sleep(0.01)
+            # Missed while the queue is full
+            counters[1] = self.counts(2)
+            while not subscriber.needs_snapshot:
+                await asyncio.sleep(0.01)
+
+            self.assertEqual(
+                await self.next_event(subscriber), ("snapshot", {1: self.counts(1)})
+            )
+            self.assertEqual(
+                await self.next_event(subscriber), ("snapshot", {1: self.counts(2)})
+            )
+            feed.unsubscribe(subscriber)
+
+    async def test_occupancy_stream(self):
+        # The stream is for staff, the scanner pages only scan the user's own tickets
+        await User.objects.filter(id=self.passenger.user_id).aupdate(is_staff=True)
+        await self.async_client.aforce_login(self.passenger.user)
+        ticket = await sync_to_async(self.ticket)("A", "C")
+        a = self.stations["A"].id
+
+        with mock.patch("scanner.views.feed", occupancy.OccupancyFeed()):
+            response = await self.async_client.get(reverse("scanner:occupancy-stream"))
+            self.assertEqual(response["Content-Type"], "text/event-stream")
+            events = response.streaming_content
+            try:
+                self.assertEqual(
+                    await asyncio.wait_for(anext(events), 5),
+                    b"event: snapshot\ndata: {}\n\n",
+                )
+
+                await self.async_client.post(
+                    reverse("scanner:scanner-incoming"), {"ticket_id": ticket.id}
+                )
+                await sync_to_async(occupancy.writer.flush)()
+
+                data = json.dumps({a: self.counts(1)})
+                self.assertEqual(
+                    await asyncio.wait_for(anext(events), 5),
+                    f"event: delta\ndata: {data}\n\n".encode(),
+                )
+            finally:
+                await events.aclose()
@@ -1,12 +1,29 @@
 from django.urls import path
 from . import views
+from .gate import INCOMING, OUTGOING
 
 app_name = "scanner"
 
 urlpatterns = [
     path("", views.index, name="index"),
     path("offline", views.purchase_offline, name="offline"),
+    path("offline/group", views.purchase_group, name="offline-group"),
     path("scanner", views.scan_tickets, name="scanner"),
     path("scanner/incoming", views.incoming, name="scanner-incoming"),
     path("scanner/outgoing", views.outgoing, name="scanner-outgoing"),
+    path(
+        "gate/<int:station_id>/incoming",
+        views.gate_scan,
+        {"direction": INCOMING},
+        name="gate-incoming",
+    ),
+    path(
+        "gate/<int:station_id>/outgoing",
+        views.gate_scan,
+        {"direction": OUTGOING},
+        name="gate-outgoing",
+    ),
+    path("gate/revocations", views.revocations, name="gate-revocations"),
+    path("occupancy", views.occupancy, name="occupancy"),
+    path("occupancy/stream", views.occupancy_stream, name="occupancy-stream"),
 ]
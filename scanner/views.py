@@ -1,9 +1,23 @@
+import asyncio
+import json
+
 from django.contrib.admin.views.decorators import staff_member_required
 from django.contrib.auth.decorators import login_required
+from django.db import transaction
+from django.http import HttpResponse, JsonResponse, StreamingHttpResponse
 from django.shortcuts import render
-from .forms import TicketForm, TicketIncomingForm, TicketOutgoingForm
-from passengers.pathfinder import shortest_path
-from passengers.models import Ticket
+from django.views.decorators.cache import cache_control
+from django.views.decorators.csrf import csrf_exempt
+from django.views.decorators.http import require_GET, require_POST
+from django.conf import settings
+from .forms import GroupTicketForm, TicketForm, TicketIncomingForm, TicketOutgoingForm
+from passengers.routing_client import shortest_route
+from passengers.catalogue import get_station_catalogue
+from passengers.models import Passenger, Ticket, TicketChange
+from .gate import INCOMING, OUTGOING, scan
+from .occupancy import feed, record_entry, record_exit
+from .revocation import get_revocation_data
+from .tap_log import record_tap
 
 
 def index(request):
@@ -37,9 +51,18 @@ def incoming(request):
                 else:
                     ticket.status = "In Use"
                     ticket.save()
+                    record_entry(ticket.start_station_id)
                     message = "Scanned and updated successfully"
             except Ticket.DoesNotExist:
                 message = "Invalid ticket ID/ Ticket doesn't belong to this passenger"
+
+            record_tap(
+                ticket_id,
+                None,
+                INCOMING,
+                message == "Scanned and updated successfully",
+                message,
+            )
     else:
         form = TicketIncomingForm()
 
@@ -60,18 +83,25 @@ def outgoing(request):
                     id=ticket_id, passenger=request.user.passenger
                 )
 
-                if ticket.status == "In Use":
+                if ticket.status.lower() == "in use":
                     ticket.status = "Expired"
                     ticket.save()
+                    record_exit(ticket.start_station_id, ticket.destination_id)
                     message = "Journey completed"
                 elif ticket.status.lower() == "active":
                     message = "Invalid, go to the incoming platform"
                 elif ticket.status.lower() == "pending":
                     message = "Payment pending"
-                elif ticket.status == "Expired":
+                elif ticket.status.lower() == "expired":
                     message = "Already scanned"
+                else:
+                    message = "Invalid ticket status"
             except Ticket.DoesNotExist:
                 message = "Invalid ticket ID/ Ticket doesn't belong to this passenger"
+
+            record_tap(
+                ticket_id, None, OUTGOING, message == "Journey completed", message
+            )
     else:
         form = TicketOutgoingForm()
     return render(request, "scanner/outgoing.html", {"form": form, "message": message})
@@ -93,11 +123,10 @@ def purchase_offline(request):
                 )
 
             try:
-                total_cost, total_distance, connections = shortest_path(
-                    ticket.start_station, ticket.destination
-                )
-                ticket.cost = total_cost
+                route = shortest_route(ticket.start_station_id, ticket.destination_id)
+                ticket.cost = route.cost
                 ticket.save()
+                record_entry(ticket.start_station_id)
                 blank_form = TicketForm()
                 return render(
                     request,
@@ -121,3 +150,128 @@ def purchase_offline(request):
         form = TicketForm()
 
     return render(request, "scanner/purchase.html", {"form": form})
+
+
+@staff_member_required
+def purchase_group(request):
+    """
+    Issues identical tickets for a group (ex. a school trip) in one go. The route is computed
+    once for the whole group and every ticket is inserted with a single bulk_create, instead of
+    routing and saving each ticket separately. Tickets are issued "In Use", like the single
+    offline purchase.
+    """
+    issued = []
+    if request.method == "POST":
+        form = GroupTicketForm(request.POST)
+        if form.is_valid():
+            start_station = form.cleaned_data["start_station"]
+            destination = form.cleaned_data["destination"]
+
+            try:
+                route = shortest_route(start_station.id, destination.id)
+            except ValueError:
+                return render(
+                    request,
+                    "scanner/group.html",
+                    {
+                        "form": form,
+                        "error": "No operational lines between these stations.",
+                    },
+                )
+
+            tickets = [
+                Ticket(
+                    passenger=passenger,
+                    start_station=start_station,
+                    destination=destination,
+                    cost=route.cost,
+                    status="In Use",
+                )
+                for passenger, quantity in form.cleaned_data["passengers"]
+                for _ in range(quantity)
+            ]
+            # bulk_create doesn't call Ticket.save(), so the route isn't computed again, and
+            # the new tickets are added to the change feed here
+            with transaction.atomic():
+                issued = Ticket.objects.bulk_create(tickets)
+                TicketChange.record(
+                    [(ticket.id, "", ticket.status, ticket.cost) for ticket in issued]
+                )
+                Passenger.bump_versions({ticket.passenger_id for ticket in issued})
+            record_entry(start_station.id, len(issued))
+
+            return render(
+                request,
+                "scanner/group.html",
+                {
+                    "form": GroupTicketForm(),
+                    "success": f"Issued {len(issued)} tickets at ${route.cost} each",
+                    "issued": issued,
+                },
+            )
+    else:
+        form = GroupTicketForm()
+
+    return render(request, "scanner/group.html", {"form": form})
+
+
+@csrf_exempt
+@require_POST
+def gate_scan(request, station_id, direction):
+    """
+    Called by the gates of a station with the token the passenger presented. Gates have no
+    session: the token's signature is the proof, and the check doesn't touch the database.
+    """
+    accepted, message = scan(request.POST.get("token", ""), station_id, direction)
+    return JsonResponse(
+        {"accepted": accepted, "message": message}, status=200 if accepted else 403
+    )
+
+
+@require_GET
+@cache_control(max_age=settings.REVOCATION_REFRESH_SECONDS)
+def revocations(request):
+    """The revocation filter synced by the gates (see revocation.py for the format)"""
+    return HttpResponse(get_revocation_data(), content_type="application/octet-stream")
+
+
+@staff_member_required
+def occupancy(request):
+    """Live station dashboard, fed by occupancy_stream"""
+    return render(
+        request,
+        "scanner/occupancy.html",
+        {"stations": get_station_catalogue()},
+    )
+
+
+@staff_member_required
+async def occupancy_stream(request):
+    """
+    Server-sent events with the station counters (see occupancy.py): a "snapshot" event with
+    every non-zero counter first, then "delta" events with the stations that changed. Must be
+    served by the ASGI application, a WSGI worker would be held by every open stream.
+    """
+
+    async def events():
+        subscriber = feed.subscribe()
+        try:
+            while True:
+                try:
+                    event, counters = await asyncio.wait_for(
+                        subscriber.queue.get(), settings.OCCUPANCY_HEARTBEAT_SECONDS
+                    )
+                except TimeoutError:
+                    # Keeps proxies from closing an idle connection
+                    yield ": keep-alive\n\n"
+                    continue
+                data = json.dumps(counters)
+                yield f"event: {event}\ndata: {data}\n\n"
+        finally:
+            feed.unsubscribe(subscriber)
+
+    response = StreamingHttpResponse(events(), content_type="text/event-stream")
+    response["Cache-Control"] = "no-cache"
+    # nginx would otherwise buffer the events
+    response["X-Accel-Buffering"] = "no"
+    return response